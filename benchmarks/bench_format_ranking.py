@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+フォーマットの順位付け（format_table / rank_formats / select_formats）のマイクロベンチマーク
+
+大量の架空のフォーマットを作り、ポリシーごとの所要時間を計測する。
+
+使用方法: python benchmarks/bench_format_ranking.py [--sizes 100,1000,10000,100000] [--repeat N]
+"""
+
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import youtube_dl_v3  # noqa: E402
+
+HEIGHTS = [144, 240, 360, 480, 720, 1080, 1440, 2160]
+VIDEO_CODECS = [('avc1.640028', 'mp4'), ('vp09.00.40.08', 'webm'), ('av01.0.08M.08', 'mp4')]
+AUDIO_CODECS = [('mp4a.40.2', 'm4a'), ('opus', 'webm')]
+
+
+def synthetic_formats(n, seed=0):
+    """動画:音声 = 4:1 の架空のフォーマットを n 個作る"""
+    rng = random.Random(seed)
+    formats = []
+    for i in range(n):
+        if i % 5 == 4:
+            acodec, ext = rng.choice(AUDIO_CODECS)
+            abr = rng.choice([48, 64, 128, 160, 256])
+            formats.append({
+                'format_id': f'a{i}', 'ext': ext, 'vcodec': 'none', 'acodec': acodec,
+                'abr': abr, 'tbr': abr, 'filesize': abr * 125 * 300, 'url': 'u'})
+        else:
+            vcodec, ext = rng.choice(VIDEO_CODECS)
+            height = rng.choice(HEIGHTS)
+            tbr = height * rng.uniform(1.0, 4.0)
+            f = {
+                'format_id': f'v{i}', 'ext': ext, 'vcodec': vcodec, 'acodec': 'none',
+                'width': height * 16 // 9, 'height': height, 'fps': rng.choice([24, 30, 60]),
+                'tbr': tbr, 'url': 'u' if rng.random() > 0.05 else None}
+            # サイズは正確な値・推定値・不明が混在する
+            size_kind = rng.random()
+            if size_kind < 0.5:
+                f['filesize'] = int(tbr * 125 * 300)
+            elif size_kind < 0.8:
+                f['filesize_approx'] = int(tbr * 125 * 300)
+            formats.append(f)
+    return formats
+
+
+def timed(func, repeat):
+    """repeat 回実行した中で最短の所要時間[ms]"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    sizes = [100, 1000, 10000, 100000]
+    repeat = 5
+    argv = sys.argv[1:]
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--sizes' and i + 1 < len(argv):
+            sizes = [int(n) for n in argv[i + 1].split(',')]
+        elif argv[i] == '--repeat' and i + 1 < len(argv):
+            repeat = int(argv[i + 1])
+        else:
+            print(f"⚠️ 不明なオプション: {argv[i]}")
+            i += 1
+            continue
+        i += 2
+
+    results = []
+    for n in sizes:
+        formats = synthetic_formats(n)
+        rows = youtube_dl_v3.format_table(formats, duration=300)
+        result = {
+            'formats': n,
+            'format_table_ms': timed(lambda: youtube_dl_v3.format_table(formats, duration=300), repeat),
+        }
+        for policy in youtube_dl_v3.FORMAT_POLICIES:
+            result[f'rank_{policy}_ms'] = timed(lambda: youtube_dl_v3.rank_formats(rows, policy), repeat)
+            result[f'select_{policy}_ms'] = timed(
+                lambda: youtube_dl_v3.select_formats(formats, policy, duration=300), repeat)
+        results.append(result)
+
+        print(f"📊 {n}フォーマット: 表の作成 {result['format_table_ms']:.2f}ms")
+        for policy in youtube_dl_v3.FORMAT_POLICIES:
+            print(f"  {policy:<10} 順位付け {result[f'rank_{policy}_ms']:.2f}ms, "
+                  f"選択（表の作成込み） {result[f'select_{policy}_ms']:.2f}ms")
+
+    print(json.dumps(results, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
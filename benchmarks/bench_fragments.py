@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+フラグメントの同時ダウンロードと、動画/音声ストリームの並列ダウンロードのベンチマーク
+
+ローカルに遅延付きのHTTPサーバーを立て、HLS（セグメント分割）と
+動画/音声が別々のフォーマットをダウンロードして所要時間を比較する。
+ネットワークには接続しない。
+
+使用方法: python benchmarks/bench_fragments.py [--segments N] [--latency SECONDS] [--concurrency N]
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import youtube_dl_v3  # noqa: E402
+
+SEGMENT_SIZE = 256 * 1024
+STREAM_SIZE = 2 * 1024 * 1024
+
+
+def make_handler(root, latency):
+    """リクエストごとに latency 秒待ってから応答するハンドラー"""
+
+    class Handler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=root, **kwargs)
+
+        def do_GET(self):
+            time.sleep(latency)
+            super().do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def write_fixtures(root, segments):
+    """HLSのプレイリストとセグメント、動画/音声ファイルを作成する"""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+    for i in range(segments):
+        name = f'seg{i}.ts'
+        (root / name).write_bytes(os.urandom(SEGMENT_SIZE))
+        lines += ['#EXTINF:2.0,', name]
+    lines.append('#EXT-X-ENDLIST')
+    (root / 'index.m3u8').write_text('\n'.join(lines) + '\n')
+    (root / 'video.mp4').write_bytes(os.urandom(STREAM_SIZE))
+    (root / 'audio.m4a').write_bytes(os.urandom(STREAM_SIZE // 4))
+
+
+def make_info(base_url, kind):
+    """ベンチマーク用のinfo dict"""
+    if kind == 'hls':
+        formats = [{'format_id': 'hls', 'url': f'{base_url}/index.m3u8', 'ext': 'mp4',
+                    'protocol': 'm3u8_native', 'vcodec': 'avc1', 'acodec': 'mp4a'}]
+    else:
+        formats = [{'format_id': 'v', 'url': f'{base_url}/video.mp4', 'ext': 'mp4',
+                    'vcodec': 'avc1', 'acodec': 'none'},
+                   {'format_id': 'a', 'url': f'{base_url}/audio.m4a', 'ext': 'm4a',
+                    'vcodec': 'none', 'acodec': 'mp4a'}]
+    return {'id': kind, 'title': 'bench', 'extractor': 'generic', 'extractor_key': 'Generic',
+            'webpage_url': f'{base_url}/', 'formats': formats}
+
+
+def run_once(base_url, kind, options, throttle):
+    """1回ダウンロードして所要時間を返す"""
+    output_dir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        ydl_opts = youtube_dl_v3.build_download_opts(output_dir, options=options)
+        ydl_opts.update({
+            'quiet': True,
+            'no_warnings': True,
+            'progress_hooks': [],
+            'format': 'bv+ba' if kind == 'streams' else 'best',
+            'ratelimit': throttle,
+            # 計測するのはダウンロードのみ（HLSのfixupは行わない）
+            'fixup': 'never',
+        })
+        ydl = youtube_dl_v3.create_ydl(ydl_opts)
+        info = ydl.process_ie_result(make_info(base_url, kind), download=False)
+        started = time.monotonic()
+        youtube_dl_v3.download_media(ydl, info, {**youtube_dl_v3.DEFAULT_DOWNLOAD_OPTIONS, **options})
+        return time.monotonic() - started
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def main():
+    segments = 32
+    latency = 0.05
+    concurrency = 8
+    argv = sys.argv[1:]
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--segments' and i + 1 < len(argv):
+            segments = int(argv[i + 1])
+        elif argv[i] == '--latency' and i + 1 < len(argv):
+            latency = float(argv[i + 1])
+        elif argv[i] == '--concurrency' and i + 1 < len(argv):
+            concurrency = int(argv[i + 1])
+        else:
+            print(f"⚠️ 不明なオプション: {argv[i]}")
+            i += 1
+            continue
+        i += 2
+
+    root = Path(tempfile.mkdtemp(prefix='bench-srv-'))
+    write_fixtures(root, segments)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(str(root), latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    results = {'segments': segments, 'latency': latency, 'concurrency': concurrency}
+    try:
+        print(f"📊 HLS {segments}セグメント（遅延 {latency}秒/リクエスト）")
+        for n in (1, concurrency):
+            elapsed = run_once(base_url, 'hls', {'concurrent_fragments': n}, None)
+            results[f'hls_fragments_{n}'] = elapsed
+            print(f"  フラグメント同時数 {n}: {elapsed:.2f}秒")
+
+        # マージにffmpegが必要
+        if shutil.which('ffmpeg'):
+            # 帯域を制限して、ストリームを同時に取得する効果を見る
+            throttle = 4 * 1024 * 1024
+            print("📊 動画/音声ストリーム（4MB/sに制限）")
+            for parallel in (False, True):
+                elapsed = run_once(base_url, 'streams', {'parallel_streams': parallel}, throttle)
+                results[f'streams_{"parallel" if parallel else "sequential"}'] = elapsed
+                print(f"  {'並列' if parallel else '順次'}: {elapsed:.2f}秒")
+        else:
+            print("⚠️ ffmpegが無いため、ストリームの並列ダウンロードは計測しません")
+    finally:
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+
+    print(json.dumps(results, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
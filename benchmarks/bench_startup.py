@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+CLIの起動時間のベンチマーク
+
+pyproject.toml の youtube-dl コマンド（youtube_dl_v3:main）を、ダウンロードを伴わない
+引数（使用方法の表示・引数のエラーなど）で起動し、終了までの時間と
+python -X importtime で計測した import の時間を記録する。
+これらの経路では yt-dlp を import しないことも確認する。
+
+youtube-dl コマンドがインストールされていればそれを、無ければ同じ処理を python -c で実行する。
+
+使用方法: python benchmarks/bench_startup.py [--repeat N] [--top N] [--output FILE]
+                                            [--baseline FILE] [--save-baseline FILE] [--tolerance RATIO]
+"""
+
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# pyproject.toml の [project.scripts] が生成するコマンドと同じ処理
+ENTRY_POINT = "import sys; sys.argv[0] = 'youtube-dl'; from youtube_dl_v3 import main; sys.exit(main())"
+
+# シナリオ名 → コマンドライン引数
+SCENARIOS = {
+    'help': ['--help'],
+    'no_args': [],
+    'bad_args': ['--workers', 'x'],
+    'missing_url': ['--list-formats'],
+}
+
+# 比較する指標（いずれも小さいほど良い）
+METRICS = ('wall_ms', 'import_ms', 'yt_dlp_ms')
+
+_IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( +)(\S+)$')
+
+
+def command(args):
+    """youtube-dl コマンドを起動するコマンドライン"""
+    script = shutil.which('youtube-dl')
+    if script:
+        return [script, *args]
+    return [sys.executable, '-c', ENTRY_POINT, *args]
+
+
+def parse_importtime(stderr):
+    """
+    -X importtime の出力から {モジュール: (自身[us], 累計[us], 深さ)} を作る
+
+    深さ1のモジュール（インタプリタが直接 import したもの）の累計の合計が import 全体の時間
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(cumulative_us), (len(indent) + 1) // 2)
+    return modules
+
+
+def run_once(args):
+    """1回起動して、所要時間とimportの計測結果を返す"""
+    env = {**os.environ, 'PYTHONPROFILEIMPORTTIME': '1',
+           'PYTHONPATH': os.pathsep.join(filter(None, [str(ROOT), os.environ.get('PYTHONPATH')]))}
+    started = time.perf_counter()
+    proc = subprocess.run(command(args), capture_output=True, text=True, env=env, cwd=ROOT)
+    wall = time.perf_counter() - started
+    modules = parse_importtime(proc.stderr)
+    yt_dlp = modules.get('yt_dlp')
+    return {
+        'exit_code': proc.returncode,
+        'wall_ms': wall * 1000,
+        'import_ms': sum(cumulative for _, cumulative, depth in modules.values() if depth == 1) / 1000,
+        'yt_dlp_loaded': yt_dlp is not None,
+        'yt_dlp_ms': yt_dlp[1] / 1000 if yt_dlp else 0.0,
+        'modules': modules,
+    }
+
+
+def run_scenario(args, repeat, top):
+    """repeat 回起動して、指標ごとの中央値と、import に時間のかかったモジュールを返す"""
+    runs = [run_once(args) for _ in range(repeat)]
+    result = {key: statistics.median(r[key] for r in runs) for key in METRICS}
+    result['exit_code'] = runs[0]['exit_code']
+    result['yt_dlp_loaded'] = any(r['yt_dlp_loaded'] for r in runs)
+    # 自身の時間が長い順（最初の1回の計測）
+    slowest = sorted(runs[0]['modules'].items(), key=lambda item: item[1][0], reverse=True)[:top]
+    result['slowest'] = [{'module': name, 'self_ms': self_us / 1000, 'cumulative_ms': cumulative_us / 1000}
+                         for name, (self_us, cumulative_us, _) in slowest]
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    ベースラインと比較して表示し、悪化した指標の一覧を返す
+
+    yt-dlp を import するようになったら、それ以外は tolerance の割合を超えて遅くなったら悪化とみなす
+    """
+    regressions = []
+    print(f"\n📊 ベースラインとの比較（許容: {tolerance:.0%}）")
+    for scenario, result in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(scenario)
+        if not base:
+            continue
+        if result['yt_dlp_loaded'] and not base.get('yt_dlp_loaded'):
+            print(f"  ❌ {scenario:<12} yt-dlp を import するようになりました")
+            regressions.append({'scenario': scenario, 'metric': 'yt_dlp_loaded',
+                                'baseline': False, 'current': True})
+        for metric in METRICS:
+            current, previous = result.get(metric), base.get(metric)
+            if current is None or previous is None:
+                continue
+            worse = previous > 0 and (current - previous) / previous > tolerance
+            ratio = f"{current / previous:.2f}x" if previous else '-'
+            print(f"  {'❌' if worse else '✓'} {scenario:<12} {metric:<10} "
+                  f"{previous:>9.1f}ms → {current:>9.1f}ms ({ratio})")
+            if worse:
+                regressions.append({'scenario': scenario, 'metric': metric,
+                                    'baseline': previous, 'current': current})
+    return regressions
+
+
+def main():
+    repeat = 5
+    top = 5
+    output = None
+    baseline_path = None
+    save_baseline = None
+    tolerance = 0.2
+    argv = sys.argv[1:]
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--repeat' and i + 1 < len(argv):
+            repeat = int(argv[i + 1])
+        elif argv[i] == '--top' and i + 1 < len(argv):
+            top = int(argv[i + 1])
+        elif argv[i] == '--output' and i + 1 < len(argv):
+            output = argv[i + 1]
+        elif argv[i] == '--baseline' and i + 1 < len(argv):
+            baseline_path = argv[i + 1]
+        elif argv[i] == '--save-baseline' and i + 1 < len(argv):
+            save_baseline = argv[i + 1]
+        elif argv[i] == '--tolerance' and i + 1 < len(argv):
+            tolerance = float(argv[i + 1])
+        else:
+            print(f"⚠️ 不明なオプション: {argv[i]}")
+            i += 1
+            continue
+        i += 2
+
+    print(f"📊 起動: {' '.join(command([]))}（{repeat}回の中央値）")
+    # 比較のため、何も import しないインタプリタの起動時間
+    started = time.perf_counter()
+    for _ in range(repeat):
+        subprocess.run([sys.executable, '-c', 'pass'], capture_output=True)
+    interpreter_ms = (time.perf_counter() - started) / repeat * 1000
+    print(f"  {'(python -c pass)':<12} {interpreter_ms:.1f}ms")
+
+    results = {'config': {'repeat': repeat, 'command': command([])[0]},
+               'interpreter_ms': interpreter_ms, 'scenarios': {}}
+    for scenario, args in SCENARIOS.items():
+        result = run_scenario(args, repeat, top)
+        results['scenarios'][scenario] = result
+        loaded = f"yt-dlp {result['yt_dlp_ms']:.1f}ms" if result['yt_dlp_loaded'] else "yt-dlp なし"
+        print(f"  {scenario:<12} {result['wall_ms']:.1f}ms（import {result['import_ms']:.1f}ms, {loaded}, "
+              f"終了コード {result['exit_code']}）")
+        for module in result['slowest']:
+            print(f"    {module['module']:<40} {module['self_ms']:>7.2f}ms（累計 {module['cumulative_ms']:.2f}ms）")
+
+    regressions = []
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), tolerance)
+        results['regressions'] = regressions
+
+    if save_baseline:
+        with open(save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 ベースラインを保存しました: {save_baseline}")
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False))
+
+    if regressions:
+        print(f"\n❌ {len(regressions)}件の指標がベースラインより悪化しました")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
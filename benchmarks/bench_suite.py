@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+ローカルの偽YouTubeサーバーを使った、ダウンロード全体のベンチマーク
+
+ローカルにHTTPサーバーを立て、スタブの抽出器が取得する動画情報（APIの応答）と、
+合成したメディア（単一ファイル / DASH / HLS）を指定のサイズ・遅延で配信する。
+その上で download_video / download_video_with_format / list_formats / バッチを実行し、
+最初のバイトまでの時間・スループット・CPU時間・最大メモリ・抽出回数を計測する。
+ネットワークには接続しない。
+
+各シナリオは別プロセスで実行する（最大メモリをシナリオごとに測るため）。
+合成メディアはランダムなバイト列なので、ffmpegによる後処理は計測しない。
+
+使用方法: python benchmarks/bench_suite.py [--size MB] [--latency SECONDS] [--segments N]
+                                          [--batch-size N] [--workers N] [--repeat N]
+                                          [--scenarios NAME,...] [--output FILE]
+                                          [--baseline FILE] [--save-baseline FILE] [--tolerance RATIO]
+"""
+
+import json
+import os
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+SCENARIOS = ['progressive', 'dash', 'hls', 'with_format', 'list_formats', 'batch']
+
+# 比較する指標と、値が小さい方が良いか
+METRICS = {
+    'elapsed': True,
+    'ttfb': True,
+    'throughput': False,
+    'cpu_seconds': True,
+    'peak_rss_mb': True,
+    'extractor_calls': True,
+}
+
+SEGMENT_DURATION = 2
+
+
+class MediaServer:
+    """
+    偽のYouTubeサーバー
+
+    /api/<id>.json  スタブの抽出器が取得する動画情報
+    /media/<id>/... 合成したメディア（progressive.mp4 / DASHのフラグメント / HLSのセグメント）
+
+    動画IDは '<種類>-<番号>'（例: 'dash-0'）で、種類ごとに高画質・低画質の2フォーマットを返す。
+    低画質のフォーマットは高画質の1/4のサイズ。
+    """
+
+    def __init__(self, size, latency, segments):
+        self.size = size
+        self.latency = latency
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.payloads = {}
+        self.reset()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def reset(self):
+        """シナリオごとの記録を消す"""
+        with self.lock:
+            self.api_requests = 0
+            self.media_bytes = 0
+            self.first_media_at = None
+
+    def payload(self, n):
+        """n バイトのランダムなデータ（サイズごとに1回だけ作成）"""
+        with self.lock:
+            if n not in self.payloads:
+                self.payloads[n] = os.urandom(n)
+            return self.payloads[n]
+
+    def info(self, video_id):
+        """スタブの抽出器に返す動画情報"""
+        kind = video_id.split('-')[0]
+        media = f'{self.base_url}/media/{video_id}'
+        duration = self.segments * SEGMENT_DURATION
+        formats = []
+        for quality, height, size in (('low', 360, self.size // 4), ('high', 720, self.size)):
+            f = {
+                'format_id': f'{kind}-{height}',
+                'ext': 'mp4',
+                'vcodec': 'avc1.64001F',
+                'acodec': 'mp4a.40.2',
+                'width': height * 16 // 9,
+                'height': height,
+                'tbr': size * 8 / 1000 / duration,
+                'filesize': size,
+            }
+            if kind == 'dash':
+                f.update({
+                    'url': f'{media}/{quality}.mpd',
+                    'protocol': 'http_dash_segments',
+                    'fragment_base_url': f'{media}/{quality}/',
+                    'fragments': [{'path': f'seg{i}.m4s', 'duration': SEGMENT_DURATION}
+                                  for i in range(self.segments)],
+                })
+            elif kind == 'hls':
+                f.update({'url': f'{media}/{quality}.m3u8', 'protocol': 'm3u8_native'})
+            else:
+                f['url'] = f'{media}/{quality}.mp4'
+            formats.append(f)
+        return {
+            'id': video_id,
+            'title': f'bench {video_id}',
+            'uploader': 'bench',
+            'duration': duration,
+            'view_count': 0,
+            'webpage_url': f'{self.base_url}/watch?v={video_id}',
+            'formats': formats,
+        }
+
+    def media(self, path):
+        """メディアのパスに対する (Content-Type, 本体)。存在しなければNone"""
+        m = re.fullmatch(r'/media/(?P<id>[\w-]+)/(?P<quality>low|high)(?:\.(?P<ext>\w+)|/seg(?P<seg>\d+)\.\w+)',
+                         path)
+        if not m:
+            return None
+        size = self.size if m['quality'] == 'high' else self.size // 4
+        if m['ext'] == 'm3u8':
+            lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{SEGMENT_DURATION}',
+                     '#EXT-X-MEDIA-SEQUENCE:0']
+            for i in range(self.segments):
+                lines += [f'#EXTINF:{SEGMENT_DURATION}.0,', f'{m["quality"]}/seg{i}.ts']
+            lines.append('#EXT-X-ENDLIST')
+            return 'application/vnd.apple.mpegurl', ('\n'.join(lines) + '\n').encode()
+        if m['seg'] is not None:
+            return 'video/mp4', self.payload(max(1, size // self.segments))
+        return 'video/mp4', self.payload(size)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                time.sleep(server.latency)
+                path = self.path.split('?')[0]
+                m = re.fullmatch(r'/api/([\w-]+)\.json', path)
+                if m:
+                    with server.lock:
+                        server.api_requests += 1
+                    self._respond('application/json', json.dumps(server.info(m[1])).encode())
+                    return
+                media = server.media(path)
+                if media is None:
+                    self.send_error(404)
+                    return
+                # プレイリストを除いたメディアの本体だけを数える
+                if not path.endswith('.m3u8'):
+                    with server.lock:
+                        server.media_bytes += len(media[1])
+                        if server.first_media_at is None:
+                            server.first_media_at = time.time()
+                self._respond(*media)
+
+            def _respond(self, content_type, body):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def register_stub_extractor():
+    """ローカルサーバーの /watch?v=<id> を扱う抽出器を、yt-dlpの抽出器の先頭に登録する"""
+    import yt_dlp
+    from yt_dlp.extractor.common import InfoExtractor
+
+    class BenchIE(InfoExtractor):
+        IE_NAME = 'bench'
+        _VALID_URL = r'(?P<base>https?://127\.0\.0\.1:\d+)/watch\?v=(?P<id>[\w-]+)'
+
+        def _real_extract(self, url):
+            base, video_id = self._match_valid_url(url).group('base', 'id')
+            return self._download_json(f'{base}/api/{video_id}.json', video_id)
+
+    yt_dlp.extractor.import_extractors()
+    yt_dlp.globals.extractors.value = {'BenchIE': BenchIE, **yt_dlp.globals.extractors.value}
+
+
+def run_child(scenario, base_url, result_path, config):
+    """
+    シナリオを1回実行し、CPU時間・最大メモリ・抽出回数を result_path に書き込む
+
+    （--child で起動された子プロセスで実行される）
+    """
+    import youtube_dl_v3
+
+    register_stub_extractor()
+    # GitHubからEJSソルバーを取得しない
+    youtube_dl_v3.component_settings['offline'] = True
+    # 合成メディアはffmpegで扱えないため、後処理（mp4への変換・メタデータ）は行わない
+    youtube_dl_v3.TARGET_EXT = None
+    youtube_dl_v3.configure_progress('none')
+
+    def watch_url(video_id):
+        return f'{base_url}/watch?v={video_id}'
+
+    output_dir = tempfile.mkdtemp(prefix='bench-out-')
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started_at = time.time()
+    started = time.monotonic()
+    ok = True
+    try:
+        if scenario in ('progressive', 'dash', 'hls'):
+            youtube_dl_v3.download_video(watch_url(f'{scenario}-0'), output_dir)
+        elif scenario == 'with_format':
+            youtube_dl_v3.download_video_with_format(watch_url('dash-0'), output_dir, 'dash-360')
+        elif scenario == 'list_formats':
+            youtube_dl_v3.list_formats(watch_url('progressive-0'))
+        elif scenario == 'batch':
+            kinds = ('progressive', 'dash', 'hls')
+            urls = [watch_url(f'{kinds[i % len(kinds)]}-{i}') for i in range(config['batch_size'])]
+            summary = youtube_dl_v3.run_batch(urls, output_dir, workers=config['workers'])
+            ok = not summary['failed']
+    except SystemExit as e:
+        # download_video はエラー時に sys.exit する
+        ok = not e.code
+    finally:
+        elapsed = time.monotonic() - started
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = ((usage_end.ru_utime + usage_end.ru_stime) - (usage.ru_utime + usage.ru_stime)
+           + (children_end.ru_utime + children_end.ru_stime) - (children.ru_utime + children.ru_stime))
+    # ru_maxrss はLinuxではKB、macOSではバイト
+    peak_rss = usage_end.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'ok': ok,
+            'started_at': started_at,
+            'elapsed': elapsed,
+            'cpu_seconds': cpu,
+            'peak_rss_mb': peak_rss / 1024 / 1024,
+            'extractor_calls': sum(youtube_dl_v3.extractor_calls.values()),
+        }, f)
+
+
+def run_scenario(server, scenario, config, workdir):
+    """シナリオを子プロセスで1回実行し、サーバー側の記録と合わせた結果を返す"""
+    server.reset()
+    result_path = workdir / f'{scenario}.json'
+    log_path = workdir / f'{scenario}.log'
+    env = {**os.environ, 'YTDL_CACHE_DIR': str(workdir / 'cache')}
+    with open(log_path, 'w', encoding='utf-8') as log:
+        subprocess.run(
+            [sys.executable, __file__, '--child', scenario, server.base_url, str(result_path), json.dumps(config)],
+            stdout=log, stderr=subprocess.STDOUT, env=env, check=False)
+    if not result_path.exists():
+        return {'ok': False, 'log': str(log_path)}
+
+    with open(result_path, encoding='utf-8') as f:
+        result = json.load(f)
+    started_at = result.pop('started_at')
+    result['api_requests'] = server.api_requests
+    result['bytes'] = server.media_bytes
+    result['ttfb'] = server.first_media_at - started_at if server.first_media_at else None
+    result['throughput'] = server.media_bytes / result['elapsed'] if server.media_bytes else None
+    if not result['ok']:
+        result['log'] = str(log_path)
+    return result
+
+
+def summarize(runs):
+    """複数回の結果を、指標ごとの中央値にまとめる"""
+    summary = {'ok': all(r['ok'] for r in runs), 'runs': len(runs)}
+    for key in ('elapsed', 'ttfb', 'throughput', 'cpu_seconds', 'peak_rss_mb', 'extractor_calls',
+                'api_requests', 'bytes'):
+        values = [r[key] for r in runs if r.get(key) is not None]
+        summary[key] = statistics.median(values) if values else None
+    logs = [r['log'] for r in runs if 'log' in r]
+    if logs:
+        summary['log'] = logs[0]
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """
+    ベースラインと比較して表示し、悪化した指標の一覧を返す
+
+    抽出回数は1回でも増えたら、それ以外は tolerance の割合を超えて悪化したら悪化とみなす
+    """
+    regressions = []
+    print(f"\n📊 ベースラインとの比較（許容: {tolerance:.0%}）")
+    for scenario, result in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(scenario)
+        if not base:
+            continue
+        for metric, lower_is_better in METRICS.items():
+            current, previous = result.get(metric), base.get(metric)
+            if current is None or previous is None:
+                continue
+            if metric == 'extractor_calls':
+                worse = current > previous
+            elif previous == 0:
+                worse = False
+            else:
+                change = (current - previous) / previous
+                worse = (change > tolerance) if lower_is_better else (change < -tolerance)
+            ratio = f"{current / previous:.2f}x" if previous else '-'
+            print(f"  {'❌' if worse else '✓'} {scenario:<13} {metric:<16} "
+                  f"{previous:>12.3f} → {current:>12.3f} ({ratio})")
+            if worse:
+                regressions.append({'scenario': scenario, 'metric': metric,
+                                    'baseline': previous, 'current': current})
+    return regressions
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        scenario, base_url, result_path, config = sys.argv[2:6]
+        run_child(scenario, base_url, result_path, json.loads(config))
+        return
+
+    size_mb = 8.0
+    latency = 0.02
+    segments = 16
+    config = {'batch_size': 9, 'workers': 4}
+    repeat = 1
+    scenarios = SCENARIOS
+    output = None
+    baseline_path = None
+    save_baseline = None
+    tolerance = 0.2
+    argv = sys.argv[1:]
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--size' and i + 1 < len(argv):
+            size_mb = float(argv[i + 1])
+        elif argv[i] == '--latency' and i + 1 < len(argv):
+            latency = float(argv[i + 1])
+        elif argv[i] == '--segments' and i + 1 < len(argv):
+            segments = int(argv[i + 1])
+        elif argv[i] == '--batch-size' and i + 1 < len(argv):
+            config['batch_size'] = int(argv[i + 1])
+        elif argv[i] == '--workers' and i + 1 < len(argv):
+            config['workers'] = int(argv[i + 1])
+        elif argv[i] == '--repeat' and i + 1 < len(argv):
+            repeat = int(argv[i + 1])
+        elif argv[i] == '--scenarios' and i + 1 < len(argv):
+            scenarios = argv[i + 1].split(',')
+            unknown = [name for name in scenarios if name not in SCENARIOS]
+            if unknown:
+                print(f"❌ 不明なシナリオ: {', '.join(unknown)}（{', '.join(SCENARIOS)}）")
+                sys.exit(1)
+        elif argv[i] == '--output' and i + 1 < len(argv):
+            output = argv[i + 1]
+        elif argv[i] == '--baseline' and i + 1 < len(argv):
+            baseline_path = argv[i + 1]
+        elif argv[i] == '--save-baseline' and i + 1 < len(argv):
+            save_baseline = argv[i + 1]
+        elif argv[i] == '--tolerance' and i + 1 < len(argv):
+            tolerance = float(argv[i + 1])
+        else:
+            print(f"⚠️ 不明なオプション: {argv[i]}")
+            i += 1
+            continue
+        i += 2
+
+    server = MediaServer(int(size_mb * 1024 * 1024), latency, segments)
+    server.start()
+    workdir = Path(tempfile.mkdtemp(prefix='bench-suite-'))
+    results = {
+        'config': {'size_mb': size_mb, 'latency': latency, 'segments': segments, 'repeat': repeat, **config},
+        'scenarios': {},
+    }
+    try:
+        print(f"📊 {size_mb}MB/動画、遅延 {latency}秒/リクエスト、{segments}セグメント、{repeat}回の中央値")
+        for scenario in scenarios:
+            result = summarize([run_scenario(server, scenario, config, workdir) for _ in range(repeat)])
+            results['scenarios'][scenario] = result
+            if not result['ok']:
+                print(f"  ❌ {scenario:<13} 失敗しました（ログ: {result.get('log')}）")
+                continue
+            ttfb = f"{result['ttfb']:.3f}秒" if result['ttfb'] is not None else '-'
+            throughput = (f"{result['throughput'] / 1024 / 1024:.1f}MB/s" if result['throughput'] is not None
+                          else '-')
+            print(f"  {scenario:<13} {result['elapsed']:.2f}秒, 最初のバイト {ttfb}, {throughput}, "
+                  f"CPU {result['cpu_seconds']:.2f}秒, 最大メモリ {result['peak_rss_mb']:.0f}MB, "
+                  f"抽出 {result['extractor_calls']}回")
+    finally:
+        server.shutdown()
+        # 失敗したシナリオのログは残す
+        if all(r['ok'] for r in results['scenarios'].values()):
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = []
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), tolerance)
+        results['regressions'] = regressions
+
+    if save_baseline:
+        with open(save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 ベースラインを保存しました: {save_baseline}")
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False))
+
+    if regressions:
+        print(f"\n❌ {len(regressions)}件の指標がベースラインより悪化しました")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+テストで共通の準備
+
+benchmarks/bench_suite.py のローカルの偽YouTubeサーバーとスタブの抽出器を使う。
+ネットワークには接続しない。
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+# キャッシュ（EJSソルバーなど）はユーザーのものを使わない
+os.environ.setdefault('YTDL_CACHE_DIR', tempfile.mkdtemp(prefix='ytdl-test-cache-'))
+
+import bench_suite  # noqa: E402
+import youtube_dl_v3  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def server():
+    server = bench_suite.MediaServer(size=64 * 1024, latency=0, segments=2)
+    server.start()
+    bench_suite.register_stub_extractor()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def stub_settings(server, monkeypatch):
+    # GitHubからEJSソルバーを取得せず、合成メディアはffmpegで扱えないため後処理もしない
+    monkeypatch.setitem(youtube_dl_v3.component_settings, 'offline', True)
+    monkeypatch.setattr(youtube_dl_v3, 'TARGET_EXT', None)
+    youtube_dl_v3.configure_progress('none')
+    youtube_dl_v3.extractor_calls.clear()
+    server.reset()
+
+
+@pytest.fixture
+def watch_url(server):
+    """偽のサーバーの動画ページのURLを返す関数"""
+    return lambda video_id: f'{server.base_url}/watch?v={video_id}'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """youtube_dl_v3 の time.time を進められる時計"""
+    now = [1_000_000.0]
+    monkeypatch.setattr(youtube_dl_v3.time, 'time', lambda: now[0])
+    return now
@@ -0,0 +1,45 @@
+"""
+ダウンロードアーカイブ（DownloadArchive）の確認
+
+ダウンロードした動画が記録され、記録済みの動画は抽出もダウンロードもせずにスキップすることを確かめる。
+"""
+
+import pytest
+
+import youtube_dl_v3
+from youtube_dl_v3 import DownloadArchive
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    archive = DownloadArchive(tmp_path / 'archive.sqlite3')
+    monkeypatch.setattr(youtube_dl_v3, 'download_archive', archive)
+    return archive
+
+
+def test_downloaded_videos_are_recorded_and_skipped(archive, server, watch_url, tmp_path):
+    urls = [watch_url('progressive-20'), watch_url('dash-21')]
+    summary = youtube_dl_v3.run_batch(urls, str(tmp_path / 'first'), workers=2)
+    assert summary['succeeded'] == 2 and not summary['skipped']
+    assert 'bench progressive-20' in archive and 'bench dash-21' in archive
+    assert len(archive) == 2
+
+    # 保存先が違っても（ファイルが無くても）、記録済みの動画は抽出せずにスキップする
+    youtube_dl_v3.extractor_calls.clear()
+    server.reset()
+    summary = youtube_dl_v3.run_batch(urls, str(tmp_path / 'second'), workers=2)
+    assert summary['skipped'] == 2
+    assert not youtube_dl_v3.extractor_calls
+    assert server.api_requests == 0
+    assert not (tmp_path / 'second').exists() or not any((tmp_path / 'second').iterdir())
+
+
+def test_imported_archive_skips_videos(archive, server, watch_url, tmp_path):
+    text_archive = tmp_path / 'archive.txt'
+    text_archive.write_text('bench hls-22\nbench hls-22\n\n', encoding='utf-8')
+    assert archive.import_file(text_archive) == 1
+
+    youtube_dl_v3.download_video(watch_url('hls-22'), str(tmp_path / 'out'))
+    assert not youtube_dl_v3.extractor_calls
+    assert server.api_requests == 0
+    assert archive.stats['hits'] == 1
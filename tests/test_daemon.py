@@ -0,0 +1,80 @@
+"""
+デーモンモードのAPI（make_daemon_handler）の確認
+
+127.0.0.1 で待ち受けたハンドラーが、トークン・Host / Origin・Content-Type で拒否するリクエストを確かめる。
+"""
+
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import youtube_dl_v3
+
+TOKEN = 'test-token'
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    """ジョブを実行しない（ワーカー 0）デーモンのAPIを起動し、ポートを返す"""
+    job_queue = youtube_dl_v3.JobQueue(str(tmp_path), workers=0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), youtube_dl_v3.make_daemon_handler(job_queue, TOKEN))
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def request(port, method, path, body=None, headers=None):
+    """(ステータス, JSONの本体) を返す"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read() or b'null')
+    finally:
+        conn.close()
+
+
+def auth(token=TOKEN):
+    return {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+
+
+def test_job_is_accepted_with_the_token(daemon, watch_url):
+    status, job = request(daemon, 'POST', '/jobs', {'url': watch_url('dash-0')}, auth())
+    assert status == 202
+    assert request(daemon, 'GET', f"/jobs/{job['id']}", headers=auth())[0] == 200
+
+
+@pytest.mark.parametrize('headers', [{}, auth('wrong-token'), {'Authorization': TOKEN}])
+def test_missing_or_wrong_token_is_rejected(daemon, headers):
+    assert request(daemon, 'POST', '/jobs', {'url': 'https://example.com/'}, headers)[0] == 401
+    assert request(daemon, 'GET', '/jobs', headers=headers)[0] == 401
+
+
+@pytest.mark.parametrize('headers', [
+    {'Host': 'evil.example'},
+    {'Host': 'evil.example:8780'},
+    {'Origin': 'https://evil.example'},
+    {'Origin': 'null'},
+])
+def test_foreign_host_or_origin_is_rejected(daemon, headers):
+    # DNSリバインディングや、ブラウザで開いた別のサイトからのリクエストは、トークンより先に拒否する
+    assert request(daemon, 'POST', '/jobs', {'url': 'https://example.com/'}, {**auth(), **headers})[0] == 403
+    assert request(daemon, 'GET', '/metrics', headers=headers)[0] == 403
+
+
+def test_local_origin_is_accepted(daemon, watch_url):
+    headers = {**auth(), 'Origin': f'http://localhost:{daemon}'}
+    assert request(daemon, 'POST', '/jobs', {'url': watch_url('dash-0')}, headers)[0] == 202
+
+
+@pytest.mark.parametrize('content_type', [None, 'text/plain', 'application/x-www-form-urlencoded'])
+def test_non_json_content_type_is_rejected(daemon, content_type):
+    headers = {'Authorization': f'Bearer {TOKEN}'}
+    if content_type:
+        headers['Content-Type'] = content_type
+    assert request(daemon, 'POST', '/jobs', {'url': 'https://example.com/'}, headers)[0] == 415
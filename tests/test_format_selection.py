@@ -0,0 +1,52 @@
+"""
+フォーマットの順位付け（rank_formats / select_formats / format_selector）の確認
+"""
+
+import youtube_dl_v3
+
+
+def video_format(format_id, height=None, tbr=None, **extra):
+    return {'format_id': format_id, 'ext': 'mp4', 'vcodec': 'avc1.64001F', 'acodec': 'mp4a.40.2',
+            'url': f'https://example.com/{format_id}.mp4', 'height': height, 'tbr': tbr, **extra}
+
+
+def test_resolution_is_ranked_numerically():
+    # 以前は解像度の文字列で並べていたため、'640x360' が '1920x1080' より上になっていた
+    formats = [video_format('360p', resolution='640x360'), video_format('1080p', resolution='1920x1080'),
+               video_format('720p', resolution='1280x720')]
+    rows = youtube_dl_v3.format_table(formats)
+
+    ranked = youtube_dl_v3.rank_formats(rows, 'best')
+    assert [row.format_id for row in ranked] == ['1080p', '720p', '360p']
+    assert [row.height for row in ranked] == [1080, 720, 360]
+
+
+def test_size_is_estimated_from_duration():
+    formats = [video_format('720p', 720, tbr=2000), video_format('480p', 480, tbr=300)]
+    rows = youtube_dl_v3.format_table(formats, duration=100)
+
+    assert [row.size for row in rows] == [2000 * 1000 // 8 * 100, 300 * 1000 // 8 * 100]
+    assert youtube_dl_v3.select_formats(formats, 'smallest:360', duration=100) == [formats[1]]
+
+
+def test_format_selector_uses_the_recorded_duration():
+    # yt-dlpが ctx に渡すのは形式のリストだけなので、pre_process で記録した動画の長さでサイズを見積もる
+    formats = [video_format('720p', 720, tbr=2000), video_format('360p', 360, tbr=500),
+               video_format('480p', 480, tbr=300), video_format('240p', 240, tbr=100)]
+    selector = youtube_dl_v3.format_selector('smallest:360')
+
+    youtube_dl_v3._FormatDurationRecorder().run({'duration': 100})
+    assert [f['format_id'] for f in selector({'formats': formats})] == ['480p']
+
+
+def test_duration_is_recorded_before_selection():
+    formats = [video_format('720p', 720, tbr=2000), video_format('480p', 480, tbr=300)]
+    info = {'id': 'x', 'title': 'x', 'duration': 123, 'extractor': 'generic', 'extractor_key': 'Generic',
+            'webpage_url': 'https://example.com/x', 'formats': formats}
+    ydl_opts = {'quiet': True, 'format': youtube_dl_v3.format_selector('smallest:360')}
+
+    with youtube_dl_v3.create_ydl(ydl_opts) as ydl:
+        result = ydl.process_ie_result(info, download=False)
+
+    assert youtube_dl_v3._job_state.format_duration == 123
+    assert result['format_id'] == '480p'
@@ -0,0 +1,56 @@
+"""
+ジャーナル（JobJournal）からの再開の確認
+
+中断した実行の続きでは、完了していないURLだけを実行し、完了済みのURLはスキップすることを確かめる。
+"""
+
+import json
+
+import pytest
+
+import youtube_dl_v3
+from youtube_dl_v3 import JOURNAL_STAGES, JobJournal
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    journal = JobJournal(tmp_path / 'journal.sqlite3')
+    monkeypatch.setattr(youtube_dl_v3, 'job_journal', journal)
+    return journal
+
+
+def interrupt(journal, url, stage):
+    """url のジョブが stage の途中で中断されたことにする（stage 以降の記録を消す）"""
+    journal.flush()
+    dropped = JOURNAL_STAGES[JOURNAL_STAGES.index(stage):]
+    with journal._connect() as conn:
+        jobs = [job for job, in conn.execute("SELECT DISTINCT job FROM events") if json.loads(job)[-1] == url]
+        assert jobs
+        conn.executemany("DELETE FROM events WHERE job = ? AND stage = ?",
+                         [(job, stage) for job in jobs for stage in dropped])
+
+
+def test_interrupted_jobs_resume_and_completed_jobs_are_skipped(journal, watch_url, tmp_path):
+    urls = [watch_url(f'{kind}-{i}') for i, kind in enumerate(('progressive', 'dash', 'hls', 'dash'), start=10)]
+    output_dir = str(tmp_path / 'out')
+    summary = youtube_dl_v3.run_batch(urls, output_dir, workers=2)
+    assert summary['succeeded'] == 4 and not summary['skipped']
+
+    # 抽出の後・ダウンロードの後・後処理の途中で中断したジョブ
+    interrupted = {urls[1]: 'downloaded', urls[2]: 'subtitles', urls[3]: 'postprocessed'}
+    for url, stage in interrupted.items():
+        interrupt(journal, url, stage)
+    youtube_dl_v3.extractor_calls.clear()
+
+    summary = youtube_dl_v3.run_batch(urls, output_dir, workers=2)
+    assert summary['succeeded'] == 4
+    assert summary['skipped'] == 1
+    # 完了済みのURLは抽出もしない
+    assert urls[0] not in youtube_dl_v3.extractor_calls
+    assert dict(youtube_dl_v3.extractor_calls) == dict.fromkeys(interrupted, 1)
+
+    # 再開したジョブも完了が記録され、3回目は全てスキップする
+    youtube_dl_v3.extractor_calls.clear()
+    summary = youtube_dl_v3.run_batch(urls, output_dir, workers=2)
+    assert summary['skipped'] == 4
+    assert not youtube_dl_v3.extractor_calls
@@ -0,0 +1,97 @@
+"""
+メタデータキャッシュ（MetadataCache）の確認
+
+キャッシュのキー、TTLとストリームURLの有効期限、LRUでの削除、キャッシュがあれば抽出しないことを確かめる。
+"""
+
+import youtube_dl_v3
+from youtube_dl_v3 import MetadataCache
+
+
+def video_info(video_id, url='https://example.com/media.mp4'):
+    return {'id': video_id, 'title': f'title {video_id}', 'formats': [{'format_id': '18', 'url': url}]}
+
+
+def test_cache_key_is_extractor_and_video_id(watch_url):
+    assert youtube_dl_v3.metadata_cache_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ') == 'Youtube:dQw4w9WgXcQ'
+    assert youtube_dl_v3.metadata_cache_key('https://youtu.be/dQw4w9WgXcQ') == 'Youtube:dQw4w9WgXcQ'
+    assert youtube_dl_v3.metadata_cache_key(watch_url('dash-0')) == 'Bench:dash-0'
+
+
+def test_video_id_tries_the_given_extractors_first(watch_url, monkeypatch):
+    url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    assert youtube_dl_v3.url_video_id(url, youtube_dl_v3.YOUTUBE_EXTRACTORS) == ('Youtube', 'dQw4w9WgXcQ')
+    # どれにも合わなければ全ての抽出器から探す
+    assert youtube_dl_v3.url_video_id(watch_url('dash-0'), youtube_dl_v3.YOUTUBE_EXTRACTORS) == ('Bench', 'dash-0')
+
+    def all_extractors():
+        raise AssertionError('全ての抽出器を探した')
+
+    monkeypatch.setattr(youtube_dl_v3.yt_dlp.extractor, 'gen_extractor_classes', all_extractors)
+    assert youtube_dl_v3.url_video_id(url) == ('Youtube', 'dQw4w9WgXcQ')
+
+
+def test_cache_key_falls_back_to_url():
+    url = 'https://example.invalid/no-extractor-knows-this'
+    assert youtube_dl_v3.metadata_cache_key(url) == f'url:{url}'
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    cache = MetadataCache(tmp_path / 'metadata.sqlite3', ttl=60)
+    cache.put('Bench:a', video_info('a'))
+    assert cache.get('Bench:a')['title'] == 'title a'
+
+    clock[0] += 61
+    assert cache.get('Bench:a') is None
+    assert cache.stats['expired'] == 1
+    # 期限切れのものは削除される
+    clock[0] -= 61
+    assert cache.get('Bench:a') is None
+
+
+def test_entries_expire_with_stream_urls(tmp_path, clock):
+    cache = MetadataCache(tmp_path / 'metadata.sqlite3', ttl=3600)
+    # ストリームURLの有効期限より STREAM_EXPIRY_MARGIN 秒前に使えなくなる
+    expire = int(clock[0]) + youtube_dl_v3.STREAM_EXPIRY_MARGIN + 100
+    cache.put('Bench:a', video_info('a', f'https://example.com/videoplayback?expire={expire}'))
+    clock[0] += 99
+    assert cache.get('Bench:a') is not None
+    clock[0] += 2
+    assert cache.get('Bench:a') is None
+
+    # 期限が迫っているURLは保存しない
+    cache.put('Bench:b', video_info('b', f'https://example.com/videoplayback?expire={int(clock[0]) + 10}'))
+    assert cache.get('Bench:b') is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = MetadataCache(tmp_path / 'metadata.sqlite3')
+    for key in ('Bench:a', 'Bench:b'):
+        clock[0] += 1
+        cache.put(key, video_info(key))
+    clock[0] += 1
+    assert cache.get('Bench:a') is not None
+
+    # 2件分の上限で3件目を追加すると、最近使われていない b が削除される
+    with cache._connect() as conn:
+        cache.max_bytes = conn.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+    clock[0] += 1
+    cache.put('Bench:c', video_info('Bench:c'))
+
+    assert cache.get('Bench:b') is None
+    assert cache.get('Bench:a') is not None
+    assert cache.get('Bench:c') is not None
+    assert cache.stats['evictions'] == 1
+
+
+def test_cache_hit_skips_extraction(server, watch_url, tmp_path, monkeypatch):
+    monkeypatch.setattr(youtube_dl_v3, 'metadata_cache', MetadataCache(tmp_path / 'metadata.sqlite3'))
+    url = watch_url('progressive-10')
+
+    youtube_dl_v3.download_video(url, str(tmp_path / 'first'))
+    youtube_dl_v3.download_video(url, str(tmp_path / 'second'))
+
+    assert youtube_dl_v3.extractor_calls[url] == 1
+    assert server.api_requests == 1
+    assert youtube_dl_v3.metadata_cache.stats['hits'] == 1
+    assert any((tmp_path / 'second').iterdir())
@@ -0,0 +1,105 @@
+"""
+ダウンロードのやり直し（classify_error / retry_delay / CircuitBreaker）の確認
+
+失敗の分類、待ち時間の範囲、サーキットブレーカーの open → half-open → closed の遷移を確かめる。
+"""
+
+import io
+import threading
+import time
+
+import pytest
+
+import youtube_dl_v3
+from youtube_dl_v3 import CircuitBreaker, classify_error, retry_delay
+
+MEDIA_URL = 'https://rr1---sn-example.googlevideo.com/videoplayback?expire=2000000000'
+
+
+def http_error(status, headers=None):
+    response = youtube_dl_v3.yt_dlp.networking.Response(io.BytesIO(b''), MEDIA_URL, headers or {}, status=status)
+    return youtube_dl_v3.yt_dlp.networking.exceptions.HTTPError(response)
+
+
+def download_error(message, cause=None):
+    exc_info = (type(cause), cause, None) if cause is not None else None
+    return youtube_dl_v3.yt_dlp.utils.DownloadError(message, exc_info)
+
+
+@pytest.mark.parametrize('error, expected', [
+    (http_error(429), ('throttled', None)),
+    (http_error(429, {'Retry-After': '120'}), ('throttled', 120)),
+    (http_error(503, {'Retry-After': '30'}), ('throttled', 30)),
+    (http_error(503), ('transient', None)),
+    (http_error(403), ('expired', None)),
+    (http_error(410), ('expired', None)),
+    (http_error(404), ('fatal', None)),
+    (youtube_dl_v3.yt_dlp.networking.exceptions.TransportError('connection reset'), ('transient', None)),
+    (ConnectionResetError(), ('transient', None)),
+    (ValueError('unexpected'), ('fatal', None)),
+])
+def test_classify_error(error, expected):
+    assert classify_error(error, [MEDIA_URL]) == expected
+
+
+def test_classify_error_uses_the_wrapped_exception():
+    assert classify_error(download_error('ERROR: unable to download', http_error(429))) == ('throttled', None)
+    # yt-dlpが元の例外を残さない DownloadError は、メッセージのHTTPステータスだけを見る
+    assert classify_error(download_error('ERROR: fragment 3: HTTP Error 429: Too Many Requests')) == ('throttled', None)
+    assert classify_error(download_error('ERROR: video unavailable: the page expired')) == ('fatal', None)
+
+
+def test_classify_error_detects_expired_urls(clock):
+    url = f'https://example.com/videoplayback?expire={int(clock[0]) - 1}'
+    assert classify_error(ValueError('unexpected'), [url]) == ('expired', None)
+
+
+@pytest.mark.parametrize('kind', ['throttled', 'transient'])
+def test_retry_delay_doubles_up_to_the_cap(kind):
+    base, cap = youtube_dl_v3.RETRY_BACKOFF[kind]
+    for attempt in range(12):
+        ceiling = min(cap, base * 2 ** attempt)
+        for _ in range(20):
+            assert ceiling / 2 <= retry_delay(kind, attempt) <= ceiling
+
+
+def test_retry_delay_honours_retry_after():
+    assert retry_delay('throttled', 0, retry_after=120) >= 120
+    # Retry-After も上限までしか待たない
+    assert retry_delay('throttled', 0, retry_after=10_000) == youtube_dl_v3.RETRY_BACKOFF['throttled'][1]
+
+
+def test_circuit_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker(threshold=2, open_seconds=0.2, max_open_seconds=1)
+    urls = [MEDIA_URL]
+
+    # closed: threshold 回続けて失敗するまでは止めない
+    assert breaker.report(urls, True) == []
+    assert breaker.wait(urls) == 0
+    (host, duration), = breaker.report(urls, True)
+    assert duration == 0.2
+
+    # open: 時間が過ぎるまで待たせる
+    assert breaker.wait(urls) >= 0.15
+
+    # half-open: 試しのダウンロードの結果が出るまで、ほかのジョブは待つ
+    waited = []
+    other = threading.Thread(target=lambda: waited.append(breaker.wait(urls)))
+    other.start()
+    time.sleep(0.1)
+    assert other.is_alive()
+    # 試しが失敗すれば、止める時間を倍にする
+    assert breaker.report(urls, True) == [(host, 0.4)]
+    other.join(timeout=5)
+    assert waited[0] >= 0.3
+
+    # 試しが成功すれば closed に戻る
+    breaker.report(urls, False)
+    assert breaker.wait(urls) == 0
+    assert breaker.report(urls, True) == []
+
+
+def test_circuit_breaker_ignores_failures_unrelated_to_the_host():
+    breaker = CircuitBreaker(threshold=1, open_seconds=60)
+    assert breaker.report([MEDIA_URL], None) == []
+    assert breaker.wait([MEDIA_URL]) == 0
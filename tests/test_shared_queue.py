@@ -0,0 +1,122 @@
+"""
+共有のジョブキュー（SharedJobQueue）の確認
+
+リースの期限切れと延長、リースを失った後の記録、同じ動画のジョブの重複の除き方を確かめる。
+"""
+
+import threading
+
+import pytest
+
+import youtube_dl_v3
+from youtube_dl_v3 import SharedJobQueue
+
+VIDEO_URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+SHORT_URL = 'https://youtu.be/dQw4w9WgXcQ'
+VIDEO_ID = 'youtube dQw4w9WgXcQ'
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    return SharedJobQueue(tmp_path / 'queue.sqlite3', lease_seconds=60, max_attempts=3)
+
+
+def test_expired_lease_is_leased_again(queue, clock):
+    queue.enqueue([VIDEO_URL])
+    first = queue.lease('worker-a')
+    assert first['video_id'] == VIDEO_ID
+    assert queue.lease('worker-b') is None
+
+    clock[0] += 61
+    assert queue.counts()['expired'] == 1
+    second = queue.lease('worker-b')
+    assert second['id'] == first['id']
+    assert second['attempts'] == 2
+    assert second['token'] != first['token']
+
+
+def test_renew_extends_only_a_live_lease(queue, clock):
+    queue.enqueue([VIDEO_URL])
+    job = queue.lease('worker-a')
+
+    clock[0] += 50
+    assert queue.renew(job)
+    clock[0] += 50
+    assert queue.lease('worker-b') is None
+
+    clock[0] += 61
+    assert not queue.renew(job)
+
+
+def test_stale_token_does_not_record(queue, clock):
+    queue.enqueue([VIDEO_URL])
+    stale = queue.lease('worker-a')
+    clock[0] += 61
+    current = queue.lease('worker-b')
+
+    assert queue.complete(stale, result={'owner': 'worker-a'}) == 'lost'
+    assert queue.fail(stale, 'error') == 'lost'
+    assert queue.counts()['leased'] == 1
+    assert queue.complete(current) == 'done'
+    assert queue.counts()['done'] == 1
+
+
+def test_completed_video_is_not_leased_again(queue):
+    assert queue.enqueue([VIDEO_URL, SHORT_URL]) == 2
+    job = queue.lease('worker-a')
+    # 同じ動画の別のURLは、実行中のジョブがある間は借りられない
+    assert queue.lease('worker-b') is None
+
+    assert queue.complete(job) == 'done'
+    assert queue.lease('worker-b') is None
+    assert queue.counts()['done'] == 2
+
+
+def test_claim_deduplicates_jobs_without_video_id(queue, clock):
+    queue.enqueue(['https://example.com/a', 'https://example.com/b', 'https://example.com/c'])
+    a, b, c = (queue.lease('worker') for _ in range(3))
+    assert a['video_id'] is None
+
+    # 同じ動画を実行中のジョブがあれば待ちに戻し、完了済みなら完了にする
+    assert queue.claim(a, VIDEO_ID) == 'ok'
+    assert a['video_id'] == VIDEO_ID
+    assert queue.claim(b, VIDEO_ID) == 'busy'
+    assert queue.complete(a) == 'done'
+    assert queue.claim(c, VIDEO_ID) == 'duplicate'
+    assert queue.counts() == {'queued': 1, 'leased': 0, 'done': 2, 'failed': 0, 'expired': 0}
+
+    # 待ちに戻したジョブは実行回数に数えず、次に借りるときに完了済みとわかる
+    clock[0] += youtube_dl_v3.QUEUE_POLL_INTERVAL
+    assert queue.lease('worker') is None
+    assert queue.counts()['done'] == 3
+
+
+def test_claim_after_losing_the_lease(queue, clock):
+    queue.enqueue(['https://example.com/a'])
+    job = queue.lease('worker-a')
+    clock[0] += 61
+    assert queue.claim(job, VIDEO_ID) == 'lost'
+
+
+def test_cancelled_job_stops_downloading(monkeypatch):
+    job = {'cancel': threading.Event()}
+    monkeypatch.setattr(youtube_dl_v3._job_state, 'job', job, raising=False)
+    youtube_dl_v3.cancel_hook({'status': 'downloading'})
+
+    job['cancel'].set()
+    with pytest.raises(youtube_dl_v3.JobCancelled):
+        youtube_dl_v3.cancel_hook({'status': 'downloading'})
+
+
+def test_worker_deduplicates_jobs_queued_without_video_id(tmp_path, watch_url, monkeypatch):
+    queue = SharedJobQueue(tmp_path / 'queue.sqlite3')
+    # URLから動画IDが分からなかったジョブとして追加する
+    monkeypatch.setattr(youtube_dl_v3, 'archive_id_for_url', lambda url: None)
+    urls = [watch_url('dash-30'), watch_url('dash-30') + '&t=1', watch_url('hls-31')]
+    assert queue.enqueue(urls) == 3
+
+    summary = youtube_dl_v3.run_worker(queue, str(tmp_path / 'out'), workers=1, exit_when_empty=True)
+    assert (summary['done'], summary['duplicate']) == (2, 1)
+    assert queue.counts()['done'] == 3
+    # 同じ動画は1回だけダウンロードする
+    assert len(list((tmp_path / 'out').glob('*dash-30*'))) == 1
@@ -0,0 +1,35 @@
+"""
+1本の動画につき抽出（extract_info）が1回だけであることの確認
+
+download_video / download_video_with_format / run_batch の後の extractor_calls を確かめる。
+"""
+
+import pytest
+
+import youtube_dl_v3
+
+
+@pytest.mark.parametrize('kind', ['progressive', 'dash', 'hls'])
+def test_download_video_extracts_once(server, watch_url, tmp_path, kind):
+    url = watch_url(f'{kind}-0')
+    youtube_dl_v3.download_video(url, str(tmp_path))
+
+    assert youtube_dl_v3.extractor_calls[url] == 1
+    assert server.api_requests == 1
+    assert any(tmp_path.iterdir())
+
+
+def test_download_video_with_format_extracts_once(server, watch_url, tmp_path):
+    url = watch_url('dash-1')
+    youtube_dl_v3.download_video_with_format(url, str(tmp_path), 'dash-360')
+
+    assert youtube_dl_v3.extractor_calls[url] == 1
+    assert server.api_requests == 1
+
+
+def test_run_batch_extracts_once_per_url(watch_url, tmp_path):
+    urls = [watch_url(f'{kind}-{i}') for i, kind in enumerate(('progressive', 'dash', 'hls'), start=2)]
+    summary = youtube_dl_v3.run_batch(urls, str(tmp_path), workers=2)
+
+    assert not summary['failed']
+    assert dict(youtube_dl_v3.extractor_calls) == {url: 1 for url in urls}
@@ -6,219 +6,5384 @@ YouTube動画ダウンロードスクリプト
 
 import sys
 import os
+import contextlib
+import functools
+import atexit
+import glob
+import hashlib
+import hmac
+import importlib
+import json
+import queue
+import random
+import re
+import secrets
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait as wait_futures
 from pathlib import Path
-import yt_dlp
 from datetime import datetime
 
 
-def download_subtitles(url, output_dir, info):
+class _LazyModule:
+    """最初に属性を参照したときに import するモジュール"""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        # 以降はモジュールを直接参照する
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+
+# yt-dlp の import には数百msかかるため、使用方法の表示・引数のチェックが終わって
+# 実際に使うときまで import しない
+# （http.server・プロセスプールも、起動時に不要な import を避けて使う関数の中で import する）
+yt_dlp = _LazyModule('yt_dlp')
+
+
+# 後処理の変換先コンテナと、そのままストリームコピーできるコーデック
+TARGET_EXT = 'mp4'
+MP4_VIDEO_CODECS = {'avc1', 'avc3', 'h264', 'hev1', 'hvc1', 'h265', 'av01'}
+MP4_AUDIO_CODECS = {'mp4a', 'aac', 'mp3', 'ac-3', 'ec-3'}
+
+# コーデックの圧縮効率の目安（avc1 / mp4a を1.0として、同じビットレートでの画質・音質の比）
+CODEC_EFFICIENCY = {
+    'av01': 1.5, 'hev1': 1.4, 'hvc1': 1.4, 'h265': 1.4, 'vp09': 1.3, 'vp9': 1.3,
+    'avc1': 1.0, 'avc3': 1.0, 'h264': 1.0, 'vp8': 0.9,
+    'opus': 1.3, 'vorbis': 1.1, 'mp4a': 1.0, 'aac': 1.0, 'ec-3': 0.9, 'ac-3': 0.8, 'mp3': 0.8,
+}
+
+# フォーマット選択のポリシーのデフォルト
+DEFAULT_FORMAT_POLICY = 'best'
+# smallest ポリシーのデフォルトの最低の高さ
+SMALLEST_MIN_HEIGHT = 720
+
+# 1ホストあたりの同時接続数の上限（デフォルト）
+MAX_CONNECTIONS_PER_HOST = 8
+
+# 取得する字幕の言語と、字幕の取得に使うスレッド数・同じホストへのリクエストの間隔[秒]・429時のリトライ回数
+SUBTITLE_LANGS = ['ja', 'en']
+SUBTITLE_WORKERS = 4
+SUBTITLE_HOST_INTERVAL = 0.5
+SUBTITLE_RETRIES = 3
+
+# 先頭から順に読むだけで多重化できる（パイプから読める）コンテナ
+# mp4 / m4a は断片化されたもの（container が '*_dash'）だけがパイプから読める
+STREAMABLE_EXTS = ('webm', 'mkv', 'mka', 'ts')
+
+# 同時に実行するダウンロードと後処理（ffmpegはCPU負荷が高い）の数（デフォルト）
+MAX_DOWNLOADS = 4
+MAX_POSTPROCESS = max(1, (os.cpu_count() or 2) // 2)
+# ダウンロード後もこれだけの空き容量が残る場合のみジョブを開始する
+DISK_FREE_MARGIN = 512 * 1024 * 1024
+
+# 動画情報だけを扱う（エクスポートの）yt-dlp のリトライ回数。
+# ダウンロードではyt-dlp自身はやり直さず、失敗の種類ごとに run_pipeline がやり直す（classify_error を参照）
+YTDL_RETRIES = 3
+# throttled / transient の失敗でダウンロードをやり直す回数（デフォルト）
+RETRY_ATTEMPTS = 5
+# 失敗の種類ごとの待ち時間の基準と上限[秒]（やり直すたびに倍にし、ばらつきを加える）
+RETRY_BACKOFF = {'throttled': (5.0, 300.0), 'transient': (1.0, 60.0)}
+# expired（署名/URLの期限切れ）の失敗で再抽出する回数
+RETRY_REEXTRACTS = 2
+# ホストへのダウンロードがこの回数続けて失敗したら、そのホストへのダウンロードを止める秒数（止めるたびに倍、上限あり）
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_SECONDS = 30
+CIRCUIT_MAX_OPEN_SECONDS = 600
+
+# ダウンロードの設定項目とデフォルト値（CLIの各オプションに対応）
+DEFAULT_DOWNLOAD_OPTIONS = {
+    # マージ/変換前の動画・音声ファイルを残すか
+    'keep_intermediates': False,
+    # DASH/HLSのフラグメントを同時にダウンロードする数
+    'concurrent_fragments': 1,
+    # 動画と音声のストリームを同時にダウンロードするか
+    'parallel_streams': False,
+    # プレイリストのエントリを1本ずつ解決しながらダウンロードするか
+    'lazy_playlists': True,
+    # フォーマットを選ぶポリシー（Noneならyt-dlpのフォーマット指定を使う。FORMAT_POLICIES を参照）
+    'format_policy': None,
+    # 取得する字幕の言語（優先順）
+    'subtitle_langs': SUBTITLE_LANGS,
+    # 使う抽出器（yt-dlpの allowed_extractors。Noneなら全ての抽出器。extractors_for_urls を参照）
+    'extractors': None,
+    # 何を保存するか（PROFILES を参照）
+    'profile': 'video',
+    # throttled / transient の失敗でダウンロードをやり直す回数
+    'retries': RETRY_ATTEMPTS,
+    # 動画と音声のストリームを中間ファイルに書かずにffmpegに渡し、1回でマージするか（streaming_merge_ext を参照）
+    'streaming_merge': False,
+    # サムネイルを取得して埋め込むか（動画のプロファイルのみ。start_thumbnail_downloads を参照）
+    'thumbnail': True,
+}
+
+# ダウンロードのプロファイル（名前: 説明）
+PROFILES = {
+    'video': '動画+音声（mp4に変換）',
+    'audio': '音声のみ（m4a/opusをそのまま保存し、変換しない）',
+    'subtitles': '字幕のみ（メディアはダウンロードしない）',
+    'metadata': '動画情報のJSONのみ（メディアはダウンロードしない）',
+}
+# メディアをダウンロードしないプロファイル
+NO_MEDIA_PROFILES = ('subtitles', 'metadata')
+# 音声のみのプロファイルのフォーマット（再エンコードが要らない m4a / opus を優先し、動画のストリームは取得しない）
+AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio[acodec=opus]/bestaudio/best'
+
+# 動画情報のエクスポート（--export）の列と型（固定のスキーマ。値が無い列は null）
+# error は常に最後の列として書き出す（抽出に失敗したURLとその原因）
+EXPORT_COLUMNS = {
+    'id': 'string', 'title': 'string', 'uploader': 'string', 'channel': 'string', 'channel_id': 'string',
+    'duration': 'double', 'view_count': 'int64', 'like_count': 'int64', 'comment_count': 'int64',
+    'upload_date': 'string', 'live_status': 'string', 'availability': 'string', 'description': 'string',
+    'webpage_url': 'string', 'extractor_key': 'string', 'playlist_id': 'string', 'error': 'string',
+}
+# プレイリスト・チャンネルのエントリ（動画ページを抽出していない平坦な結果）から取れる列
+# 書き出す列がこれだけなら、エントリの動画ごとの抽出を行わない
+EXPORT_FLAT_COLUMNS = ('id', 'title', 'uploader', 'channel', 'channel_id', 'duration', 'view_count',
+                       'live_status', 'webpage_url', 'extractor_key', 'playlist_id')
+# --export-fields を指定しない場合の列（download_video が表示する項目）
+EXPORT_DEFAULT_COLUMNS = ('id', 'title', 'uploader', 'duration', 'view_count', 'webpage_url')
+EXPORT_FORMATS = ('ndjson', 'parquet', 'arrow')
+# parquet / arrow で1回に書き込む行数（メモリに保持するのはこの行数まで）と、進行状況を表示する間隔の行数
+EXPORT_BATCH_ROWS = 1000
+EXPORT_PROGRESS_ROWS = 1000
+# エクスポートでは形式を使わないため、YouTubeのプレーヤーのJS（署名/nチャレンジの解決）と
+# DASH/HLSのマニフェストは取得しない
+EXPORT_EXTRACTOR_ARGS = {'youtube': {'player_skip': ['js'], 'skip': ['dash', 'hls', 'translated_subs']}}
+
+# YouTubeのURLだけを扱う場合に使う抽出器
+# （全抽出器の登録には YoutubeDL の作成ごとに100ms前後かかる）
+YOUTUBE_EXTRACTORS = [r'youtube.*']
+YOUTUBE_HOSTS = {'youtube.com', 'youtu.be', 'youtube-nocookie.com'}
+
+# デーモンモードのAPIのポート、保持する終了済みジョブの数、ワーカーごとに保持する YoutubeDL の数
+DAEMON_PORT = 8780
+DAEMON_JOB_HISTORY = 1000
+DAEMON_WARM_INSTANCES = 8
+# ポートで待ち受ける場合、/jobs へのリクエストに必要なトークンを書き込むファイル（起動ごとに作り直す、0600）
+DAEMON_TOKEN_FILE = 'daemon-token'
+# APIへのリクエストで受け付ける Host / Origin のホスト名（DNSリバインディングとブラウザからの投入を防ぐ）
+DAEMON_LOCAL_HOSTS = {'127.0.0.1', 'localhost', '::1'}
+
+# 複数のマシンで共有するジョブのキュー（--queue、SharedJobQueue を参照）
+# ジョブを借りている間（リース）は QUEUE_RENEW_INTERVAL 秒ごとに QUEUE_LEASE_SECONDS 秒先まで延長する。
+# 延長されないまま期限が切れたジョブ（止まったワーカーのもの）は、別のワーカーが借りて実行する
+QUEUE_LEASE_SECONDS = 300
+QUEUE_RENEW_INTERVAL = 60
+# ジョブを実行する回数の上限（リースの期限切れを含む）、失敗したジョブをやり直すまでの待ち時間（回数に比例）、
+# 実行できるジョブが無いときに確認する間隔[秒]
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_RETRY_DELAY = 60
+QUEUE_POLL_INTERVAL = 5.0
+# ジョブの結果をキューに記録できない（ロックされているなど）場合にやり直す回数（QUEUE_POLL_INTERVAL 秒ごと）。
+# それでも記録できなければ、リースの期限切れで別のワーカーがやり直す
+QUEUE_RECORD_RETRIES = 5
+
+# プレイリストとして扱う info dict の _type
+PLAYLIST_TYPES = ('playlist', 'multi_video')
+
+# メトリクスのヒストグラムのバケット（所要時間[秒] と ダウンロード速度[バイト/秒]）
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))
+
+# 公開するメトリクス（名前: (種類, 説明, ヒストグラムのバケット)）
+METRIC_DEFINITIONS = {
+    'ytdl_jobs_total': ('counter', 'URLごとのジョブの数（result: ok / error / skipped）', None),
+    'ytdl_download_bytes_total': ('counter', 'ダウンロードしたバイト数（kind: media / subtitle）', None),
+    'ytdl_retries_total': ('counter', 'ダウンロードのリトライ回数（kind: download, '
+                                      'reason: classify_error の分類）', None),
+    'ytdl_retry_backoff_seconds_total': ('counter', 'リトライ前に待った秒数（reason: throttled / transient）', None),
+    'ytdl_reextracts_total': ('counter', '失効したURLのための再抽出の回数（reason: expired / cache）', None),
+    'ytdl_circuit_breaker_trips_total': ('counter', 'サーキットブレーカーがホストへのダウンロードを止めた回数', None),
+    'ytdl_disk_written_bytes_total': ('counter', 'メディアのファイル（中間ファイル・後処理の出力を含む）に書き込んだバイト数',
+                                      None),
+    'ytdl_extractor_failures_total': ('counter', '抽出の失敗数（exception: 原因の例外クラス）', None),
+    'ytdl_export_rows_total': ('counter', 'エクスポートした行数（source: flat / extracted / failed）', None),
+    'ytdl_queue_jobs_total': ('counter', '共有のキューから借りたジョブの結果（result: done / duplicate / busy / retry / failed / lost）',
+                              None),
+    'ytdl_queue_lease_lost_total': ('counter', '延長できずに別のワーカーに移ったリースの数', None),
+    'ytdl_store_lookups_total': ('counter', 'ストアの検索数（result: hit / miss）', None),
+    'ytdl_store_saved_bytes_total': ('counter', 'ストアから置いたため、ダウンロードせずに済んだバイト数', None),
+    'ytdl_stage_duration_seconds': ('histogram', '段階ごとの所要時間（stage: extract / download など）',
+                                    DURATION_BUCKETS),
+    'ytdl_first_byte_seconds': ('histogram', 'ジョブの開始から最初のバイトを受信するまでの時間', DURATION_BUCKETS),
+    'ytdl_stream_throughput_bytes_per_second': ('histogram', 'ストリームごとのダウンロード速度',
+                                                THROUGHPUT_BUCKETS),
+    'ytdl_downloads_active': ('gauge', '実行中のダウンロードの数', None),
+    'ytdl_downloads_waiting': ('gauge', 'ダウンロードの枠（または空き容量）を待っているジョブの数', None),
+    'ytdl_postprocess_active': ('gauge', '実行中の後処理の数', None),
+    'ytdl_postprocess_queued': ('gauge', '後処理のキューで待っているジョブの数', None),
+    'ytdl_queue_pending': ('gauge', '開始を待っているURLの数（バッチ）', None),
+}
+
+# 実行中のジョブの状態（スレッドごと）
+# job には後処理時間などジョブ単位の記録が入り、ジョブ内で起動したスレッドとも共有する
+_job_state = threading.local()
+
+# 起動から最初のバイトを受信するまでの時間を測るための基準時刻
+PROCESS_STARTED = time.monotonic()
+
+# キャッシュなどを保存するディレクトリ
+CACHE_DIR = Path(os.environ.get('YTDL_CACHE_DIR') or Path.home() / '.cache' / 'youtube-dl-v3')
+
+# メタデータキャッシュのデフォルト設定
+METADATA_CACHE_TTL = 3600
+METADATA_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# ストリームURLの有効期限がこれより近いエントリは使わない（秒）
+STREAM_EXPIRY_MARGIN = 300
+
+# 取得・変換したサムネイルのキャッシュ（動画ごとに1つ。再ダウンロードでは取得も変換もしない）
+THUMBNAIL_CACHE_DIR = CACHE_DIR / 'thumbnails'
+# サムネイルを埋め込めるコンテナと、そのまま埋め込める画像の形式（それ以外はjpgに変換する）
+THUMBNAIL_EMBED_EXTS = ('mp4', 'm4a', 'mov', 'mkv')
+THUMBNAIL_IMAGE_EXTS = ('jpg', 'png')
+
+# 内容アドレスのストア（--store で有効化）の合計サイズの上限
+STORE_MAX_BYTES = 50 * 1024 * 1024 * 1024
+# どの動画からも参照されていないストアのファイルは、これより古ければ gc で削除する（秒）
+# （追加の途中で参照がまだ記録されていないファイルは消さない）
+STORE_ORPHAN_GRACE = 3600
+# Linux の ioctl(FICLONE)（reflink）
+FICLONE = 0x40049409
+
+# ジョブの進み具合を記録するジャーナル（再実行時に完了した段階を飛ばす）
+# 段階: 抽出 → ダウンロード（マージを含む）→ 字幕 → 後処理（サムネイルの埋め込みを含む）
+JOURNAL_STAGES = ('extracted', 'downloaded', 'subtitles', 'postprocessed')
+# この件数か秒数を超えたら、ためた記録をまとめて書き込む（fsyncは1回）
+JOURNAL_FLUSH_EVENTS = 32
+JOURNAL_FLUSH_INTERVAL = 2.0
+# これより古い記録は起動時に削除する
+JOURNAL_RETENTION = 30 * 24 * 3600
+
+# EJS(署名/nチャレンジのソルバー)スクリプトのキャッシュ
+# yt-dlpのキャッシュディレクトリとして全ての YoutubeDL で共有する
+COMPONENT_CACHE_DIR = CACHE_DIR / 'yt-dlp'
+COMPONENT_CHECK_INTERVAL = 24 * 3600
+EJS_RELEASE_URL = 'https://github.com/yt-dlp/ejs/releases/download/{version}/{filename}'
+EJS_SCRIPTS = {'core': 'yt.solver.core.min.js', 'lib': 'yt.solver.lib.min.js'}
+
+# コンポーネントの取得設定（main で --offline-components などから設定する）
+component_settings = {'offline': False, 'check_interval': COMPONENT_CHECK_INTERVAL}
+
+# プロセス内で共有するJSランタイムとその設定（create_ydl で設定）
+_shared_js_runtimes = None
+_shared_js_runtimes_config = None
+_shared_js_runtimes_lock = threading.Lock()
+
+# URLごとの抽出(extract_info)呼び出し回数
+# 1本の動画につき抽出は1回だけであることをテストで確認できるように記録する
+extractor_calls = Counter()
+
+# 抽出結果のキャッシュ（configure_metadata_cache で有効化）
+metadata_cache = None
+
+# ジョブのジャーナル（configure_journal で有効化）
+job_journal = None
+
+# ダウンロード済みの動画のアーカイブ（configure_archive で有効化）
+download_archive = None
+
+# 段階ごとの所要時間の書き出し先（configure_trace で有効化）
+trace_writer = None
+
+# ダウンロードしたメディアの内容アドレスのストア（configure_store で有効化）
+content_store = None
+
+# 複数のマシンで共有するジョブのキュー（configure_queue で有効化）
+shared_queue = None
+
+
+def solver_version():
+    """このyt-dlpが必要とするEJSソルバースクリプトのバージョン"""
+    try:
+        from yt_dlp.extractor.youtube.jsc._builtin.vendor import VERSION
+    except ImportError:
+        return None
+    return VERSION
+
+
+def cached_solver_version():
+    """キャッシュ済みのEJSソルバースクリプトのバージョン（揃っていなければNone）"""
+    versions = set()
+    for name in EJS_SCRIPTS:
+        try:
+            with open(COMPONENT_CACHE_DIR / 'challenge-solver' / f'{name}.json', encoding='utf-8') as f:
+                entry = json.load(f)
+            # yt-dlpのキャッシュは {'yt-dlp_version': ..., 'data': 保存した値} の形で書かれる
+            versions.add(entry.get('data', entry).get('version'))
+        except (OSError, ValueError, AttributeError):
+            return None
+    return versions.pop() if len(versions) == 1 else None
+
+
+def _component_check_due():
+    """前回の更新確認から check_interval 以上経っているか"""
+    try:
+        with open(COMPONENT_CACHE_DIR / 'components.json', encoding='utf-8') as f:
+            checked = json.load(f).get('checked', 0)
+    except (OSError, ValueError):
+        return True
+    return time.time() - checked >= component_settings['check_interval']
+
+
+def _record_component_check():
+    """更新確認の時刻を記録する"""
+    COMPONENT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = COMPONENT_CACHE_DIR / 'components.json'
+    tmp = stamp.with_name(f'{stamp.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'checked': time.time(), 'version': cached_solver_version()}, f)
+    os.replace(tmp, stamp)
+
+
+def component_opts():
+    """
+    EJSコンポーネント関連のyt-dlpオプション
+
+    キャッシュに必要なバージョンのソルバースクリプトがあれば、
+    check_interval ごとの確認時以外はGitHubからの取得を許可しない。
+    確認の時刻は、取得を許可した YoutubeDL がソルバースクリプトを実際に確かめた時点で記録する（watch_component_cache）。
+    オフラインモードでは常にキャッシュ（または yt-dlp 同梱のもの）だけを使う。
+    """
+    opts = {
+        'cachedir': str(COMPONENT_CACHE_DIR),
+        'remote_components': [],
+    }
+    if component_settings['offline']:
+        return opts
+
+    version = solver_version()
+    if version is not None and cached_solver_version() == version and not _component_check_due():
+        return opts
+
+    # YouTubeの署名/nチャレンジを解くためのEJSスクリプトを取得
+    # （これが無いと一部フォーマットのURLが無効になり HTTP 403 で停止する）
+    opts['remote_components'] = ['ejs:github']
+    return opts
+
+
+def watch_component_cache(ydl):
+    """
+    YoutubeDL のキャッシュを見張り、必要なバージョンのソルバースクリプトを読み込んだか
+    GitHubから取得して保存した時点で、更新確認の時刻を記録する
+
+    取得しなかった・失敗した実行は記録しないため、次の実行でまた確認する
+    """
+    load, store = ydl.cache.load, ydl.cache.store
+
+    def confirm(section, key, data):
+        if (section == 'challenge-solver' and key in EJS_SCRIPTS and isinstance(data, dict)
+                and data.get('version') == solver_version() and cached_solver_version() == solver_version()):
+            with contextlib.suppress(OSError):
+                _record_component_check()
+
+    def watched_load(section, key, *args, **kwargs):
+        data = load(section, key, *args, **kwargs)
+        confirm(section, key, data)
+        return data
+
+    def watched_store(section, key, data, *args, **kwargs):
+        result = store(section, key, data, *args, **kwargs)
+        confirm(section, key, data)
+        return result
+
+    ydl.cache.load, ydl.cache.store = watched_load, watched_store
+
+
+def seed_components():
+    """
+    EJSソルバースクリプトをGitHubから取得してキャッシュに保存する
+
+    オフラインで使う環境には、事前にこれでキャッシュを用意しておく
+
+    Returns:
+        保存したバージョン
+    """
+    version = solver_version()
+    if version is None:
+        raise RuntimeError("このyt-dlpはEJSソルバーに対応していません")
+
+    with create_ydl({'quiet': True, **component_opts()}) as ydl:
+        for name, filename in EJS_SCRIPTS.items():
+            url = EJS_RELEASE_URL.format(version=version, filename=filename)
+            code = ydl.urlopen(url).read().decode('utf-8')
+            ydl.cache.store('challenge-solver', name, {
+                'version': version,
+                'variant': 'minified',
+                'code': code,
+            })
+    _record_component_check()
+    return version
+
+
+def create_ydl(ydl_opts):
+    """
+    YoutubeDL を作成する
+
+    JSランタイムの検出（バージョン確認のためのプロセス起動）はプロセス内で1回だけ行い、
+    以降に作成する YoutubeDL でも同じランタイムを使い回す
+    """
+    global _shared_js_runtimes, _shared_js_runtimes_config
+    _instrument_yt_dlp()
+    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    if 'ejs:github' in (ydl.params.get('remote_components') or ()):
+        watch_component_cache(ydl)
+    if callable(ydl.params.get('format')):
+        ydl.add_post_processor(_FormatDurationRecorder(), when='pre_process')
+    with _shared_js_runtimes_lock:
+        if _shared_js_runtimes is None:
+            _shared_js_runtimes = ydl._js_runtimes
+            _shared_js_runtimes_config = ydl.params.get('js_runtimes')
+        elif ydl.params.get('js_runtimes') == _shared_js_runtimes_config:
+            # _js_runtimes は functools.cached_property なので、インスタンスに設定すれば共有できる
+            ydl.__dict__['_js_runtimes'] = _shared_js_runtimes
+    return ydl
+
+
+def extract_info(ydl, url, lazy_playlist=False):
+    """
+    動画情報を抽出する（ダウンロードはしない）
+
+    抽出結果のinfo dictはメディアのダウンロードと字幕の取得で使い回すため、
+    ここが1本の動画に対する唯一の抽出処理になる。
+    メタデータキャッシュが有効なら、有効期限内のキャッシュを優先して使う。
+
+    lazy_playlist が有効でURLがプレイリストの場合は、エントリを解決せずに返す
+    （エントリは run_playlist で1本ずつ抽出する）
+    """
+    _job_state.cache_hit = None
+    if metadata_cache is not None:
+        key = metadata_cache_key(url)
+        info = metadata_cache.get(key)
+        _job_state.cache_hit = info is not None
+        if info is not None:
+            return info
+
+    extractor_calls[url] += 1
+    try:
+        if lazy_playlist:
+            # まずエントリを解決せずに抽出し、プレイリストならそのまま返す
+            info = ydl.extract_info(url, download=False, process=False)
+            while info is not None and info.get('_type') == 'url':
+                info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+            if info is not None and info.get('_type') in PLAYLIST_TYPES:
+                return info
+            if info is not None:
+                info = ydl.process_ie_result(info, download=False)
+        else:
+            info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        metrics.inc('ytdl_extractor_failures_total', exception=exception_class(e))
+        raise
+    # アーカイブに記録済みの場合、yt-dlpは抽出せずにNoneを返す
+    if info is None:
+        return None
+
+    if metadata_cache is not None:
+        metadata_cache.put(key, info)
+    return info
+
+
+def is_youtube_url(url):
+    """YouTubeのURLか（ホスト名だけで判定する）"""
+    host = (urllib.parse.urlsplit(url.strip()).hostname or '').lower()
+    return any(host == name or host.endswith('.' + name) for name in YOUTUBE_HOSTS)
+
+
+def extractors_for_urls(urls):
+    """URLが全てYouTubeなら YOUTUBE_EXTRACTORS、それ以外は None（全ての抽出器を使う）"""
+    urls = list(urls)
+    if urls and all(is_youtube_url(url) for url in urls):
+        return YOUTUBE_EXTRACTORS
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _extractor_classes(patterns):
+    """
+    allowed_extractors と同じ正規表現（の tuple）に合う抽出器のクラス
+
+    URLに合う抽出器は最初に合ったものを使うため、yt-dlp の順序のまま返す
+    """
+    all_ies = {ie.IE_NAME.lower(): ie for ie in yt_dlp.extractor.gen_extractor_classes()}
+    names = set(yt_dlp.utils.orderedSet_from_options(
+        patterns, {'all': list(all_ies), 'default': [name for name, ie in all_ies.items() if ie._ENABLED]},
+        use_regex=True))
+    return [ie for name, ie in all_ies.items() if name in names]
+
+
+def url_video_id(url, extractors=None):
+    """
+    URLから抽出せずに分かる (抽出器のキー, 動画ID) を返す
+
+    抽出器は extractors（allowed_extractors と同じ形式。Noneなら extractors_for_urls）から先に試し、
+    どれにも合わない場合だけ全ての抽出器から探す
+
+    分からない場合は (None, None)
+    """
+    extractors = extractors or extractors_for_urls([url])
+    candidates = _extractor_classes(tuple(extractors)) if extractors else []
+    ie = next((ie for ie in candidates if ie.suitable(url)), None)
+    if ie is None:
+        ie = next((ie for ie in yt_dlp.extractor.gen_extractor_classes() if ie.suitable(url)), None)
+    video_id = ie.get_temp_id(url) if ie is not None else None
+    if video_id:
+        return ie.ie_key(), video_id
+    return None, None
+
+
+def metadata_cache_key(url):
+    """
+    URLからキャッシュのキー（抽出器 + 動画ID）を求める
+
+    IDが分からないURLはURLそのものをキーにする
+    """
+    ie_key, video_id = url_video_id(url)
+    if video_id:
+        return f"{ie_key}:{video_id}"
+    return f"url:{url}"
+
+
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+
+def url_expiry(url):
+    """ストリームURLの有効期限（UNIX時刻、含まれていなければNone）"""
+    mobj = _EXPIRE_RE.search(url or '')
+    return int(mobj.group(1)) if mobj else None
+
+
+def stream_expiry(info):
+    """
+    info dictに含まれるストリームURLのうち、最も早い有効期限(UNIX時刻)を返す
+
+    YouTubeのストリームURLは 'expire=<時刻>' または '/expire/<時刻>/' を含む
+    """
+    expiries = []
+    for entry in info.get('entries') or []:
+        if entry:
+            expiry = stream_expiry(entry)
+            if expiry:
+                expiries.append(expiry)
+    for fmt in [info, *(info.get('formats') or [])]:
+        for key in ('url', 'manifest_url', 'fragment_base_url'):
+            expiry = url_expiry(fmt.get(key))
+            if expiry:
+                expiries.append(expiry)
+    return min(expiries, default=None)
+
+
+class MetadataCache:
+    """
+    抽出結果(info dict)をSQLiteに保存するキャッシュ
+
+    - キーは 抽出器 + 動画ID
+    - TTLを過ぎたもの、ストリームURLの有効期限が切れたものは使わない
+    - 合計サイズが上限を超えたら、最近使われていないものから削除する（LRU）
+    """
+
+    def __init__(self, path=None, ttl=METADATA_CACHE_TTL, max_bytes=METADATA_CACHE_MAX_BYTES):
+        self.path = Path(path or CACHE_DIR / 'metadata.sqlite3')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    expires REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    @property
+    def config(self):
+        """ワーカープロセスで同じキャッシュを開くための設定"""
+        return {'path': str(self.path), 'ttl': self.ttl, 'max_bytes': self.max_bytes}
+
+    def _connect(self):
+        """スレッド/プロセスごとの接続を返す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        """キャッシュを取得する（無い/期限切れならNone）"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT data, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._count('misses')
+                return None
+            if row[1] <= now:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._count('expired')
+                self._count('misses')
+                return None
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        self._count('hits')
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, info):
+        """抽出結果を保存する"""
+        now = time.time()
+        expires = now + self.ttl
+        expiry = stream_expiry(info)
+        if expiry is not None:
+            expires = min(expires, expiry - STREAM_EXPIRY_MARGIN)
+        if expires <= now:
+            return
+
+        data = zlib.compress(json.dumps(
+            yt_dlp.YoutubeDL.sanitize_info(info), separators=(',', ':')).encode('utf-8'))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, data, size, created, accessed, expires) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (key, data, len(data), now, now, expires))
+            self._evict(conn)
+
+    def invalidate(self, key):
+        """キャッシュを削除する"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _evict(self, conn):
+        """合計サイズが上限を超えた分を、最近使われていないものから削除する"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self._count('evictions', len(evicted))
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+
+def configure_metadata_cache(path=None, ttl=METADATA_CACHE_TTL, max_bytes=METADATA_CACHE_MAX_BYTES):
+    """メタデータキャッシュを有効にする"""
+    global metadata_cache
+    metadata_cache = MetadataCache(path, ttl, max_bytes)
+    return metadata_cache
+
+
+class JobJournal:
+    """
+    URLごとに、完了した段階（JOURNAL_STAGES）を記録するジャーナル
+
+    - SQLiteのテーブルに追記するだけで、更新はしない
+    - 記録はメモリにためて、件数か時間が閾値を超えたら1回のトランザクションでまとめて書く
+      （fsyncはまとめた分で1回。クラッシュで直前の記録が失われても、その段階をやり直すだけで済む）
+    """
+
+    def __init__(self, path=None, flush_events=JOURNAL_FLUSH_EVENTS, flush_interval=JOURNAL_FLUSH_INTERVAL):
+        self.path = Path(path or CACHE_DIR / 'journal.sqlite3')
+        self.flush_events = flush_events
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    data TEXT,
+                    recorded REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_job ON events (job)")
+            conn.execute("DELETE FROM events WHERE recorded < ?", (time.time() - JOURNAL_RETENTION,))
+
+    @property
+    def config(self):
+        """ワーカープロセスで同じジャーナルを開くための設定"""
+        return {'path': str(self.path), 'flush_events': self.flush_events,
+                'flush_interval': self.flush_interval}
+
+    def _connect(self):
+        """スレッド/プロセスごとの接続を返す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # コミットごとにfsyncする（コミットの回数は flush でまとめて減らす）
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def job_key(output_dir, url, format_spec=None):
+        """ジョブのキー（保存先・フォーマット指定・URLが同じなら同じジョブ）"""
+        return json.dumps([str(Path(output_dir).resolve()), format_spec or '', url], ensure_ascii=False)
+
+    def stages(self, job):
+        """完了した段階と、その時に記録したデータのdictを返す"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT stage, data FROM events WHERE job = ? ORDER BY id", (job,)).fetchall()
+        with self._lock:
+            rows += [(stage, data) for key, stage, data, _ in self._pending if key == job]
+        return {stage: json.loads(data) if data else None for stage, data in rows}
+
+    def record(self, job, stage, data=None):
+        """段階の完了を記録する（書き込みは flush でまとめて行う）"""
+        event = (job, stage, None if data is None else json.dumps(data, ensure_ascii=False), time.time())
+        with self._lock:
+            self._pending.append(event)
+            due = (len(self._pending) >= self.flush_events
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def forget(self, job):
+        """ジョブの記録を全て削除する（最初からやり直す）"""
+        with self._lock:
+            self._pending = [event for event in self._pending if event[0] != job]
+        with self._connect() as conn:
+            conn.execute("DELETE FROM events WHERE job = ?", (job,))
+
+    def flush(self):
+        """ためている記録を書き込む"""
+        with self._lock:
+            events, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+        if not events:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO events (job, stage, data, recorded) VALUES (?, ?, ?, ?)", events)
+
+
+def configure_journal(path=None, flush_events=JOURNAL_FLUSH_EVENTS, flush_interval=JOURNAL_FLUSH_INTERVAL):
+    """ジョブのジャーナルを有効にする（終了時にためている記録を書き込む）"""
+    global job_journal
+    job_journal = JobJournal(path, flush_events, flush_interval)
+    atexit.register(job_journal.flush)
+    return job_journal
+
+
+def journal_downloads(result):
+    """ジャーナルに記録する、ダウンロードしたファイルの一覧"""
+    downloads = []
+    for video, download in iter_downloads(result):
+        target = {**video, **download}
+        downloads.append({key: target.get(key) for key in ('id', 'filepath', 'ext', 'vcodec', 'acodec')})
+    return downloads
+
+
+def restore_downloads(info, downloads):
+    """
+    ジャーナルに記録したファイルが全て残っていれば、それを
+    process_ie_result の結果と同じ形（requested_downloads 付きのinfo dict）にして返す
+
+    1つでも無ければNone（ダウンロードからやり直す）
+    """
+    if not downloads or not all(d['filepath'] and os.path.exists(d['filepath']) for d in downloads):
+        return None
+    by_id = {}
+    for download in downloads:
+        by_id.setdefault(download['id'], []).append(
+            {key: value for key, value in download.items() if key != 'id'})
+
+    def attach(entry):
+        if entry.get('entries'):
+            return {**entry, 'entries': [attach(e) for e in entry['entries'] if e]}
+        return {**entry, 'requested_downloads': by_id.get(entry.get('id'), [])}
+
+    return attach(info)
+
+
+class DownloadArchive:
+    """
+    ダウンロード済みの動画（抽出器 + 動画ID）を記録するアーカイブ
+
+    - yt-dlpの download_archive にそのまま渡せる集合（`in` と add）として振る舞う
+    - yt-dlpはプレイリストの各エントリを解決（抽出）する前にアーカイブを確認するため、
+      記録済みの動画は抽出されない
+    - SQLiteの主キーで引くため、数十万件でも1件の確認は索引を1回たどるだけで済む
+    - 複数のスレッド/プロセスから同時に追加しても INSERT OR IGNORE で重複しない
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path or CACHE_DIR / 'archive.sqlite3')
+        self.stats = Counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive (
+                    id TEXT PRIMARY KEY,
+                    recorded REAL NOT NULL
+                ) WITHOUT ROWID""")
+
+    @property
+    def config(self):
+        """ワーカープロセスで同じアーカイブを開くための設定"""
+        return {'path': str(self.path)}
+
+    def _connect(self):
+        """スレッド/プロセスごとの接続を返す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def __contains__(self, archive_id):
+        row = self._connect().execute("SELECT 1 FROM archive WHERE id = ?", (archive_id,)).fetchone()
+        self._count('hits' if row else 'misses')
+        return row is not None
+
+    def __bool__(self):
+        # yt-dlpは空のアーカイブを確認しないため、件数を数えずに常に真とする
+        return True
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM archive").fetchone()[0]
+
+    def add(self, archive_id):
+        """動画を記録する"""
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO archive (id, recorded) VALUES (?, ?)", (archive_id, time.time()))
+        self._count('added')
+
+    def import_file(self, path):
+        """yt-dlpのテキスト形式のアーカイブ（1行に "抽出器 ID"）を取り込み、追加した件数を返す"""
+        with open(path, encoding='utf-8') as f:
+            ids = [(line.strip(), time.time()) for line in f if line.strip()]
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO archive (id, recorded) VALUES (?, ?)", ids)
+            return conn.total_changes - before
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+
+def configure_archive(path=None):
+    """ダウンロード済みの動画のアーカイブを有効にする"""
+    global download_archive
+    download_archive = DownloadArchive(path)
+    return download_archive
+
+
+def archive_id_for_url(url):
+    """URLから抽出せずに分かるアーカイブのID（分からなければNone）"""
+    ie_key, video_id = url_video_id(url)
+    if video_id is None:
+        return None
+    return yt_dlp.utils.make_archive_id(ie_key, video_id)
+
+
+def file_hash(path):
+    """ファイルの内容の SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(src, dst):
+    """reflink（ブロックを共有する複製）で src を dst に作る（対応していなければ OSError）"""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflink はこのOSでは使えません")
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+
+def place_file(src, dst):
+    """
+    src を dst に置く（dst があれば置き換える）
+
+    ハードリンク → reflink → コピー の順に試し、使った方法（'hardlink' / 'reflink' / 'copy'）を返す
+    """
+    dst = Path(dst)
+    tmp = dst.with_name(f'.{dst.name}.{uuid.uuid4().hex[:8]}.tmp')
+    try:
+        try:
+            os.link(src, tmp)
+            method = 'hardlink'
+        except OSError:
+            try:
+                _reflink(src, tmp)
+                method = 'reflink'
+            except OSError:
+                shutil.copyfile(src, tmp)
+                method = 'copy'
+        os.replace(tmp, dst)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+    return method
+
+
+class ContentStore:
+    """
+    ダウンロード（後処理まで）したメディアを、内容のハッシュで保存するストア
+
+    - 動画のキーは 抽出器 + 動画ID + フォーマットID + 変換先コンテナ
+    - ファイルは objects/<SHA-256の先頭2文字>/<SHA-256>.<拡張子> に1つだけ置き、
+      保存先ディレクトリには place_file でリンクする
+    - 別の保存先で同じ動画を要求された場合は、ダウンロードも後処理もせずにリンクするだけで済む
+    - 別のキーで同じ内容のファイル（同じ動画の再アップロードなど）が追加された場合も、ディスク上は1つにまとめる
+    - 合計サイズが上限を超えたら、最近使われていないものからストアから外す
+      （保存先のリンクは残るため、ディスクが空くのは他にリンクが無いファイルだけ）
+    """
+
+    def __init__(self, path=None, max_bytes=STORE_MAX_BYTES):
+        self.path = Path(path or CACHE_DIR / 'store')
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        (self.path / 'objects').mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    key TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    ext TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS items_hash ON items (hash)")
+            conn.execute("CREATE INDEX IF NOT EXISTS items_accessed ON items (accessed)")
+
+    @property
+    def config(self):
+        """ワーカープロセスで同じストアを開くための設定"""
+        return {'path': str(self.path), 'max_bytes': self.max_bytes}
+
+    def _connect(self):
+        """スレッド/プロセスごとの接続を返す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path / 'store.sqlite3', timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def key(info, target_ext=None):
+        """動画のキー（プレイリストや、抽出器・動画ID・フォーマットIDが分からない場合はNone）"""
+        if info.get('_type', 'video') != 'video' or info.get('entries'):
+            return None
+        parts = [info.get('extractor_key'), info.get('id'), info.get('format_id')]
+        if not all(parts):
+            return None
+        return ' '.join([*parts, target_ext or '-'])
+
+    def object_path(self, digest, ext):
+        """内容のハッシュに対応するファイルのパス"""
+        return self.path / 'objects' / digest[:2] / f'{digest}.{ext}'
+
+    def get(self, key):
+        """保存済みなら (ファイルのパス, 拡張子) を返す（無い、またはファイルが消えていればNone）"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT hash, ext, size FROM items WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                path = self.object_path(row[0], row[1])
+                try:
+                    intact = path.stat().st_size == row[2]
+                except FileNotFoundError:
+                    intact = False
+                if not intact:
+                    conn.execute("DELETE FROM items WHERE hash = ?", (row[0],))
+                    row = None
+            if row is None:
+                self._count('misses')
+                return None
+            conn.execute("UPDATE items SET accessed = ? WHERE hash = ?", (time.time(), row[0]))
+        self._count('hits')
+        return path, row[1]
+
+    def link(self, path, filepath):
+        """ストアのファイル path を filepath に置く（既に同じファイルなら何もしない）"""
+        if os.path.exists(filepath) and os.path.samefile(path, filepath):
+            return
+        self._count(place_file(path, filepath))
+
+    def add(self, key, filepath):
+        """
+        ダウンロードしたファイルをストアに追加し、内容のハッシュを返す
+
+        同じ内容のファイルが既にあれば、filepath をそれへのリンクに置き換える
+        """
+        filepath = Path(filepath)
+        digest = file_hash(filepath)
+        ext = filepath.suffix.lstrip('.') or 'bin'
+        path = self.object_path(digest, ext)
+        path.parent.mkdir(exist_ok=True)
+        if not path.exists():
+            self._count(place_file(filepath, path))
+        elif not os.path.samefile(path, filepath):
+            place_file(path, filepath)
+            self._count('deduplicated')
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO items (key, hash, ext, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, digest, ext, path.stat().st_size, now, now))
+            self._evict(conn)
+        self._count('added')
+        return digest
+
+    def _remove(self, conn, digest, ext):
+        """ファイルをストアから外し、ディスクが空いたバイト数を返す（他にリンクがあれば0）"""
+        conn.execute("DELETE FROM items WHERE hash = ?", (digest,))
+        path = self.object_path(digest, ext)
+        try:
+            st = path.stat()
+            path.unlink()
+        except FileNotFoundError:
+            return 0
+        return st.st_size if st.st_nlink == 1 else 0
+
+    def _evict(self, conn, max_bytes=None):
+        """合計サイズが上限を超えた分を、最近使われていないものから外す。(外した数, 空いたバイト数) を返す"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        objects = conn.execute(
+            "SELECT hash, ext, MAX(size), MAX(accessed) AS last FROM items GROUP BY hash ORDER BY last").fetchall()
+        total = sum(size for _, _, size, _ in objects)
+        removed = freed = 0
+        for digest, ext, size, _ in objects:
+            if total <= max_bytes:
+                break
+            freed += self._remove(conn, digest, ext)
+            total -= size
+            removed += 1
+        self._count('evictions', removed)
+        return removed, freed
+
+    def gc(self, max_bytes=None):
+        """
+        ストアを整理する
+
+        - ファイルが消えた記録と、どの動画からも参照されていないファイルを削除する
+        - 合計サイズを max_bytes（Noneなら設定の上限）以下にする
+
+        Returns:
+            {'removed': 外した数, 'freed': 空いたバイト数, 'objects': 残りの数, 'bytes': 残りの合計サイズ}
+        """
+        removed = freed = 0
+        with self._connect() as conn:
+            referenced = set()
+            for digest, ext in conn.execute("SELECT DISTINCT hash, ext FROM items").fetchall():
+                if self.object_path(digest, ext).exists():
+                    referenced.add(self.object_path(digest, ext).name)
+                else:
+                    conn.execute("DELETE FROM items WHERE hash = ?", (digest,))
+                    removed += 1
+            for path in (self.path / 'objects').glob('*/*'):
+                if path.name in referenced:
+                    continue
+                st = path.stat()
+                if time.time() - st.st_ctime < STORE_ORPHAN_GRACE:
+                    continue
+                path.unlink()
+                removed += 1
+                freed += st.st_size if st.st_nlink == 1 else 0
+            evicted, evicted_freed = self._evict(conn, max_bytes)
+            objects, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM "
+                "(SELECT MAX(size) AS size FROM items GROUP BY hash)").fetchone()
+        return {'removed': removed + evicted, 'freed': freed + evicted_freed, 'objects': objects, 'bytes': total}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+
+def configure_store(path=None, max_bytes=STORE_MAX_BYTES):
+    """ダウンロードしたメディアの内容アドレスのストアを有効にする"""
+    global content_store
+    content_store = ContentStore(path, max_bytes)
+    return content_store
+
+
+def link_from_store(ydl, info, key):
+    """
+    ストアに保存済みなら保存先にリンクして、process_ie_result の結果と同じ形
+    （requested_downloads 付きのinfo dict）にして返す（無ければNone）
+    """
+    stored = content_store.get(key)
+    metrics.inc('ytdl_store_lookups_total', result='miss' if stored is None else 'hit')
+    if stored is None:
+        return None
+    path, ext = stored
+    filepath = ydl.prepare_filename({**info, 'ext': ext})
+    Path(filepath).parent.mkdir(parents=True, exist_ok=True)
+    content_store.link(path, filepath)
+    metrics.inc('ytdl_store_saved_bytes_total', os.path.getsize(filepath))
+    # ダウンロードしないため、yt-dlpの代わりにアーカイブへ記録する
+    ydl.record_download_archive(info)
+    return {**info, 'ext': ext, 'filepath': filepath, 'requested_downloads': [{'filepath': filepath, 'ext': ext}]}
+
+
+def add_to_store(result, target_ext):
+    """ダウンロードして後処理まで終えたファイル（1つの場合のみ）をストアに追加する"""
+    downloads = list(iter_downloads(result))
+    key = ContentStore.key(result, target_ext)
+    if key is None or len(downloads) != 1:
+        return
+    filepath = downloads[0][1].get('filepath')
+    if not filepath or not os.path.exists(filepath):
+        return
+    try:
+        with stage_timer('store_add'):
+            content_store.add(key, filepath)
+    except (OSError, sqlite3.Error) as e:
+        progress_reporter.log(f"⚠️ ストアに追加できません: {e}")
+
+
+class TraceWriter:
+    """
+    URLごとの段階別の所要時間とバイト数を JSON Lines で追記する
+
+    chrome_path を指定すると、終了時にこの実行で追記した記録を
+    Chromeのトレース形式（chrome://tracing や Perfetto で開ける）でも書き出す。
+    バッチのワーカープロセスも同じファイルに1行ずつ追記するため、全プロセス分がまとまる。
+    """
+
+    def __init__(self, path, chrome_path=None):
+        self.path = Path(path)
+        self.chrome_path = chrome_path
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # この実行で追記した記録だけをChromeのトレース形式にする
+        self._offset = self.path.stat().st_size if self.path.exists() else 0
+
+    @property
+    def config(self):
+        """ワーカープロセスで同じファイルに追記するための設定（トレース形式はメインプロセスで書く）"""
+        return {'path': str(self.path)}
+
+    def write(self, record):
+        """1件の記録を1行で追記する"""
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    def close(self):
+        """Chromeのトレース形式で書き出す"""
+        if not self.chrome_path or not self.path.exists():
+            return
+        with open(self.path, encoding='utf-8') as f:
+            f.seek(self._offset)
+            records = [json.loads(line) for line in f if line.strip()]
+        with open(self.chrome_path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': chrome_trace_events(records), 'displayTimeUnit': 'ms'}, f,
+                      ensure_ascii=False)
+
+
+def configure_trace(path, chrome_path=None):
+    """段階ごとの所要時間の記録を有効にする（終了時にトレース形式でも書き出す）"""
+    global trace_writer
+    trace_writer = TraceWriter(path, chrome_path)
+    atexit.register(trace_writer.close)
+    return trace_writer
+
+
+def trace_record(url, info, job, error=None):
+    """
+    ジョブの記録を、TraceWriter に書き出す1件の記録にする
+
+    段階の開始はジョブの開始からの秒数。totals は段階の種類（'stream:137' なら 'stream'）ごとの合計
+    """
+    stages = sorted(job['stages'], key=lambda stage: stage['started'])
+    totals = Counter()
+    for stage in stages:
+        totals[stage['name'].split(':')[0]] += stage['finished'] - stage['started']
+    return {
+        'url': url,
+        'id': info.get('id') if info else None,
+        'title': info.get('title') if info else None,
+        'pid': os.getpid(),
+        'thread': job['thread'],
+        'started': job['started_at'],
+        'elapsed': time.monotonic() - job['started'],
+        'ok': error is None,
+        'error': error,
+        'playlist': bool(info and info.get('_type') in PLAYLIST_TYPES),
+        'skipped': job.get('skipped', False),
+        'bytes': sum(stage.get('bytes') or 0 for stage in stages
+                     if stage['name'] == 'download' or stage['name'].startswith('subtitle:')),
+        'first_byte': job['first_byte_at'] - job['started'] if job['first_byte_at'] else None,
+        'retries': dict(job['retries']),
+        'backoff': job['backoff'],
+        'reextracts': job['reextracts'],
+        'disk_written': job['disk']['written'],
+        'disk_peak': job['disk']['peak'],
+        'stages': [{'name': stage['name'], 'start': stage['started'] - job['started'],
+                    'duration': stage['finished'] - stage['started'],
+                    **{k: v for k, v in stage.items() if k not in ('name', 'started', 'finished')}}
+                   for stage in stages],
+        'totals': dict(totals),
+    }
+
+
+def chrome_trace_events(records):
+    """TraceWriter の記録を、Chromeのトレース形式のイベント（'X' = 所要時間付き）に変換する"""
+    events = []
+    for record in records:
+        base = record['started'] * 1e6
+        events.append({
+            'name': record.get('title') or record['url'], 'cat': 'job', 'ph': 'X',
+            'ts': base, 'dur': record['elapsed'] * 1e6, 'pid': record['pid'], 'tid': record['thread'],
+            'args': {'url': record['url'], 'ok': record['ok'], 'bytes': record['bytes']},
+        })
+        for stage in record['stages']:
+            events.append({
+                'name': stage['name'], 'cat': 'stage', 'ph': 'X',
+                'ts': base + stage['start'] * 1e6, 'dur': stage['duration'] * 1e6,
+                'pid': record['pid'], 'tid': stage['thread'],
+                'args': {k: v for k, v in stage.items() if k not in ('name', 'start', 'duration', 'thread')},
+            })
+    return events
+
+
+class Metrics:
+    """
+    METRIC_DEFINITIONS のメトリクスを集計し、Prometheus のテキスト形式で返す
+
+    カウンターとヒストグラムはラベルの組み合わせごとに値を持つ。
+    ゲージは値か、表示のたびに呼ぶ関数を設定する。
+    バッチのワーカープロセスの集計は collect(reset=True) で取り出し、メインプロセスで merge する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (名前, ラベル) → カウンターの値、またはヒストグラムの [バケットごとの数..., 合計, 件数]
+        self._values = {}
+        self._gauges = {}
+        self.server = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """カウンターを増やす"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ヒストグラムに値を1件追加する"""
+        buckets = METRIC_DEFINITIONS[name][2]
+        key = self._key(name, labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def set_gauge(self, name, value):
+        """ゲージの値（または値を返す関数）を設定する"""
+        self._gauges[name] = value
+
+    def observe_job(self, record):
+        """ジョブの記録（trace_record）から、バイト数・段階ごとの所要時間・速度を集計する"""
+        if not record['playlist']:
+            result = 'skipped' if record['skipped'] else 'ok' if record['ok'] else 'error'
+            self.inc('ytdl_jobs_total', result=result)
+        if record['first_byte'] is not None:
+            self.observe('ytdl_first_byte_seconds', record['first_byte'])
+        if record['disk_written']:
+            self.inc('ytdl_disk_written_bytes_total', record['disk_written'])
+        for stage in record['stages']:
+            kind = stage['name'].split(':')[0]
+            self.observe('ytdl_stage_duration_seconds', stage['duration'], stage=kind)
+            if stage.get('bytes') and kind in ('download', 'subtitle'):
+                self.inc('ytdl_download_bytes_total', stage['bytes'],
+                         kind='media' if kind == 'download' else 'subtitle')
+            if stage.get('bytes') and kind == 'stream' and stage['duration'] > 0:
+                self.observe('ytdl_stream_throughput_bytes_per_second', stage['bytes'] / stage['duration'])
+
+    def collect(self, reset=False):
+        """カウンターとヒストグラムの値を取り出す（reset なら取り出した分を消す）"""
+        with self._lock:
+            values = {key: list(value) if isinstance(value, list) else value
+                      for key, value in self._values.items()}
+            if reset:
+                self._values.clear()
+        return values
+
+    def merge(self, values):
+        """collect で取り出した値を足し込む"""
+        with self._lock:
+            for key, value in values.items():
+                current = self._values.get(key)
+                if current is None:
+                    self._values[key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    self._values[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    self._values[key] = current + value
+
+    def render(self):
+        """Prometheus のテキスト形式"""
+        values = self.collect()
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        def label_str(labels):
+            if not labels:
+                return ''
+            # 値の \ と " と改行はエスケープする
+            escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+            return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+        lines = []
+        for name, (kind, help_text, buckets) in METRIC_DEFINITIONS.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            if kind == 'gauge':
+                value = self._gauges.get(name, 0)
+                lines.append(f'{name} {value() if callable(value) else value}')
+                continue
+            for labels, value in sorted(by_name.get(name, [])):
+                if kind == 'counter':
+                    lines.append(f'{name}{label_str(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{label_str(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_bucket{label_str(labels + (("le", "+Inf"),))} {value[-1]}')
+                lines.append(f'{name}_sum{label_str(labels)} {value[-2]}')
+                lines.append(f'{name}_count{label_str(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """/metrics で render の結果を返すHTTPサーバーをバックグラウンドで起動する"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        return self.server
+
+
+# メトリクス（常に集計し、configure_metrics でHTTPで公開する）
+# スケジューラは configure_scheduler で作り直されるため、ゲージは表示のたびに参照する
+metrics = Metrics()
+metrics.set_gauge('ytdl_downloads_active', lambda: download_scheduler.active)
+metrics.set_gauge('ytdl_downloads_waiting', lambda: download_scheduler.waiting)
+metrics.set_gauge('ytdl_postprocess_active', lambda: download_scheduler.postprocess_active)
+metrics.set_gauge('ytdl_postprocess_queued', lambda: download_scheduler.postprocess_queued)
+
+
+def configure_metrics(port, host='127.0.0.1'):
+    """メトリクスを http://host:port/metrics で公開する"""
+    return metrics.serve(port, host)
+
+
+def exception_class(e):
+    """yt-dlpが DownloadError で包んだ例外は、元の例外のクラス名を返す"""
+    cause = getattr(e, 'exc_info', None)
+    if cause and cause[1] is not None:
+        return type(cause[1]).__name__
+    return type(e).__name__
+
+
+def print_video_info(info):
+    """抽出した動画情報を表示"""
+    if 'entries' in info:
+        # プレイリストの場合
+        print(f"📋 プレイリスト: {info.get('title', 'Unknown')}")
+        print(f"📊 動画数: {len(info['entries'])}本")
+    else:
+        # 単一動画の場合
+        print(f"📹 タイトル: {info.get('title', 'Unknown')}")
+        print(f"👤 チャンネル: {info.get('uploader', 'Unknown')}")
+        print(f"⏱️ 長さ: {format_duration(info.get('duration', 0))}")
+        view_count = info.get('view_count')
+        print(f"👁️ 再生回数: {f'{view_count:,}' if view_count is not None else 'Unknown'}")
+
+
+def run_pipeline(ydl, url, output_dir, verbose=True, target_ext=None, options=None):
+    """
+    抽出 → メディアのダウンロード → 字幕取得 → 後処理 を1回の抽出で実行する
+
+    extract_info で得たinfo dictをそのまま process_ie_result に渡して
+    ダウンロードし、同じinfo dictから字幕も取得する。
+    抽出（署名/nチャレンジの解決を含む）は1本につき1回だけ行われる。
+
+    Args:
+        ydl: 使用する YoutubeDL インスタンス（バッチではワーカーごとに使い回す）
+        url: 動画のURL
+        output_dir: ダウンロード先ディレクトリ
+        verbose: 動画情報や字幕の進行状況を表示するか
+        target_ext: 後処理の変換先コンテナ（Noneなら後処理しない）
+        options: ダウンロードの設定（DEFAULT_DOWNLOAD_OPTIONS を参照）
+
+    ダウンロードの失敗は種類ごとにやり直す（期限切れのURLは再抽出、429・5xx などは間隔をあけてやり直す。
+    classify_error を参照）。リトライの回数と待ち時間はジョブの記録（trace_record）に残る
+
+    ジャーナルが有効なら段階ごとに記録し、前回の実行で完了した段階は飛ばす
+    （ダウンロード途中の .part ファイルは yt-dlp が続きから再開する）
+
+    Returns:
+        結果のdict（info: 動画情報, bytes: ダウンロードしたバイト数,
+        postprocess: 後処理ごとの所要時間[秒], cache: メタデータキャッシュの結果,
+        extract_time: 抽出の所要時間[秒], first_byte: 開始から最初のバイトまで[秒],
+        files: 保存したファイルのパス, skipped: 前回の実行で完了済みだったか,
+        store: ストアの結果（'hit' ならダウンロードせずにストアのファイルをリンクした）,
+        retries: リトライの回数, backoff: リトライ前に待った秒数,
+        disk_written: メディアのファイルに書き込んだバイト数, disk_peak: ディスク使用量のピーク[バイト]）
+
+    字幕のみ・動画情報のみのプロファイルでは、抽出した後はメディアをダウンロードせずに
+    save_without_media で保存する（ジャーナルとアーカイブは使わない）。
+    動画以外のプロファイルでは target_ext に関わらず変換しない。
+    """
+    options = {**DEFAULT_DOWNLOAD_OPTIONS, **(options or {})}
+    no_media = options['profile'] in NO_MEDIA_PROFILES
+    if options['profile'] != 'video':
+        target_ext = None
+
+    # 前回の実行で完了した段階
+    journal_key = None
+    done = {}
+    if job_journal is not None and not no_media:
+        format_spec = ydl.params.get('format')
+        journal_key = job_journal.job_key(output_dir, url, getattr(format_spec, 'spec', format_spec))
+        done = job_journal.stages(journal_key)
+        # 完了済みでも、記録したファイルが消えていれば記録を捨てて最初からやり直す
+        downloads = done.get('postprocessed') or done.get('downloaded')
+        if all(stage in done for stage in JOURNAL_STAGES) and restore_downloads({}, downloads) is None:
+            job_journal.forget(journal_key)
+            done = {}
+    skipped = {
+        'info': done.get('extracted') or {},
+        'bytes': 0,
+        'postprocess': {},
+        'cache': None,
+        'extract_time': 0,
+        'first_byte': None,
+        'first_byte_at': None,
+        'files': [],
+        'skipped': True,
+        'store': None,
+        'retries': 0,
+        'backoff': 0.0,
+        'disk_written': 0,
+        'disk_peak': 0,
+    }
+    if all(stage in done for stage in JOURNAL_STAGES):
+        if verbose:
+            print(f"⏭️ 前回の実行で完了済みのためスキップします: {url}")
+        metrics.inc('ytdl_jobs_total', result='skipped')
+        return skipped
+    # 途中まで進んだジョブは続きを実行する（アーカイブにはダウンロード時点で記録されるため）
+    if not done and download_archive is not None and not no_media:
+        archive_id = archive_id_for_url(url)
+        if archive_id is not None and archive_id in download_archive:
+            if verbose:
+                print(f"⏭️ アーカイブに記録済みのためスキップします: {url}")
+            metrics.inc('ytdl_jobs_total', result='skipped')
+            return skipped
+
+    def record(stage, data=None):
+        if journal_key is not None:
+            job_journal.record(journal_key, stage, data)
+
+    # このジョブの後処理時間と、最初のバイトを受信した時刻と、段階ごとの所要時間を記録する
+    started = time.monotonic()
+    job = _job_state.job = {'pp_timings': Counter(), 'pp_started': {}, 'first_byte_at': None, 'received_at': None,
+                            'stages': [], 'streams': {}, 'started': started, 'started_at': time.time(),
+                            'thread': threading.get_ident(), 'retries': Counter(), 'backoff': 0.0,
+                            'reextracts': 0, 'disk': {'files': {}, 'written': 0, 'peak': 0}, 'thumbnails': {},
+                            'cancel': getattr(_job_state, 'cancel', None)}
+    info = None
+    error = None
+
+    def download(info):
+        # 同時ダウンロード数と空き容量はスケジューラが調整する
+        queued = time.monotonic()
+        with download_scheduler.download_slot(info, output_dir, target_ext):
+            record_stage(job, 'download_wait', queued, time.monotonic())
+            with stage_timer('download') as stage:
+                result = download_media(ydl, info, options, target_ext)
+                stage['bytes'] = downloaded_bytes(result)
+        return result
+
+    def download_with_retry(info, from_cache):
+        """
+        失敗の種類（classify_error）ごとにやり直してダウンロードする
+
+        expired（とキャッシュのURLでの失敗）は再抽出して新しいURLで、throttled / transient は
+        retry_delay だけ待って同じURLでやり直す。ホストのサーキットブレーカーが止めている間は待つ。
+        やり直しの回数は、データを受信できずに続けて失敗した回数で数える
+        （yt-dlpはフラグメントごとにやり直さないため、長いストリームでも途中まで進んだ失敗では数え直す）
+
+        Returns:
+            (info, ダウンロードの結果)
+        """
+        attempt = 0
+        while True:
+            urls = media_urls(info)
+            queued = time.monotonic()
+            if circuit_breaker.wait(urls) > 0:
+                record_stage(job, 'circuit_wait', queued, time.monotonic())
+            started = time.monotonic()
+            try:
+                result = download(info)
+            except (yt_dlp.utils.DownloadError, *yt_dlp.networking.exceptions.network_exceptions) as e:
+                reason, retry_after = classify_error(e, urls)
+                # ホストの状態によるもの（throttled / transient）だけを失敗として数える
+                circuit_breaker.report(urls, True if reason in RETRY_BACKOFF else None)
+                if reason == 'expired' or (reason == 'fatal' and from_cache):
+                    # 失効したURL（またはキャッシュのURLが使えなかった場合）は再抽出してやり直す
+                    if job['reextracts'] >= RETRY_REEXTRACTS:
+                        raise
+                    job['reextracts'] += 1
+                    metrics.inc('ytdl_reextracts_total', reason='expired' if reason == 'expired' else 'cache')
+                    if verbose:
+                        print(f"🔄 ストリームのURLが使えないため、再抽出してやり直します: {e}")
+                    if metadata_cache is not None:
+                        metadata_cache.invalidate(metadata_cache_key(url))
+                    with stage_timer('extract', cache=False, reason=reason):
+                        info = extract_info(ydl, url)
+                    from_cache = False
+                    continue
+                if (job['received_at'] or 0) > started:
+                    attempt = 0
+                if reason == 'fatal' or attempt >= options['retries']:
+                    raise
+                delay = retry_delay(reason, attempt, retry_after)
+                attempt += 1
+                record_retry('download', reason, delay)
+                if verbose:
+                    print(f"⏳ {e}: {delay:.1f}秒待ってやり直します（{attempt}/{options['retries']}）")
+                with stage_timer('backoff', reason=reason):
+                    time.sleep(delay)
+            except BaseException:
+                circuit_breaker.report(urls, None)
+                raise
+            else:
+                circuit_breaker.report(urls, False)
+                return info, result
+
+    try:
+        # 動画情報を取得
+        with stage_timer('extract') as stage:
+            info = extract_info(ydl, url, lazy_playlist=options['lazy_playlists'])
+            stage['cache'] = _job_state.cache_hit
+        if info is None:
+            if verbose:
+                print(f"⏭️ アーカイブに記録済みのためスキップします: {url}")
+            job['skipped'] = True
+            return skipped
+        if options['lazy_playlists'] and info.get('_type') in PLAYLIST_TYPES:
+            return run_playlist(ydl, info, output_dir, verbose, target_ext, options)
+        # 共有のキューのワーカーでは、抽出して分かった動画を別のジョブが扱っていないか確かめる（run_worker を参照）
+        claim_video = getattr(_job_state, 'claim_video', None)
+        if claim_video is not None and not claim_video(info):
+            if verbose:
+                print(f"⏭️ 別のジョブで完了済み（または実行中）のためスキップします: {url}")
+            job['skipped'] = True
+            return {**skipped, 'info': info}
+        cache_hit = _job_state.cache_hit
+        extract_time = time.monotonic() - started
+
+        record('extracted', {'id': info.get('id'), 'title': info.get('title')})
+
+        # 動画情報を表示
+        if verbose:
+            print_video_info(info)
+            print("-" * 50)
+
+        if no_media:
+            files = save_without_media(ydl, info, options['profile'], options['subtitle_langs'], verbose)
+            return {
+                'info': info,
+                'bytes': sum(os.path.getsize(f) for f in files),
+                'postprocess': {},
+                'cache': None if cache_hit is None else ('hit' if cache_hit else 'miss'),
+                'extract_time': extract_time,
+                'first_byte': None,
+                'first_byte_at': None,
+                'files': files,
+                'skipped': False,
+                'store': None,
+                'retries': sum(job['retries'].values()),
+                'backoff': job['backoff'],
+                'disk_written': job['disk']['written'],
+                'disk_peak': job['disk']['peak'],
+            }
+
+        # 前回ダウンロード（または後処理）したファイルが残っていれば使う
+        result = restore_downloads(info, done.get('postprocessed') or done.get('downloaded'))
+        if result is None:
+            # ダウンロードからやり直すので、後の段階も全てやり直す
+            done = {}
+
+        # 同じ動画・フォーマットをストアに保存済みなら、ダウンロードも後処理もせずにリンクする
+        store_key = None
+        if content_store is not None and result is None:
+            store_key = ContentStore.key(info, target_ext)
+        stored = False
+        if store_key is not None:
+            with stage_timer('store_link') as stage:
+                result = link_from_store(ydl, info, store_key)
+                stage['hit'] = stored = result is not None
+
+        # 字幕はメディアのダウンロードと並行して取得する
+        subtitles = []
+        if 'subtitles' not in done:
+            subtitles = start_subtitle_downloads(ydl, info, options['subtitle_langs'])
+            if verbose and subtitles:
+                print(f"📝 字幕ダウンロード中...（{', '.join(lang for lang, _ in subtitles)}）")
+        # サムネイルも並行して取得しておき、後処理でメタデータと一緒に埋め込む
+        if options['thumbnail'] and options['profile'] == 'video' and 'postprocessed' not in done and not stored:
+            job['thumbnails'] = start_thumbnail_downloads(ydl, info)
+
+        if stored:
+            if verbose:
+                print(f"🔗 保存済みのファイルをリンクしました（ダウンロードしません）: {result['filepath']}")
+            record('downloaded', journal_downloads(result))
+        elif result is not None:
+            if verbose:
+                print("⏩ 前回の実行でダウンロード済みのファイルを使います")
+        else:
+            # ダウンロード実行（URLが失効していた場合だけ再抽出する）
+            info, result = download_with_retry(info, from_cache=cache_hit)
+            record('downloaded', journal_downloads(result))
+
+        # 字幕の取得が終わるのを待つ（失敗しても続行）
+        # 通信だけで済む処理は、後処理の順番待ちの前に済ませておく
+        if 'subtitles' not in done:
+            with stage_timer('subtitles_wait'):
+                finish_subtitle_downloads(subtitles, verbose=verbose)
+            record('subtitles')
+
+        # 必要な後処理だけを、後処理のキューで実行（キューで待った時間も含む）
+        if 'postprocessed' not in done:
+            if not stored:
+                with stage_timer('postprocess'):
+                    download_scheduler.postprocess(run_postprocessing, ydl, result, target_ext, verbose=verbose)
+            record('postprocessed', journal_downloads(result))
+
+        # 後処理まで終えたファイルをストアに追加する（失敗してもジョブは成功とする）
+        if store_key is not None and not stored:
+            add_to_store(result, target_ext)
+
+        pp_timings = dict(job['pp_timings'])
+        first_byte_at = job['first_byte_at']
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _job_state.job = None
+        trace = trace_record(url, info, job, error)
+        metrics.observe_job(trace)
+        if trace_writer is not None:
+            trace_writer.write(trace)
+
+    if verbose and first_byte_at:
+        print(f"⚡ 最初のバイトまで: 起動から {first_byte_at - PROCESS_STARTED:.2f}秒"
+              f"（抽出 {extract_time:.2f}秒）")
+    if verbose and pp_timings:
+        print("⏱️ 後処理の所要時間: " + ", ".join(
+            f"{name} {seconds:.1f}秒" for name, seconds in pp_timings.items()))
+    if verbose and job['disk']['written']:
+        print(f"💾 ディスクへの書き込み: {job['disk']['written'] / 1024 / 1024:.1f}MB"
+              f"（使用量のピーク {job['disk']['peak'] / 1024 / 1024:.1f}MB）")
+
+    return {
+        'info': info,
+        'bytes': 0 if stored else downloaded_bytes(result),
+        'postprocess': pp_timings,
+        'cache': None if cache_hit is None else ('hit' if cache_hit else 'miss'),
+        'extract_time': extract_time,
+        'first_byte': first_byte_at - started if first_byte_at else None,
+        'first_byte_at': first_byte_at,
+        'files': [download.get('filepath') for _, download in iter_downloads(result)],
+        'skipped': False,
+        'store': None if store_key is None else ('hit' if stored else 'miss'),
+        'retries': sum(job['retries'].values()),
+        'backoff': job['backoff'],
+        'disk_written': job['disk']['written'],
+        'disk_peak': job['disk']['peak'],
+    }
+
+
+def playlist_entry_url(entry):
+    """プレイリストのエントリ（解決前の url 結果、または動画のinfo dict）のURL"""
+    if entry.get('_type') in ('url', 'url_transparent'):
+        return entry['url']
+    return entry.get('webpage_url') or entry.get('original_url') or entry.get('url')
+
+
+def run_playlist(ydl, playlist, output_dir, verbose=True, target_ext=None, options=None):
+    """
+    プレイリストのエントリを1本ずつ解決しながらダウンロードする
+
+    エントリは解決せずに取得しておき、1本ごとに run_pipeline で
+    抽出 → ダウンロード → 字幕 → 後処理 を行う。
+    全エントリの解決を待たずに最初の動画のダウンロードを始め、
+    処理が終わった動画のinfo dictは保持しないため、メモリ使用量はプレイリストの長さにほぼ依存しない
+
+    Returns:
+        run_pipeline と同じ形の結果のdict（エントリの合計）
+    """
+    started = time.monotonic()
+    if verbose:
+        print(f"📋 プレイリスト: {playlist.get('title', 'Unknown')}")
+        if playlist.get('playlist_count'):
+            print(f"📊 動画数: {playlist['playlist_count']}本")
+
+    total = {
+        'info': {key: playlist.get(key) for key in ('_type', 'id', 'title', 'webpage_url')},
+        'bytes': 0,
+        'postprocess': Counter(),
+        'cache': None,
+        'extract_time': 0,
+        'first_byte': None,
+        'first_byte_at': None,
+        'files': [],
+        'skipped': False,
+        'store': None,
+        'retries': 0,
+        'backoff': 0.0,
+        'disk_written': 0,
+        'disk_peak': 0,
+    }
+    count = 0
+    for index, entry in yt_dlp.utils.PlaylistEntries(ydl, playlist).get_requested_items():
+        if not entry:
+            continue
+        url = playlist_entry_url(entry)
+        if verbose:
+            print(f"\n▶️ [{index}] {entry.get('title') or url}")
+        try:
+            result = run_pipeline(ydl, url, output_dir, verbose, target_ext, options)
+        except yt_dlp.utils.DownloadError as e:
+            # ignoreerrors の場合は1本が失敗しても残りを続行する
+            if not ydl.params.get('ignoreerrors'):
+                raise
+            print(f"❌ [{index}] {url}: {e}")
+            continue
+        count += 1
+        total['bytes'] += result['bytes']
+        total['postprocess'].update(result['postprocess'])
+        total['extract_time'] += result['extract_time']
+        total['files'] += result['files']
+        total['retries'] += result['retries']
+        total['backoff'] += result['backoff']
+        total['disk_written'] += result['disk_written']
+        total['disk_peak'] = max(total['disk_peak'], result['disk_peak'])
+        if total['first_byte_at'] is None and result['first_byte_at']:
+            total['first_byte_at'] = result['first_byte_at']
+            total['first_byte'] = result['first_byte_at'] - started
+
+    total['info']['playlist_count'] = count
+    total['postprocess'] = dict(total['postprocess'])
+    return total
+
+
+def stream_url(fmt):
+    """フォーマットのダウンロード元URL"""
+    return fmt.get('url') or fmt.get('fragment_base_url') or fmt.get('manifest_url')
+
+
+def media_urls(info):
+    """抽出済みのinfo dictでダウンロードする各ストリームのURL"""
+    return [stream_url(f) for f in info.get('requested_formats') or [info]]
+
+
+class HostConnectionLimiter:
+    """
+    ホストごとの同時接続数を制限する
+
+    ダウンロードを始める前に、フラグメントの同時ダウンロード数だけ接続を確保する。
+    並列ストリームやバッチの並列ジョブを合わせても、1ホストへの接続数は limit を超えない。
+    （プロセスプールの場合はプロセスごとの上限になる）
+    """
+
+    def __init__(self, limit=MAX_CONNECTIONS_PER_HOST):
+        self.limit = max(1, limit)
+        self._in_use = Counter()
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def connections(self, urls, count=1):
+        """urls のホストそれぞれに count 本の接続を確保する"""
+        hosts = media_hosts(urls)
+        count = max(1, min(count, self.limit))
+        with self._cond:
+            # 全ホスト分をまとめて確保する（一部だけ確保して待つとデッドロックするため）
+            self._cond.wait_for(lambda: all(self._in_use[host] + count <= self.limit for host in hosts))
+            for host in hosts:
+                self._in_use[host] += count
+        try:
+            yield
+        finally:
+            with self._cond:
+                for host in hosts:
+                    self._in_use[host] -= count
+                self._cond.notify_all()
+
+
+# ホストごとの同時接続数の制限（main で --max-connections-per-host から設定する）
+host_limiter = HostConnectionLimiter()
+
+
+def configure_host_limiter(limit=MAX_CONNECTIONS_PER_HOST):
+    """ホストごとの同時接続数の上限を設定する"""
+    global host_limiter
+    host_limiter = HostConnectionLimiter(limit)
+    return host_limiter
+
+
+_HTTP_STATUS_RE = re.compile(r'HTTP Error (\d{3})')
+
+
+def classify_error(e, urls=None):
+    """
+    ダウンロードの失敗を、やり直し方で分類する
+
+    - 'throttled': HTTP 429（と Retry-After 付きの 503）。間隔を長めにあけてやり直す
+    - 'expired': HTTP 403 / 410、またはダウンロードしたURLの expire= が過ぎている。同じURLでは成功しないため再抽出する
+    - 'transient': 5xx・接続/読み込みのエラー・タイムアウト。間隔をあけてやり直す
+    - 'fatal': それ以外（やり直さない）
+
+    yt-dlpがリトライを諦めた場合の DownloadError は元の例外を持たないことがあるため、
+    メッセージの 'HTTP Error 403' は見る（それ以外の文言では判断しない）
+
+    Args:
+        e: ダウンロードで発生した例外
+        urls: ダウンロードしたストリームのURL（有効期限を確かめる）
+
+    Returns:
+        (分類, Retry-After[秒] または None)
+    """
+    # yt-dlpが DownloadError で包んだ例外は、元の例外で判断する
+    cause = getattr(e, 'exc_info', None)
+    if cause and cause[1] is not None:
+        e = cause[1]
+    http_error = yt_dlp.networking.exceptions.HTTPError
+    status = e.status if isinstance(e, http_error) else None
+    retry_after = None
+    if isinstance(e, http_error):
+        retry_after = yt_dlp.utils.int_or_none(e.response.get_header('Retry-After'))
+    elif status is None:
+        match = _HTTP_STATUS_RE.search(str(e))
+        status = int(match.group(1)) if match else None
+
+    if status == 429 or (status == 503 and retry_after is not None):
+        return 'throttled', retry_after
+    now = time.time()
+    if status in (403, 410) or any((url_expiry(url) or now) < now for url in urls or ()):
+        return 'expired', None
+    if status is not None:
+        return ('transient' if status >= 500 else 'fatal'), retry_after
+    if isinstance(e, (yt_dlp.networking.exceptions.TransportError, yt_dlp.utils.ContentTooShortError,
+                      ConnectionError, TimeoutError)):
+        return 'transient', None
+    return 'fatal', None
+
+
+def retry_delay(kind, attempt, retry_after=None):
+    """
+    attempt 回目（0から）のやり直しの前に待つ秒数
+
+    待ち時間の上限は基準の 2^attempt 倍（RETRY_BACKOFF の上限まで）にし、その半分から上限までの間で
+    ばらつかせる（同時に失敗したジョブが同時にやり直さないように）。Retry-After があればそれ以上待つ
+    """
+    base, cap = RETRY_BACKOFF[kind]
+    ceiling = min(cap, base * 2 ** attempt)
+    delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+    return delay
+
+
+def record_retry(kind, reason, delay=0.0):
+    """リトライの回数と待ち時間を、メトリクスと実行中のジョブに記録する"""
+    metrics.inc('ytdl_retries_total', kind=kind, reason=reason)
+    if delay:
+        metrics.inc('ytdl_retry_backoff_seconds_total', delay, reason=reason)
+    job = current_job()
+    if job is not None:
+        job['retries'][reason] += 1
+        job['backoff'] += delay
+
+
+def media_hosts(urls):
+    """URLのホスト名（重複なし、順序は一定）"""
+    return sorted({urllib.parse.urlsplit(url).hostname or '' for url in urls if url})
+
+
+class CircuitBreaker:
+    """
+    ホストごとのサーキットブレーカー
+
+    同じホストへのダウンロードが threshold 回続けて失敗（throttled / transient）したら、
+    open_seconds の間そのホストへのダウンロードを止める（並行するジョブも全て待つ）。
+    時間が過ぎたら1件だけ試し、成功すれば元に戻し、失敗すれば止める時間を倍にして（max_open_seconds まで）再び止める。
+    （プロセスプールの場合はプロセスごとの状態になる）
+    """
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, open_seconds=CIRCUIT_OPEN_SECONDS,
+                 max_open_seconds=CIRCUIT_MAX_OPEN_SECONDS):
+        self.threshold = max(1, threshold)
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max(open_seconds, max_open_seconds)
+        self._failures = Counter()
+        # 止めているホスト → (再開する時刻 time.monotonic, 止めた秒数)
+        self._open = {}
+        # 再開後に試しにダウンロードしているホスト
+        self._probing = set()
+        self._cond = threading.Condition()
+
+    @property
+    def config(self):
+        """ワーカープロセスで同じ設定のサーキットブレーカーを作るための引数"""
+        return {'threshold': self.threshold, 'open_seconds': self.open_seconds,
+                'max_open_seconds': self.max_open_seconds}
+
+    def wait(self, urls):
+        """
+        urls のホストへのダウンロードを止めていれば、再開するまで待つ
+
+        再開したホストは、呼び出したジョブが試しにダウンロードする（結果は report で知らせる）
+
+        Returns:
+            待った秒数
+        """
+        hosts = media_hosts(urls)
+        started = now = time.monotonic()
+        with self._cond:
+            while True:
+                blocked = [host for host in hosts if host in self._open
+                           and (now < self._open[host][0] or host in self._probing)]
+                if not blocked:
+                    break
+                # 試しのダウンロードの結果を待つ場合は、通知されるまで待つ
+                timeouts = [self._open[host][0] - now for host in blocked if host not in self._probing]
+                self._cond.wait(min(timeouts) if timeouts else None)
+                now = time.monotonic()
+            self._probing.update(host for host in hosts if host in self._open)
+        return now - started
+
+    def report(self, urls, failed):
+        """
+        urls へのダウンロードの結果を記録する
+
+        failed が None（ホストの状態と関係ない失敗）なら、試しのダウンロードの枠を返すだけ
+
+        Returns:
+            新たに止めたホストと秒数のリスト [(ホスト, 秒数), ...]
+        """
+        tripped = []
+        with self._cond:
+            for host in media_hosts(urls):
+                probing = host in self._probing
+                self._probing.discard(host)
+                if failed is None:
+                    continue
+                if not failed:
+                    self._failures.pop(host, None)
+                    self._open.pop(host, None)
+                    continue
+                self._failures[host] += 1
+                if probing and host in self._open:
+                    duration = min(self.max_open_seconds, self._open[host][1] * 2)
+                elif self._failures[host] >= self.threshold and host not in self._open:
+                    duration = self.open_seconds
+                else:
+                    continue
+                self._open[host] = (time.monotonic() + duration, duration)
+                tripped.append((host, duration))
+            self._cond.notify_all()
+        for host, duration in tripped:
+            metrics.inc('ytdl_circuit_breaker_trips_total')
+            progress_reporter.log(f"🚧 {host} へのダウンロードが続けて失敗したため、{duration:.0f}秒止めます")
+        return tripped
+
+
+# ホストごとのサーキットブレーカー（並行するジョブで共有する）
+circuit_breaker = CircuitBreaker()
+
+
+def configure_circuit_breaker(threshold=CIRCUIT_FAILURE_THRESHOLD, open_seconds=CIRCUIT_OPEN_SECONDS,
+                              max_open_seconds=CIRCUIT_MAX_OPEN_SECONDS):
+    """サーキットブレーカーの設定をする"""
+    global circuit_breaker
+    circuit_breaker = CircuitBreaker(threshold, open_seconds, max_open_seconds)
+    return circuit_breaker
+
+
+def estimate_download_size(info):
+    """
+    info dictのファイルサイズ（filesize / filesize_approx、無ければビットレート×長さ）から
+    ダウンロードするサイズを推定する（分からなければNone）
+    """
+    if info.get('entries'):
+        sizes = [estimate_download_size(entry) for entry in info['entries'] if entry]
+        known = [size for size in sizes if size is not None]
+        return sum(known) if known else None
+
+    total = None
+    for f in info.get('requested_formats') or [info]:
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size and f.get('tbr') and info.get('duration'):
+            size = int(f['tbr'] * 1000 / 8 * info['duration'])
+        if size:
+            total = (total or 0) + size
+    return total
+
+
+class DownloadScheduler:
+    """
+    同時に実行するダウンロードと後処理を調整する
+
+    - ダウンロードは max_downloads 件まで。開始前に、推定サイズ分の空き容量を予約する
+      （空き容量が足りなければ実行中のジョブの終了を待ち、実行中のジョブが無ければエラー）
+    - 後処理（ffmpeg）は max_postprocess 並列の専用のキューで実行し、
+      待っている間はダウンロードの枠を空けておく
+    - 全ダウンロードの合計の帯域を rate_limit（バイト/秒）に制限する
+      （プログレスフックで受信したバイト数を数え、超えた分だけ待つ）
+
+    プロセスプールの場合はプロセスごとに制限される
+    """
+
+    def __init__(self, max_downloads=MAX_DOWNLOADS, max_postprocess=MAX_POSTPROCESS, rate_limit=None,
+                 disk_margin=DISK_FREE_MARGIN):
+        self.max_downloads = max(1, max_downloads)
+        self.max_postprocess = max(1, max_postprocess)
+        self.rate_limit = rate_limit
+        self.disk_margin = disk_margin
+        self.stats = Counter()
+        # 実行中/待っている ダウンロードと後処理の数（メトリクスで公開する）
+        self.active = 0
+        self.waiting = 0
+        self.postprocess_active = 0
+        self.postprocess_queued = 0
+        self._reserved = 0
+        self._cond = threading.Condition()
+        self._postprocess_executor = None
+        self._received = {}
+        self._rate_lock = threading.Lock()
+        self._rate_available = 0
+        self._rate_updated = time.monotonic()
+
+    @property
+    def config(self):
+        """ワーカープロセスで同じ設定のスケジューラを作るための設定"""
+        return {'max_downloads': self.max_downloads, 'max_postprocess': self.max_postprocess,
+                'rate_limit': self.rate_limit, 'disk_margin': self.disk_margin}
+
+    @contextlib.contextmanager
+    def download_slot(self, info, output_dir, target_ext=None):
+        """ダウンロードの枠と、推定サイズ分の空き容量を確保する"""
+        needed = estimate_download_size(info) or 0
+        # 変換する場合は元のファイルと変換後のファイルが同時に存在する
+        if plan_postprocessing(info, target_ext)['action'] != 'none':
+            needed *= 2
+
+        waited = time.monotonic()
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    if self.active < self.max_downloads:
+                        free = shutil.disk_usage(output_dir).free - self._reserved
+                        if free - needed >= self.disk_margin:
+                            break
+                        if self.active == 0:
+                            raise yt_dlp.utils.DownloadError(
+                                f"空き容量が不足しています（必要: {needed / 1024 / 1024:.0f}MB + "
+                                f"余裕 {self.disk_margin / 1024 / 1024:.0f}MB, "
+                                f"空き: {max(free, 0) / 1024 / 1024:.0f}MB）")
+                        self.stats['disk_waits'] += 1
+                    self._cond.wait()
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self._reserved += needed
+            self.stats['slot_wait'] += time.monotonic() - waited
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._reserved -= needed
+                self._cond.notify_all()
+
+    def postprocess(self, func, *args, **kwargs):
+        """後処理のキューで func を実行し、終わるまで待って結果を返す"""
+        with self._cond:
+            if self._postprocess_executor is None:
+                self._postprocess_executor = ThreadPoolExecutor(
+                    max_workers=self.max_postprocess, thread_name_prefix='postprocess')
+        job = current_job()
+
+        def run():
+            # フックがこのジョブに記録できるよう、ジョブの状態を引き継ぐ
+            _job_state.job = job
+            with self._cond:
+                self.postprocess_queued -= 1
+                self.postprocess_active += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _job_state.job = None
+                with self._cond:
+                    self.postprocess_active -= 1
+
+        queued = time.monotonic()
+        with self._cond:
+            self.postprocess_queued += 1
+        future = self._postprocess_executor.submit(run)
+        result = future.result()
+        self.stats['postprocess_wait'] += time.monotonic() - queued
+        return result
+
+    def throttle(self, d):
+        """プログレスフックから呼ばれ、合計の帯域が rate_limit を超えた分だけ待つ"""
+        if not self.rate_limit:
+            return
+        # 'finished' には tmpfilename が無いことがあるため、filename で数える
+        filename = d.get('filename')
+        # 既にあるファイルの 'finished' は downloaded_bytes が無いので数えない
+        downloaded = d.get('downloaded_bytes') or 0
+        with self._rate_lock:
+            received = downloaded - self._received.get(filename, 0)
+            if d['status'] == 'downloading':
+                self._received[filename] = downloaded
+            else:
+                self._received.pop(filename, None)
+            if received <= 0:
+                return
+            # トークンバケット（最大1秒分まで貯められる）。足りない分は借りて、その分だけ待つ
+            now = time.monotonic()
+            self._rate_available = min(
+                self.rate_limit, self._rate_available + (now - self._rate_updated) * self.rate_limit)
+            self._rate_updated = now
+            self._rate_available -= received
+            wait = -self._rate_available / self.rate_limit
+        if wait > 0:
+            self.stats['throttled'] += wait
+            time.sleep(wait)
+
+    def shutdown(self):
+        """後処理のキューを終了する"""
+        with self._cond:
+            executor, self._postprocess_executor = self._postprocess_executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+# ダウンロードと後処理のスケジューラ（main で --max-downloads などから設定する）
+download_scheduler = DownloadScheduler()
+
+
+def configure_scheduler(max_downloads=MAX_DOWNLOADS, max_postprocess=MAX_POSTPROCESS, rate_limit=None,
+                        disk_margin=DISK_FREE_MARGIN):
+    """ダウンロードと後処理のスケジューラを設定する"""
+    global download_scheduler
+    download_scheduler.shutdown()
+    download_scheduler = DownloadScheduler(max_downloads, max_postprocess, rate_limit, disk_margin)
+    return download_scheduler
+
+
+def throttle_hook(d):
+    """合計の帯域を制限するプログレスフック"""
+    download_scheduler.throttle(d)
+
+
+def download_media(ydl, info, options, target_ext=None):
+    """
+    抽出済みのinfo dictからメディアをダウンロードする
+
+    streaming_merge が有効で、動画と音声をパイプでffmpegに渡せる場合は（streaming_merge_ext を参照）、
+    中間ファイルを書かずに最終的なファイルを作り、yt-dlpにはダウンロード済みとして扱わせる。
+    parallel_streams が有効で動画と音声を別々に取得する場合は、
+    先に各ストリームを同時にダウンロードしておき、yt-dlpにはマージだけを行わせる
+    """
+    formats = info.get('requested_formats') or []
+    if streaming_merge_ext(ydl, info, target_ext, options) and download_streams_merged(ydl, info):
+        # マージと同時にメタデータとサムネイルも書き込んだので、後処理では書き込まない（plan_postprocessing を参照）
+        info = {**info, '_streaming_merge': True}
+    elif options['parallel_streams'] and len(formats) > 1:
+        download_streams_parallel(ydl, info, options)
+
+    with host_limiter.connections(media_urls(info), options['concurrent_fragments']):
+        return ydl.process_ie_result(info, download=True)
+
+
+def download_streams_parallel(ydl, info, options):
+    """
+    動画と音声のストリームを同時にダウンロードする
+
+    yt-dlpがマージ前に使うファイル名（<名前>.f<フォーマットID>.<拡張子>）で保存するため、
+    その後の process_ie_result はダウンロード済みとして扱い、マージだけを行う
+    """
+    # ffmpegでの同時ダウンロードなど、yt-dlp自身がまとめてダウンロードする場合は任せる
+    if yt_dlp.downloader.get_suitable_downloader(dict(info), ydl.params) is not None:
+        return
+    # マージ後のファイルが既にあればダウンロードしない
+    if os.path.exists(ydl.prepare_filename(info)):
+        return
+
+    temp_filename = ydl.prepare_filename(info, 'temp')
+    base, ext = os.path.splitext(temp_filename)
+    if ext[1:] != info.get('ext'):
+        base = temp_filename
+    Path(temp_filename).parent.mkdir(parents=True, exist_ok=True)
+    job = current_job()
+
+    def download(fmt):
+        # フックがこのジョブに記録できるよう、ジョブの状態を引き継ぐ
+        _job_state.job = job
+        new_info = {k: v for k, v in info.items() if k != 'requested_formats'}
+        new_info.update(fmt)
+        filename = yt_dlp.utils.prepend_extension(
+            f"{base}.{fmt['ext']}", f"f{fmt['format_id']}", fmt['ext'])
+        with host_limiter.connections([stream_url(fmt)], options['concurrent_fragments']):
+            success, _ = ydl.dl(filename, new_info)
+        if not success:
+            raise yt_dlp.utils.DownloadError(f"ストリームのダウンロードに失敗しました: {fmt['format_id']}")
+
+    formats = info['requested_formats']
+    with ThreadPoolExecutor(max_workers=len(formats)) as executor:
+        for future in [executor.submit(download, fmt) for fmt in formats]:
+            future.result()
+
+
+def is_streamable(fmt):
+    """フォーマットのコンテナを、パイプから（先頭から順に読むだけで）多重化できるか"""
+    return fmt.get('ext') in STREAMABLE_EXTS or (fmt.get('container') or '').endswith('_dash')
+
+
+def streaming_merge_ext(ydl, info, target_ext, options):
+    """
+    動画と音声のストリームをパイプでffmpegに渡し、1回で最終的なファイルを作れる場合はその拡張子を返す（できなければNone）
+
+    - 2つのストリームがどちらも1本のファイルとしてHTTPで取得するもので（フラグメントに分かれたものは
+      yt-dlpが一時ファイルを必要とする）、パイプから読めるコンテナ（is_streamable）であること
+    - 変換先への後処理が不要であること（ストリームコピーや再エンコードが必要なら、従来どおりファイルを経由する）
+    - 中間ファイルを残す設定でなく、FIFO（os.mkfifo）とffmpegが使えること
+    """
+    formats = info.get('requested_formats') or []
+    if (not options['streaming_merge'] or options['keep_intermediates'] or len(formats) != 2
+            or not hasattr(os, 'mkfifo')):
+        return None
+    for fmt in formats:
+        if not is_streamable(fmt):
+            return None
+        if yt_dlp.downloader.get_suitable_downloader(dict(fmt), ydl.params) is not yt_dlp.downloader.HttpFD:
+            return None
+    if plan_postprocessing(info, target_ext)['action'] != 'none':
+        return None
+    if not yt_dlp.postprocessor.FFmpegPostProcessor(ydl).available:
+        return None
+    return info['ext']
+
+
+def download_streams_merged(ydl, info):
+    """
+    動画と音声のストリームをFIFOでffmpegに渡し、マージとメタデータ・サムネイルの書き込みを1回で行う
+
+    yt-dlpがマージ後に使うファイル名で保存するため、その後の process_ie_result はダウンロード済みとして扱う。
+    ストリームは途中から再開できないため、yt-dlp内のリトライはせずに失敗させる（run_pipeline がやり直す）。
+
+    Returns:
+        最終的なファイルを作れたか（ffmpegが入力を読めなかった場合などは False。ファイルを経由してやり直す）
+
+    Raises:
+        ストリームのダウンロードに失敗した場合は、その例外
+    """
+    filename = ydl.prepare_filename(info)
+    if os.path.exists(filename):
+        return True
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    temp_filename = yt_dlp.utils.prepend_extension(filename, 'temp')
+    formats = info['requested_formats']
+    metadata_pp = yt_dlp.postprocessor.FFmpegMetadataPP(ydl)
+    job = current_job()
+
+    with tempfile.TemporaryDirectory(prefix='ytdl-merge-') as fifo_dir:
+        fifos = []
+        for index, fmt in enumerate(formats):
+            fifos.append(os.path.join(fifo_dir, f"{index}.{fmt['ext']}"))
+            os.mkfifo(fifos[-1])
+        # ファイル名の ':' をプロトコルと解釈させないよう 'file:' を付ける
+        path_arg = metadata_pp._ffmpeg_filename_argument
+        args = [metadata_pp.executable, '-y', '-nostdin', '-loglevel', 'error']
+        for fifo in fifos:
+            args += ['-i', path_arg(fifo)]
+        # チャプターはメタデータのファイルを3つ目の入力として渡す
+        chapters_file = None
+        if info.get('chapters'):
+            chapters_file = os.path.join(fifo_dir, 'chapters.meta')
+            list(metadata_pp._get_chapter_opts(info['chapters'], chapters_file))
+            args += ['-i', path_arg(chapters_file)]
+        # サムネイルは最後の入力として渡して埋め込む（取得が終わっていなければ待つ）
+        thumbnail = thumbnail_for(info)
+        if can_embed_thumbnail(info, thumbnail):
+            args += ['-i', path_arg(thumbnail)]
+        for index, fmt in enumerate(formats):
+            if fmt.get('vcodec') != 'none':
+                args += ['-map', f'{index}:v:0']
+            if fmt.get('acodec') != 'none':
+                args += ['-map', f'{index}:a:0']
+        if chapters_file:
+            args += ['-map_chapters', str(len(fifos))]
+        if can_embed_thumbnail(info, thumbnail):
+            args += thumbnail_embed_opts(info, len(fifos) + bool(chapters_file))
+        args += ['-c', 'copy']
+        for opts in metadata_pp._get_metadata_opts(info):
+            args += opts
+        args.append(path_arg(temp_filename))
+
+        track_disk_usage()
+        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        def download(fmt, fifo):
+            # フックがこのジョブに記録できるよう、ジョブの状態を引き継ぐ
+            _job_state.job = job
+            new_info = {k: v for k, v in info.items() if k != 'requested_formats'}
+            new_info.update(fmt)
+            if new_info.get('http_headers') is None:
+                new_info['http_headers'] = ydl._calc_headers(new_info)
+            fd = yt_dlp.downloader.HttpFD(ydl, {**ydl.params, 'retries': 0})
+            for hook in ydl._progress_hooks:
+                fd.add_progress_hook(hook)
+            with host_limiter.connections([stream_url(fmt)]):
+                success, _ = fd.download(fifo, new_info)
+            if not success:
+                raise yt_dlp.utils.DownloadError(f"ストリームのダウンロードに失敗しました: {fmt['format_id']}")
+
+        # ffmpegを止める原因になったダウンロードの失敗
+        cause = None
+        with ThreadPoolExecutor(max_workers=len(formats)) as executor:
+            futures = [executor.submit(download, fmt, fifo) for fmt, fifo in zip(formats, fifos)]
+            while wait_futures(futures, timeout=0.1).not_done:
+                if proc.poll() is not None:
+                    # ffmpegが終わった後もFIFOを開こうとしているダウンロードを進める（書き込みは失敗して終わる）
+                    for fifo in fifos:
+                        with contextlib.suppress(OSError):
+                            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                elif cause is None:
+                    # 1つのストリームが失敗したら、ffmpegを止めて残りのダウンロードも終わらせる
+                    cause = next((future.exception() for future in futures
+                                  if future.done() and future.exception()), None)
+                    if cause is not None:
+                        proc.kill()
+            stderr = proc.communicate()[1].decode('utf-8', 'replace').strip().splitlines()
+
+    errors = [future.exception() for future in futures if future.exception()]
+    if cause is not None or (errors and proc.returncode == 0):
+        with contextlib.suppress(OSError):
+            os.remove(temp_filename)
+        raise cause or errors[0]
+    if proc.returncode != 0:
+        with contextlib.suppress(OSError):
+            os.remove(temp_filename)
+        progress_reporter.log(f"⚠️ ストリームをパイプでマージできないため、ファイルを経由してやり直します: {stderr[-1] if stderr else proc.returncode}")
+        return False
+    os.replace(temp_filename, filename)
+    track_disk_usage(filename)
+    return True
+
+
+_disk_usage_lock = threading.Lock()
+
+
+def track_disk_usage(path=None):
+    """
+    ファイルの書き込みを実行中のジョブに記録する（書き込んだバイト数と、ディスク使用量のピーク）
+
+    書き込む処理の前に path=None で呼んで既に消えたファイルを除き、書き込んだ後に path を渡す。
+    処理の間は、それまでに記録したファイル（処理の入力を含む）と書き込んだファイルが同時にあったものとして
+    ピークを求める（同じパスへの書き込みは、一時ファイルに書いてから置き換えたものとする）
+    """
+    job = current_job()
+    if job is None:
+        return
+    disk = job['disk']
+    with _disk_usage_lock:
+        if path is None:
+            for name in [name for name in disk['files'] if not os.path.exists(name)]:
+                del disk['files'][name]
+            return
+        # FIFO など通常のファイル以外は数えない
+        if not os.path.isfile(path):
+            return
+        size = os.path.getsize(path)
+        disk['peak'] = max(disk['peak'], sum(disk['files'].values()) + size)
+        disk['written'] += size
+        disk['files'][path] = size
+
+
+def iter_downloads(info):
+    """
+    process_ie_result の結果から、ダウンロードされた各ファイルを列挙する
+
+    requested_downloads の各要素には動画のinfo dictとの差分しか残らないため、
+    (動画のinfo dict, ダウンロードのdict) の組で返す
+    """
+    if not info:
+        return
+    if info.get('entries'):
+        for entry in info['entries']:
+            yield from iter_downloads(entry)
+        return
+    for download in info.get('requested_downloads') or []:
+        yield info, download
+
+
+def downloaded_bytes(info):
+    """process_ie_result の結果から、保存されたファイルの合計サイズを求める"""
+    total = 0
+    for _, download in iter_downloads(info):
+        filepath = download.get('filepath')
+        if filepath and os.path.exists(filepath):
+            total += os.path.getsize(filepath)
+    return total
+
+
+def _codec_name(codec):
+    """
+    コーデック文字列からコーデック名を取り出す（例: 'avc1.640028' → 'avc1'）
+
+    ストリームが無い場合は ''、不明な場合は None を返す
+    """
+    if codec == 'none':
+        return ''
+    if not codec:
+        return None
+    return codec.split('.')[0].lower()
+
+
+def plan_postprocessing(info, target_ext=TARGET_EXT):
+    """
+    ダウンロードしたファイルに必要な後処理を決める
+
+    選択されたフォーマットの ext / vcodec / acodec から判断し、
+    - 既に変換先のコンテナ → 何もしない（none）
+    - コーデックはそのまま入る → ストリームコピーでコンテナだけ変更（remux）
+    - それ以外 → 再エンコード（convert）
+    のいずれかを選ぶ。メタデータの書き込みは変換後に1回だけ行う
+    （ストリーミングでマージしたファイル（_streaming_merge）はマージと同時に書き込み済み）。
+
+    Returns:
+        {'action': 'none' | 'remux' | 'convert', 'postprocessors': [...]}
+    """
+    if not target_ext:
+        return {'action': 'none', 'postprocessors': []}
+
+    vcodec = _codec_name(info.get('vcodec'))
+    acodec = _codec_name(info.get('acodec'))
+    copyable = (
+        vcodec is not None and acodec is not None
+        and (vcodec == '' or vcodec in MP4_VIDEO_CODECS)
+        and (acodec == '' or acodec in MP4_AUDIO_CODECS))
+
+    if info.get('ext') == target_ext:
+        action = 'none'
+    elif copyable and target_ext == 'mp4':
+        action = 'remux'
+    else:
+        action = 'convert'
+
+    postprocessors = []
+    if action == 'remux':
+        postprocessors.append({'key': 'FFmpegVideoRemuxer', 'preferedformat': target_ext})
+    elif action == 'convert':
+        postprocessors.append({'key': 'FFmpegVideoConvertor', 'preferedformat': target_ext})
+    if not info.get('_streaming_merge'):
+        postprocessors.append({'key': 'FFmpegMetadata', 'add_metadata': True})
+
+    return {'action': action, 'postprocessors': postprocessors}
+
+
+def run_postprocessing(ydl, result, target_ext, verbose=True):
+    """
+    ダウンロードした各ファイルに、plan_postprocessing で決めた後処理を実行する
+
+    元のファイルは keepvideo が無効なら削除される。
+    取得したサムネイル（start_thumbnail_downloads）はメタデータと同じffmpegの実行で埋め込み、
+    ファイルの書き換えは1回で済ませる。埋め込めないコンテナでは、動画と同じ名前の画像として保存する
+    """
+    for video, download in iter_downloads(result):
+        target = {**video, **download}
+        plan = plan_postprocessing(target, target_ext)
+        if verbose and target_ext:
+            labels = {'none': '変換不要', 'remux': 'ストリームコピー', 'convert': '再エンコード'}
+            print(f"🔧 後処理: {labels[plan['action']]} ({target.get('ext')} → {target_ext})")
+        thumbnail = thumbnail_for(target)
+        # ストリーミングでマージしたファイルには、マージと同時に埋め込み済み
+        embedded = bool(target.get('_streaming_merge')) and can_embed_thumbnail(target, thumbnail)
+        for spec in plan['postprocessors']:
+            args = {k: v for k, v in spec.items() if k != 'key'}
+            pp = yt_dlp.postprocessor.get_postprocessor(spec['key'])(ydl, **args)
+            if spec['key'] == 'FFmpegMetadata' and can_embed_thumbnail(target, thumbnail):
+                embed_thumbnail_with_metadata(pp, target, thumbnail)
+                embedded = True
+            track_disk_usage()
+            target = ydl.run_pp(pp, target)
+            track_disk_usage(target.get('filepath'))
+        if thumbnail and not embedded and target.get('filepath'):
+            shutil.copyfile(thumbnail, yt_dlp.utils.replace_extension(
+                target['filepath'], os.path.splitext(thumbnail)[1][1:], target.get('ext')))
+        # 変換後のファイルを結果に反映する
+        download['filepath'] = target.get('filepath')
+        download['ext'] = target.get('ext')
+
+
+# フォーマット選択で使う、フォーマットごとの値の表（formats の1要素につき1行）
+# index は元の formats のリストでの位置、kind は 'video' / 'audio' / None（ストーリーボードなど）
+FormatRow = namedtuple('FormatRow', [
+    'index', 'format_id', 'ext', 'kind', 'width', 'height', 'fps', 'tbr',
+    'vcodec', 'acodec', 'size', 'size_exact', 'available', 'efficiency',
+])
+
+_RESOLUTION_RE = re.compile(r'^(\d+)x(\d+)$')
+
+
+def format_row(index, f, duration=None):
+    """yt-dlpのフォーマットのdictを FormatRow にする"""
+    vcodec = _codec_name(f.get('vcodec'))
+    acodec = _codec_name(f.get('acodec'))
+    width = f.get('width') or 0
+    height = f.get('height') or 0
+    if not height:
+        match = _RESOLUTION_RE.match(f.get('resolution') or '')
+        if match:
+            width, height = int(match.group(1)), int(match.group(2))
+
+    if vcodec == '' and acodec == '':
+        kind = None
+    elif vcodec == '' or (vcodec is None and not height and acodec):
+        kind = 'audio'
+    else:
+        kind = 'video'
+
+    tbr = f.get('tbr') or (f.get('vbr') or 0) + (f.get('abr') or 0)
+    size = f.get('filesize')
+    size_exact = size is not None
+    if size is None:
+        size = f.get('filesize_approx')
+    if size is None and tbr and duration:
+        size = int(tbr * 1000 / 8 * duration)
+
+    return FormatRow(
+        index, str(f.get('format_id', 'N/A')), f.get('ext') or 'N/A', kind, width, height,
+        f.get('fps') or 0, tbr, vcodec, acodec, size, size_exact, f.get('url') is not None,
+        CODEC_EFFICIENCY.get(vcodec if kind == 'video' else acodec, 1.0))
+
+
+def format_table(formats, duration=None):
+    """formats のリストから FormatRow の表を作る"""
+    return [format_row(i, f, duration) for i, f in enumerate(formats)]
+
+
+def _quality(row):
+    """画質（音声なら音質）の比較用の値"""
+    return (row.height, row.fps, row.tbr * row.efficiency)
+
+
+def _policy_best(arg):
+    # 最高画質
+    return lambda row: (row.available, _quality(row))
+
+
+def _policy_smallest(arg):
+    # 高さが arg 以上のうちファイルサイズが最小（条件を満たすものが無ければ高いものを優先）
+    min_height = arg or SMALLEST_MIN_HEIGHT
+    return lambda row: (
+        row.available, row.kind == 'audio' or row.height >= min_height,
+        row.size is not None, -(row.size or 0), _quality(row))
+
+
+def _policy_efficient(arg):
+    # 1ピクセルあたりのビットレートが最小（コーデックの効率も考慮）
+    def key(row):
+        pixels = row.width * row.height * (row.fps or 30)
+        known = bool(pixels and row.tbr)
+        return (row.available, known, -(row.tbr / row.efficiency / pixels) if known else 0, _quality(row))
+    return key
+
+
+def _policy_mp4(arg):
+    # mp4に再エンコードせずに入るもの（ストリームコピーで済むもの）を優先
+    def key(row):
+        copyable = ((row.vcodec == '' or row.vcodec in MP4_VIDEO_CODECS)
+                    and (row.acodec == '' or row.acodec in MP4_AUDIO_CODECS))
+        return (row.available, copyable, row.ext in ('mp4', 'm4a'), _quality(row))
+    return key
+
+
+# フォーマット選択のポリシー（名前 → (説明, 順位付けのキーを作る関数)）
+# "smallest:1080" のように ':' の後に数値の引数を付けられる
+FORMAT_POLICIES = {
+    'best': ('最高品質', _policy_best),
+    'smallest': (f'指定の高さ以上（デフォルト{SMALLEST_MIN_HEIGHT}p）で最小のファイル', _policy_smallest),
+    'efficient': ('1ピクセルあたりのビットレートが最小', _policy_efficient),
+    'mp4': ('mp4への再エンコードが不要なもの', _policy_mp4),
+}
+
+
+def parse_format_policy(spec):
+    """
+    ポリシーの指定（例: 'smallest:1080'）を (名前, 引数) にする
+
+    不明なポリシーは ValueError
+    """
+    name, _, arg = (spec or DEFAULT_FORMAT_POLICY).partition(':')
+    if name not in FORMAT_POLICIES:
+        raise ValueError(f"不明なフォーマットポリシー: {name}（{', '.join(FORMAT_POLICIES)}）")
+    return name, int(arg) if arg else None
+
+
+def policy_key(policy):
+    """ポリシーの順位付けのキー関数（大きいほど良い）"""
+    name, arg = parse_format_policy(policy)
+    return FORMAT_POLICIES[name][1](arg)
+
+
+def rank_formats(rows, policy=DEFAULT_FORMAT_POLICY, kind='video'):
+    """表の kind の行を、ポリシーで良い順に並べて返す"""
+    return sorted((row for row in rows if row.kind == kind), key=policy_key(policy), reverse=True)
+
+
+def best_format(rows, policy=DEFAULT_FORMAT_POLICY, kind='video', exts=None):
+    """表の kind の行（exts があればその拡張子のみ）のうち、ポリシーで1位の行（無ければNone）"""
+    candidates = [row for row in rows if row.kind == kind and (exts is None or row.ext in exts)]
+    # 1位だけが必要なので並べ替えはしない
+    return max(candidates, key=policy_key(policy), default=None)
+
+
+# 動画のコンテナと、そのままマージできる音声のコンテナ
+COMPATIBLE_AUDIO_EXTS = {'mp4': ('m4a', 'mp4'), 'webm': ('webm',)}
+
+
+def select_formats(formats, policy=DEFAULT_FORMAT_POLICY, format_id=None, duration=None):
+    """
+    ダウンロードするフォーマットを選ぶ
+
+    format_id が指定されていればそのフォーマットを、無ければ（見つからなければ）ポリシーで1位の動画を選び、
+    音声が無い動画にはポリシーで順位付けした音声（同じコンテナにマージできるものを優先）を組み合わせる
+
+    Returns:
+        formats の要素のリスト（動画のみ / 動画+音声 / 音声のみ）、選べなければ空のリスト
+    """
+    rows = format_table(formats, duration)
+    video = None
+    if format_id is not None:
+        video = next((row for row in rows if row.format_id == format_id), None)
+    if video is None:
+        video = best_format(rows, policy, 'video')
+
+    if video is not None and video.kind == 'video' and video.acodec == '':
+        audio = (best_format(rows, policy, 'audio', COMPATIBLE_AUDIO_EXTS.get(video.ext, ()))
+                 or best_format(rows, policy, 'audio'))
+        return [formats[row.index] for row in (video, audio) if row is not None]
+    if video is not None:
+        return [formats[video.index]]
+
+    audio = best_format(rows, policy, 'audio')
+    return [formats[audio.index]] if audio else []
+
+
+class _FormatDurationRecorder:
+    """
+    形式の選択の前（pre_process）に、動画の長さを format_selector のために記録する
+
+    yt-dlpの後処理として登録するが、PostProcessor を継承しないため後処理のフック（所要時間の記録）は呼ばれない。
+    選択は同じスレッドで続けて行われるため、スレッドごとに記録する
+    """
+
+    def set_downloader(self, downloader):
+        pass
+
+    def run(self, info):
+        _job_state.format_duration = info.get('duration')
+        return [], info
+
+
+def format_selector(policy=DEFAULT_FORMAT_POLICY, format_id=None):
+    """
+    select_formats で選ぶ、yt-dlpの format オプションに渡せる関数を作る
+
+    spec 属性はジャーナルのキーなどに使う文字列表現。
+    yt-dlpが渡す ctx には動画の長さが無いため、_FormatDurationRecorder が選択の直前に記録したものを使う
+    （サイズの分からない形式の大きさを tbr × 長さ で見積もる）
+    """
+    def selector(ctx):
+        duration = getattr(_job_state, 'format_duration', None)
+        chosen = select_formats(ctx['formats'], policy, format_id, duration)
+        if len(chosen) < 2:
+            yield from chosen
+            return
+        video, audio = chosen
+        yield {
+            'requested_formats': chosen,
+            'format': f"{video.get('format')}+{audio.get('format')}",
+            'format_id': f"{video['format_id']}+{audio['format_id']}",
+            'ext': yt_dlp.utils.get_compatible_ext(
+                vcodecs=[video.get('vcodec')], acodecs=[audio.get('acodec')],
+                vexts=[video['ext']], aexts=[audio['ext']]),
+            'protocol': f"{yt_dlp.utils.determine_protocol(video)}+{yt_dlp.utils.determine_protocol(audio)}",
+            'width': video.get('width'),
+            'height': video.get('height'),
+            'fps': video.get('fps'),
+            'vcodec': video.get('vcodec'),
+            'acodec': audio.get('acodec'),
+            'tbr': (video.get('tbr') or 0) + (audio.get('tbr') or 0),
+            'filesize_approx': ((video.get('filesize') or video.get('filesize_approx') or 0)
+                                + (audio.get('filesize') or audio.get('filesize_approx') or 0)) or None,
+        }
+
+    selector.spec = f"policy:{policy or DEFAULT_FORMAT_POLICY}:{format_id or ''}"
+    return selector
+
+
+def current_job():
+    """このスレッドで実行中のジョブの記録（無ければNone）"""
+    return getattr(_job_state, 'job', None)
+
+
+class JobCancelled(Exception):
+    """実行中のジョブが取り消された（共有のキューでリースを失った）"""
+
+
+def cancel_hook(d):
+    """ジョブが取り消されていれば、ダウンロードを止めるプログレスフック"""
+    job = current_job()
+    cancel = job.get('cancel') if job is not None else None
+    if cancel is not None and cancel.is_set():
+        raise JobCancelled("リースが別のワーカーに移ったため中止しました")
+
+
+def first_byte_hook(d):
+    """最初のバイトと、最後にデータを受信した時刻を記録するフック関数"""
+    job = current_job()
+    if job is not None and d['status'] == 'downloading' and d.get('downloaded_bytes'):
+        job['received_at'] = time.monotonic()
+        if job['first_byte_at'] is None:
+            job['first_byte_at'] = job['received_at']
+
+
+def postprocessor_hook(d):
+    """
+    後処理の開始/終了から、後処理ごとの所要時間を記録するフック関数
+    """
+    job = current_job()
+    if job is None:
+        return
+    name = d.get('postprocessor')
+    if d['status'] == 'started':
+        job['pp_started'][name] = time.monotonic()
+        if name == 'Merger':
+            track_disk_usage()
+    elif d['status'] == 'finished' and name in job['pp_started']:
+        started = job['pp_started'].pop(name)
+        finished = time.monotonic()
+        job['pp_timings'][name] += finished - started
+        record_stage(job, name, started, finished)
+        # yt-dlpが実行するマージの出力（run_postprocessing で実行する後処理はそちらで記録する）
+        if name == 'Merger':
+            track_disk_usage((d.get('info_dict') or {}).get('filepath'))
+
+
+def record_stage(job, name, started, finished, **data):
+    """ジョブの段階の開始/終了時刻（time.monotonic）を記録する"""
+    job['stages'].append({'name': name, 'started': started, 'finished': finished,
+                          'thread': threading.get_ident(), **data})
+
+
+@contextlib.contextmanager
+def stage_timer(name, **data):
+    """
+    with の中の所要時間を、実行中のジョブの段階として記録する（ジョブの外では何もしない）
+
+    with の値のdictに入れた値（bytes など）も一緒に記録される
+    """
+    job = current_job()
+    started = time.monotonic()
+    try:
+        yield data
+    finally:
+        if job is not None:
+            record_stage(job, name, started, time.monotonic(), **data)
+
+
+def stream_timing_hook(d):
+    """ストリーム（フォーマット）ごとのダウンロードの所要時間とバイト数を記録するフック関数"""
+    job = current_job()
+    if job is None:
+        return
+    filename = d.get('filename')
+    if d['status'] == 'downloading':
+        if filename not in job['streams']:
+            job['streams'][filename] = time.monotonic()
+            track_disk_usage()
+    elif filename in job['streams']:
+        # 既にあるファイルは 'finished' だけが呼ばれるので記録しない
+        format_id = (d.get('info_dict') or {}).get('format_id')
+        record_stage(job, f'stream:{format_id}', job['streams'].pop(filename), time.monotonic(),
+                     bytes=d.get('downloaded_bytes') or d.get('total_bytes'), status=d['status'])
+        if d['status'] == 'finished':
+            track_disk_usage(filename)
+
+
+_yt_dlp_instrumented = False
+
+
+def _instrument_yt_dlp():
+    """
+    フックの無いyt-dlpの処理を計測できるよう、入口を1回だけラップする
+
+    - YouTubeの署名/nチャレンジの解決（EJSソルバー）: 抽出の中で行われるため 'solve' の段階として記録
+    """
+    global _yt_dlp_instrumented
+    if _yt_dlp_instrumented:
+        return
+    _yt_dlp_instrumented = True
+
+    try:
+        from yt_dlp.extractor.youtube.jsc._director import JsChallengeRequestDirector
+    except ImportError:
+        return
+    bulk_solve = JsChallengeRequestDirector.bulk_solve
+
+    def timed_bulk_solve(self, requests, *args, **kwargs):
+        with stage_timer('solve', challenges=len(requests)):
+            return bulk_solve(self, requests, *args, **kwargs)
+
+    JsChallengeRequestDirector.bulk_solve = timed_bulk_solve
+
+
+class HostRateLimiter:
+    """
+    ホストごとに、リクエストの間隔を interval 秒以上あける
+
+    字幕のように小さいリクエストを並列に送ると HTTP 429 になりやすいため、
+    同じホストへのリクエストは順番に間隔をあけて送る
+    """
+
+    def __init__(self, interval=SUBTITLE_HOST_INTERVAL):
+        self.interval = interval
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """url のホストにリクエストしてよい時刻まで待つ"""
+        host = urllib.parse.urlsplit(url).hostname or ''
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+# 字幕・サムネイルの取得に使うスレッドプールと、字幕のホストごとの間隔の制限（プロセス内で共有）
+_subtitle_executor = None
+_subtitle_executor_lock = threading.Lock()
+subtitle_rate_limiter = HostRateLimiter()
+
+
+def _get_subtitle_executor():
+    """字幕・サムネイルを取得するスレッドプール（無ければ作成）"""
+    global _subtitle_executor
+    with _subtitle_executor_lock:
+        if _subtitle_executor is None:
+            _subtitle_executor = ThreadPoolExecutor(max_workers=SUBTITLE_WORKERS, thread_name_prefix='subtitles')
+        return _subtitle_executor
+
+
+def select_subtitles(info, langs=SUBTITLE_LANGS):
+    """
+    info dictの subtitles / automatic_captions から、取得する字幕を言語ごとに選ぶ
+
+    手動の字幕を自動生成の字幕より優先し、形式はVTTを優先する
+
+    Returns:
+        [(言語, 字幕のdict), ...]
+    """
+    selected = []
+    for lang in langs:
+        tracks = (info.get('subtitles') or {}).get(lang) or (info.get('automatic_captions') or {}).get(lang)
+        if not tracks:
+            continue
+        vtt = [track for track in tracks if track.get('ext') == 'vtt']
+        selected.append((lang, (vtt or tracks)[-1]))
+    return selected
+
+
+def fetch_subtitle(ydl, info, lang, track):
+    """
+    字幕を1つ取得して、動画ファイルと同じ名前（<名前>.<言語>.<形式>）で保存する
+
+    同じホストへのリクエストは間隔をあけ、HTTP 429 の場合は待ってからやり直す
+
+    Returns:
+        保存したファイルのパス
+    """
+    filename = yt_dlp.utils.subtitles_filename(
+        ydl.prepare_filename(info, 'subtitle'), lang, track.get('ext') or 'vtt', info.get('ext'))
+    if os.path.exists(filename):
+        return filename
+
+    data = track.get('data')
+    with stage_timer(f'subtitle:{lang}') as stage:
+        for attempt in range(SUBTITLE_RETRIES + 1):
+            if data is not None:
+                break
+            subtitle_rate_limiter.wait(track['url'])
+            try:
+                with ydl.urlopen(yt_dlp.networking.Request(track['url'], headers=track.get('http_headers'))) as response:
+                    data = response.read()
+            except yt_dlp.networking.exceptions.HTTPError as e:
+                if e.status != 429 or attempt == SUBTITLE_RETRIES:
+                    raise
+                # Retry-After があればそれに従い、無ければ待ち時間を倍にしていく
+                retry_after = yt_dlp.utils.int_or_none(e.response.get_header('Retry-After'))
+                time.sleep(retry_after if retry_after is not None else 2 ** attempt)
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        stage['bytes'] = len(data)
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+    return filename
+
+
+def start_subtitle_downloads(ydl, info, langs=SUBTITLE_LANGS):
+    """
+    字幕の取得を開始する（メディアのダウンロードと並行して実行する）
+
+    抽出済みのinfo dictに含まれる subtitles / automatic_captions のURLを使うため、
+    動画ページの再抽出は行わない。プレイリストの場合は各エントリの字幕を取得する
+
+    Returns:
+        [(言語, Future), ...]（finish_subtitle_downloads に渡す）
+    """
+    if info.get('entries'):
+        return [pending for entry in info['entries'] if entry
+                for pending in start_subtitle_downloads(ydl, entry, langs)]
+    executor = _get_subtitle_executor()
+    job = current_job()
+
+    def fetch(lang, track):
+        # 所要時間をこのジョブに記録できるよう、ジョブの状態を引き継ぐ
+        _job_state.job = job
+        try:
+            return fetch_subtitle(ydl, info, lang, track)
+        finally:
+            _job_state.job = None
+
+    return [(lang, executor.submit(fetch, lang, track)) for lang, track in select_subtitles(info, langs)]
+
+
+def finish_subtitle_downloads(pending, verbose=True):
+    """開始した字幕の取得が終わるのを待ち、保存したファイルのパスを返す（失敗しても続行）"""
+    fetched = []
+    files = []
+    for lang, future in pending:
+        try:
+            files.append(future.result())
+            fetched.append(lang)
+        except Exception as e:
+            # バッチ・デーモンでもプログレスバーを崩さずに知らせる
+            progress_reporter.log(f"⚠️ 字幕ダウンロード失敗（ダウンロードは続行）: {lang}: {e}")
+    if verbose and fetched:
+        print(f"✓ 字幕ダウンロード完了（{', '.join(fetched)}）")
+    return files
+
+
+def thumbnail_cache_path(info):
+    """
+    動画のサムネイルのキャッシュのパス（拡張子なし）
+
+    抽出器と動画IDごとに1つだけ保存する
+    """
+    name = f"{info.get('extractor_key') or info.get('extractor') or 'generic'}-{info['id']}"
+    return THUMBNAIL_CACHE_DIR / yt_dlp.utils.sanitize_filename(name, restricted=True)
+
+
+def cached_thumbnail(info):
+    """キャッシュ済みのサムネイルのパス（無ければNone）"""
+    base = thumbnail_cache_path(info)
+    for path in base.parent.glob(f'{glob.escape(base.name)}.*'):
+        if path.stem == base.name:
+            return str(path)
+    return None
+
+
+def fetch_thumbnail(ydl, info):
+    """
+    動画のサムネイルを1つ取得して、埋め込める形式（THUMBNAIL_IMAGE_EXTS）にしてキャッシュに保存する
+
+    抽出済みのinfo dictの thumbnails から良いものを順に試し（yt-dlpと同じ並び順）、
+    取得できなかったもの（最大解像度のサムネイルが無い場合など）は飛ばす。
+    WebPなどはffmpegでjpgに変換する。キャッシュにあれば取得も変換もしない
+
+    Returns:
+        保存したファイルのパス（サムネイルが無ければNone）
+    """
+    cached = cached_thumbnail(info)
+    if cached:
+        with stage_timer('thumbnail', cache='hit'):
+            return cached
+
+    thumbnails = list(info.get('thumbnails') or [])
+    if not thumbnails and info.get('thumbnail'):
+        thumbnails = [{'url': info['thumbnail']}]
+    if not thumbnails:
+        return None
+    ydl._sort_thumbnails(thumbnails)
+
+    base = thumbnail_cache_path(info)
+    base.parent.mkdir(parents=True, exist_ok=True)
+    with stage_timer('thumbnail', cache='miss') as stage:
+        error = None
+        for thumbnail in reversed(thumbnails):
+            try:
+                request = yt_dlp.networking.Request(thumbnail['url'], headers=thumbnail.get('http_headers'))
+                with ydl.urlopen(request) as response:
+                    data = response.read()
+            except yt_dlp.networking.exceptions.HTTPError as e:
+                error = e
+                continue
+            break
+        else:
+            raise error
+        stage['bytes'] = len(data)
+
+        ext = thumbnail.get('ext') or yt_dlp.utils.determine_ext(thumbnail['url'], 'jpg')
+        ext = {'jpeg': 'jpg'}.get(ext.lower(), ext.lower())
+        # 別のジョブが同時に取得していても、完成したファイルだけが見えるようにする（一時ファイルは隠しファイル）
+        with tempfile.NamedTemporaryFile(dir=base.parent, prefix=f'.{base.name}.', suffix=f'.{ext}',
+                                         delete=False) as f:
+            f.write(data)
+        path = f.name
+        try:
+            if ext not in THUMBNAIL_IMAGE_EXTS:
+                convertor = yt_dlp.postprocessor.FFmpegThumbnailsConvertorPP(ydl)
+                if convertor.available:
+                    converted = convertor.convert_thumbnail(path, 'jpg')
+                    os.remove(path)
+                    path, ext = converted, 'jpg'
+            filename = f'{base}.{ext}'
+            os.replace(path, filename)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            raise
+    return filename
+
+
+def start_thumbnail_downloads(ydl, info):
+    """
+    サムネイルの取得を開始する（メディアのダウンロードと並行して実行する）
+
+    字幕と同じスレッドプールで取得し、結果は実行中のジョブに動画IDごとに記録する（thumbnail_for で受け取る）。
+    プレイリストの場合は各エントリのサムネイルを取得する
+
+    Returns:
+        {動画ID: Future}
+    """
+    if info.get('entries'):
+        return {video_id: future for entry in info['entries'] if entry
+                for video_id, future in start_thumbnail_downloads(ydl, entry).items()}
+    if not info.get('id'):
+        return {}
+    executor = _get_subtitle_executor()
+    job = current_job()
+
+    def fetch():
+        # 所要時間をこのジョブに記録できるよう、ジョブの状態を引き継ぐ
+        _job_state.job = job
+        try:
+            return fetch_thumbnail(ydl, info)
+        finally:
+            _job_state.job = None
+
+    return {info['id']: executor.submit(fetch)}
+
+
+def thumbnail_for(info):
+    """
+    start_thumbnail_downloads で開始した、動画のサムネイルの取得が終わるのを待ってパスを返す
+
+    取得していない・失敗した場合はNone（失敗してもダウンロードは続行する）
+    """
+    job = current_job()
+    pending = job['thumbnails'] if job else {}
+    future = pending.get(info.get('id'))
+    if future is None:
+        return None
+    try:
+        with stage_timer('thumbnail_wait'):
+            return future.result()
+    except Exception as e:
+        # 同じ動画で何度も表示しないよう、失敗したものは取り除く
+        del pending[info['id']]
+        progress_reporter.log(f"⚠️ サムネイル取得失敗（ダウンロードは続行）: {e}")
+        return None
+
+
+def thumbnail_embed_opts(info, index):
+    """
+    ffmpegで、index 番目の入力のサムネイルを動画のカバー画像として埋め込むオプション
+
+    サムネイルのストリームは動画のストリームの後に追加されるため、動画のストリームの数から番号を決める
+    """
+    video_streams = sum(1 for fmt in info.get('requested_formats') or [info] if fmt.get('vcodec') != 'none')
+    return ['-map', str(index), f'-disposition:v:{video_streams}', 'attached_pic']
+
+
+def can_embed_thumbnail(info, thumbnail):
+    """サムネイルをファイルに埋め込めるか（コンテナと画像の形式）"""
+    return (bool(thumbnail) and info.get('ext') in THUMBNAIL_EMBED_EXTS
+            and os.path.splitext(thumbnail)[1][1:] in THUMBNAIL_IMAGE_EXTS)
+
+
+def embed_thumbnail_with_metadata(pp, info, thumbnail):
+    """
+    FFmpegMetadataPP が実行するffmpegにサムネイルの入力を追加する
+
+    メタデータ（とチャプター）の書き込みと同じ1回の書き換えで、サムネイルも埋め込む
+    """
+    run_ffmpeg_multiple_files = pp.run_ffmpeg_multiple_files
+
+    def run_with_thumbnail(input_paths, out_path, opts, **kwargs):
+        inputs = [path for path in input_paths if path]
+        return run_ffmpeg_multiple_files(
+            [*inputs, thumbnail], out_path, [*opts, *thumbnail_embed_opts(info, len(inputs))], **kwargs)
+
+    pp.run_ffmpeg_multiple_files = run_with_thumbnail
+
+
+def write_info_json(ydl, info):
+    """動画情報を、動画ファイルと同じ名前の .info.json に保存してパスを返す"""
+    filename = ydl.prepare_filename(info, 'infojson')
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(ydl.sanitize_info(info), f, ensure_ascii=False)
+    return filename
+
+
+def save_without_media(ydl, info, profile, langs=SUBTITLE_LANGS, verbose=True):
+    """
+    メディアをダウンロードしないプロファイル（NO_MEDIA_PROFILES）で保存する
+
+    - subtitles: 抽出済みのinfo dictから字幕だけを取得する
+    - metadata: 動画情報をJSONで保存する
+
+    Returns:
+        保存したファイルのパスのリスト
+    """
+    if profile == 'metadata':
+        entries = [entry for entry in info['entries'] if entry] if info.get('entries') else [info]
+        with stage_timer('metadata'):
+            files = [write_info_json(ydl, entry) for entry in entries]
+        if verbose:
+            print(f"✓ 動画情報を保存しました: {', '.join(files)}")
+        return files
+
+    pending = start_subtitle_downloads(ydl, info, langs)
+    if not pending:
+        print(f"⚠️ 字幕が見つかりませんでした（{', '.join(langs)}）")
+        return []
+    if verbose:
+        print(f"📝 字幕ダウンロード中...（{', '.join(lang for lang, _ in pending)}）")
+    with stage_timer('subtitles_wait'):
+        return finish_subtitle_downloads(pending, verbose=verbose)
+
+
+def build_download_opts(output_dir, format_code=None, options=None):
+    """
+    ダウンロード用のyt-dlpオプションを作成する
+
+    後処理（コンテナ変換・メタデータ）はダウンロード後に
+    plan_postprocessing が必要なものだけを選んで実行する
+
+    Args:
+        output_dir: ダウンロード先ディレクトリ
+        format_code: 特定のフォーマットID（Noneなら自動選択）
+        options: ダウンロードの設定（DEFAULT_DOWNLOAD_OPTIONS を参照）
+    """
+    options = {**DEFAULT_DOWNLOAD_OPTIONS, **(options or {})}
+
+    # yt-dlpの設定オプション
+    ydl_opts = {
+        # 出力ファイル名のテンプレート
+        'outtmpl': f'{output_dir}/%(title)s_%(id)s.%(ext)s',
+
+        # フォーマット選択（より柔軟な設定）
+        # 動画+音声の組み合わせを優先し、フォールバックを追加
+        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/bestvideo+bestaudio/best',
+
+        # 字幕は別途ダウンロードするため、ここでは無効
+        'writesubtitles': False,
+        'writeautomaticsub': False,
+
+        # サムネイルはダウンロードと並行して取得し、後処理で埋め込む（start_thumbnail_downloads を参照）
+        'writethumbnail': False,
+
+        # マージ/変換前の中間ファイルは削除する
+        'keepvideo': options['keep_intermediates'],
+        'addmetadata': True,
+
+        # プログレスフック（yt-dlp自身の進行状況表示は使わない）
+        'progress_hooks': [progress_hook, first_byte_hook, stream_timing_hook, throttle_hook, cancel_hook],
+        'noprogress': True,
+        'postprocessor_hooks': [postprocessor_hook],
+
+        # エラー時も続行
+        'ignoreerrors': False,
+
+        # プレイリストの場合は全動画をダウンロード
+        'playlistend': None,
+
+        # ffmpegのパス（必要に応じて）
+        # 'ffmpeg_location': '/usr/local/bin/ffmpeg',
+
+        # 静かなモード（False:詳細表示, True:最小限の出力）
+        'quiet': False,
+        'no_warnings': False,
+
+        # その他のオプション
+        'nocheckcertificate': True,
+        'geo_bypass': True,
+
+        # YouTubeの署名/nチャレンジを解くためのEJSスクリプト（キャッシュを共有）
+        # （これが無いと一部フォーマットのURLが無効になり HTTP 403 で停止する）
+        **component_opts(),
+
+        # DASH/HLSのフラグメントを同時にダウンロードする
+        'concurrent_fragment_downloads': options['concurrent_fragments'],
+
+        # 中断したダウンロードは .part ファイルの続きから再開する
+        'continuedl': True,
+
+        # yt-dlp自身はやり直さない（yt-dlpの retry_sleep_functions には失敗の内容が渡されず、429 と 5xx を
+        # 区別して待てないため）。やり直しと期限切れのURLの再抽出は run_pipeline が classify_error で分類して行う。
+        # フラグメントも飛ばさずに失敗させ、やり直すときは continuedl で続きから再開する
+        'retries': 0,
+        'fragment_retries': 0,
+        'skip_unavailable_fragments': False,
+        'file_access_retries': options['retries'],
+
+        # ブラウザのCookieを使用（必要に応じて）
+        # 'cookiesfrombrowser': 'chrome',
+    }
+
+    if format_code and re.fullmatch(r'[\w-]+', format_code):
+        # 指定されたフォーマットに、ポリシーで選んだ音声を追加
+        ydl_opts['format'] = format_selector(options['format_policy'], format_code)
+    elif format_code:
+        # yt-dlpのフォーマット指定（例: 'bv*[height<=720]'）はそのまま使い、音声を追加
+        ydl_opts['format'] = f'{format_code}+bestaudio/best'
+    elif options['format_policy']:
+        ydl_opts['format'] = format_selector(options['format_policy'])
+
+    # 動画以外のプロファイルでは、必要なものだけを取得する
+    if options['profile'] != 'video':
+        ydl_opts['addmetadata'] = False
+    if options['profile'] == 'audio':
+        ydl_opts['format'] = format_code or AUDIO_FORMAT
+    elif options['profile'] in NO_MEDIA_PROFILES:
+        ydl_opts['skip_download'] = True
+        # メディアのフォーマットが無い動画でも字幕・動画情報は保存する
+        ydl_opts['ignore_no_formats_error'] = True
+
+    if options['extractors']:
+        ydl_opts['allowed_extractors'] = options['extractors']
+
+    if download_archive is not None and options['profile'] not in NO_MEDIA_PROFILES:
+        # ダウンロード済みの動画（プレイリストのエントリを含む）を飛ばす
+        ydl_opts['download_archive'] = download_archive
+
+    return ydl_opts
+
+
+def download_video(url, output_dir="downloads", options=None):
+    """
+    YouTube動画をダウンロードする
+
+    Args:
+        url: YouTube動画のURL
+        output_dir: ダウンロード先ディレクトリ
+        options: ダウンロードの設定（DEFAULT_DOWNLOAD_OPTIONS を参照）
+    """
+    # ダウンロード先ディレクトリを作成
+    Path(output_dir).mkdir(exist_ok=True)
+
+    ydl_opts = build_download_opts(output_dir, options=options)
+
+    try:
+        print(f"\n📥 ダウンロード開始: {url}")
+        print(f"📁 保存先: {output_dir}/")
+        print("-" * 50)
+
+        with create_ydl(ydl_opts) as ydl:
+            run_pipeline(ydl, url, output_dir, target_ext=TARGET_EXT, options=options)
+
+        print("\n✅ ダウンロード完了！")
+
+    except yt_dlp.utils.DownloadError as e:
+        print(f"\n❌ ダウンロードエラー: {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print("\n⚠️ ダウンロードが中断されました")
+        if job_journal is not None:
+            print("💡 もう一度同じコマンドを実行すると、完了した段階の続きから再開します")
+        sys.exit(1)
+    except Exception as e:
+        print(f"\n❌ エラーが発生しました: {e}")
+        sys.exit(1)
+
+
+class ProgressReporter:
+    """
+    yt-dlpのプログレスフックから進行状況を表示する
+
+    断片化されたDASH/HLSではフックが1秒間に何千回も呼ばれるため、
+    表示は interval 秒ごとに間引く。表示モード:
+    - 'bar': 端末向けのプログレスバー。同時に複数のダウンロードがあれば1つの複数行表示にまとめる
+    - 'plain': 端末以外（ログファイルなど）向け。\\r を使わず一定間隔で1行ずつ出力
+    - 'json': 機械可読なJSON Lines（バイト数・速度・ETA・フラグメント番号）
+    - 'none': 表示しない
+    """
+
+    MODES = ('auto', 'bar', 'plain', 'json', 'none')
+    DEFAULT_INTERVALS = {'bar': 0.2, 'plain': 10.0, 'json': 1.0, 'none': 0.0}
+    BAR_LENGTH = 30
+
+    def __init__(self, mode='auto', interval=None, stream=None):
+        self.stream = stream or sys.stdout
+        if mode == 'auto':
+            isatty = getattr(self.stream, 'isatty', None)
+            mode = 'bar' if isatty and isatty() else 'plain'
+        if mode not in self.MODES:
+            raise ValueError(f"不明な表示モード: {mode}")
+        self.mode = mode
+        self.interval = self.DEFAULT_INTERVALS[mode] if interval is None else interval
+        self._lock = threading.Lock()
+        self._active = {}
+        self._last_render = 0.0
+        self._drawn_lines = 0
+
+    def hook(self, d):
+        """yt-dlpのプログレスフック"""
+        if self.mode == 'none':
+            return
+        key = d.get('tmpfilename') or d.get('filename')
+        now = time.monotonic()
+        with self._lock:
+            if d['status'] == 'downloading':
+                self._active[key] = d
+                if now - self._last_render < self.interval:
+                    return
+                self._last_render = now
+                self._render()
+            elif d['status'] in ('finished', 'error'):
+                self._active.pop(key, None)
+                self._clear()
+                self._write_event(d)
+                self._redraw()
+
+    def log(self, message):
+        """進行状況の表示を崩さずにメッセージを出力する"""
+        with self._lock:
+            self._clear()
+            print(message, file=self.stream, flush=True)
+            self._redraw()
+
+    def _redraw(self):
+        """消したプログレスバーを描き直す（bar以外は次の更新を待つ）"""
+        if self.mode == 'bar':
+            self._render()
+
+    def _render(self):
+        """進行中のダウンロードを表示する"""
+        if not self._active:
+            return
+        if self.mode == 'json':
+            for d in self._active.values():
+                self._write_json(d)
+        elif self.mode == 'plain':
+            for d in self._active.values():
+                print(self._format_line(d, bar=False), file=self.stream, flush=True)
+        elif self.mode == 'bar':
+            self._clear()
+            lines = [self._format_line(d, bar=True, name=len(self._active) > 1)
+                     for d in self._active.values()]
+            self.stream.write('\n'.join(f'\x1b[2K{line}' for line in lines))
+            self.stream.flush()
+            self._drawn_lines = len(lines)
+
+    def _clear(self):
+        """表示中のプログレスバーを消す"""
+        if self.mode != 'bar' or not self._drawn_lines:
+            return
+        if self._drawn_lines > 1:
+            # 複数行表示の先頭に戻る
+            self.stream.write(f'\x1b[{self._drawn_lines - 1}F')
+        self.stream.write('\r\x1b[J')
+        self.stream.flush()
+        self._drawn_lines = 0
+
+    def _write_event(self, d):
+        """ダウンロードの完了/失敗を出力する"""
+        if self.mode == 'json':
+            self._write_json(d)
+        elif d['status'] == 'finished':
+            filename = d.get('filename', 'unknown')
+            print(f"✓ ダウンロード完了: {os.path.basename(filename)}", file=self.stream, flush=True)
+        else:
+            filename = d.get('filename', 'unknown')
+            print(f"❌ ダウンロード失敗: {os.path.basename(filename)}", file=self.stream, flush=True)
+
+    def _write_json(self, d):
+        """進行状況をJSONで1行出力する"""
+        record = {
+            'status': d['status'],
+            'id': (d.get('info_dict') or {}).get('id'),
+            'format_id': (d.get('info_dict') or {}).get('format_id'),
+            'filename': d.get('filename'),
+            'downloaded_bytes': d.get('downloaded_bytes'),
+            'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate'),
+            'speed': d.get('speed'),
+            'eta': d.get('eta'),
+            'elapsed': d.get('elapsed'),
+            'fragment_index': d.get('fragment_index'),
+            'fragment_count': d.get('fragment_count'),
+            'time': time.time(),
+        }
+        print(json.dumps(record, ensure_ascii=False), file=self.stream, flush=True)
+
+    def _format_line(self, d, bar=True, name=False):
+        """1件分の進行状況を1行にまとめる"""
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        downloaded = d.get('downloaded_bytes') or 0
+        # 速度をMB/s単位で表示
+        speed_mb = (d.get('speed') or 0) / 1024 / 1024
+        eta = d.get('eta')
+
+        parts = []
+        if total > 0:
+            percentage = downloaded / total * 100
+            if bar:
+                # プログレスバーを作成
+                filled_length = int(self.BAR_LENGTH * downloaded // total)
+                parts.append('[' + '█' * filled_length + '░' * (self.BAR_LENGTH - filled_length) + ']')
+            parts.append(f"{percentage:.1f}%")
+        else:
+            parts.append(f"{downloaded / 1024 / 1024:.1f}MB")
+        line = f"⏬ {' '.join(parts)} | {speed_mb:.2f} MB/s | ETA: {format_time(int(eta) if eta else eta)}"
+        if d.get('fragment_index') and d.get('fragment_count'):
+            line += f" | {d['fragment_index']}/{d['fragment_count']}"
+        if name or not bar:
+            line = f"{line} | {os.path.basename(d.get('filename') or '')}"
+        return line
+
+
+# 進行状況の表示（main で --progress などから設定する）
+progress_reporter = ProgressReporter()
+
+
+def configure_progress(mode='auto', interval=None):
+    """進行状況の表示方法を設定する"""
+    global progress_reporter
+    progress_reporter = ProgressReporter(mode, interval)
+    return progress_reporter
+
+
+def progress_hook(d):
+    """
+    ダウンロード進行状況を表示するフック関数
+    """
+    progress_reporter.hook(d)
+
+
+def format_duration(seconds):
+    """秒数を時:分:秒形式に変換"""
+    if not seconds:
+        return "Unknown"
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    secs = seconds % 60
+    
+    if hours > 0:
+        return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+    else:
+        return f"{minutes:02d}:{secs:02d}"
+
+
+def format_time(seconds):
+    """秒数を読みやすい形式に変換"""
+    if not seconds:
+        return "Unknown"
+    if seconds < 60:
+        return f"{seconds}秒"
+    elif seconds < 3600:
+        return f"{seconds // 60}分{seconds % 60}秒"
+    else:
+        hours = seconds // 3600
+        minutes = (seconds % 3600) // 60
+        return f"{hours}時間{minutes}分"
+
+
+# バッチモードのワーカーごとの YoutubeDL インスタンス
+# スレッド/プロセスごとに1つ作成し、複数のURLで使い回す
+_worker_state = threading.local()
+_worker_ydls = []
+_worker_ydls_lock = threading.Lock()
+
+
+def read_batch_urls(path):
+    """
+    バッチファイルからURLを読み込む
+
+    Args:
+        path: URLを1行に1つ書いたファイル（'-' なら標準入力）
+
+    空行と '#' で始まる行は無視する
+    """
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+
+def _get_worker_ydl(job_opts):
+    """このワーカー用の YoutubeDL を取得する（無ければ作成）"""
+    ydl = getattr(_worker_state, 'ydl', None)
+    if ydl is None:
+        # spawnで起動したワーカープロセスではキャッシュを開き直す
+        if metadata_cache is None and job_opts['metadata_cache']:
+            configure_metadata_cache(**job_opts['metadata_cache'])
+        if job_journal is None and job_opts['journal']:
+            configure_journal(**job_opts['journal'])
+        if download_archive is None and job_opts['archive']:
+            configure_archive(**job_opts['archive'])
+        if trace_writer is None and job_opts['trace']:
+            configure_trace(**job_opts['trace'])
+        if content_store is None and job_opts['store']:
+            configure_store(**job_opts['store'])
+        # fork したワーカープロセスには親のメトリクスが複製されているため、このプロセスの分だけを数え直す
+        if job_opts['use_processes']:
+            metrics.collect(reset=True)
+        if progress_reporter.mode != job_opts['progress_mode']:
+            configure_progress(job_opts['progress_mode'], job_opts['progress_interval'])
+        if host_limiter.limit != job_opts['max_connections_per_host']:
+            configure_host_limiter(job_opts['max_connections_per_host'])
+        if circuit_breaker.config != job_opts['circuit_breaker']:
+            configure_circuit_breaker(**job_opts['circuit_breaker'])
+        if download_scheduler.config != job_opts['scheduler']:
+            configure_scheduler(**job_opts['scheduler'])
+        ydl_opts = build_download_opts(job_opts['output_dir'], job_opts['format_code'], job_opts['options'])
+        # 進行状況は ProgressReporter が全ワーカー分をまとめて表示する
+        ydl_opts.update({
+            'quiet': True,
+            'no_warnings': True,
+        })
+        ydl = create_ydl(ydl_opts)
+        _worker_state.ydl = ydl
+        with _worker_ydls_lock:
+            _worker_ydls.append(ydl)
+    return ydl
+
+
+def batch_job_opts(output_dir, format_code=None, workers=4, use_processes=False, options=None):
+    """
+    ワーカーで _batch_job を実行するための設定（ワーカープロセスでキャッシュなどを開き直すための設定を含む）
+
+    Args:
+        output_dir: ダウンロード先ディレクトリ
+        format_code: 特定のフォーマットID（Noneなら自動選択）
+        workers: 同時に処理するワーカー数
+        use_processes: ワーカーがプロセスか
+        options: ダウンロードの設定（DEFAULT_DOWNLOAD_OPTIONS を参照）
+    """
+    return {
+        'output_dir': output_dir,
+        'format_code': format_code,
+        'options': options,
+        'metadata_cache': metadata_cache.config if metadata_cache else None,
+        'journal': job_journal.config if job_journal else None,
+        'archive': download_archive.config if download_archive else None,
+        'trace': trace_writer.config if trace_writer else None,
+        'store': content_store.config if content_store else None,
+        'use_processes': use_processes,
+        # 別プロセスの進行状況は1つの表示にまとめられないため、JSON以外は表示しない
+        'progress_mode': (progress_reporter.mode if not use_processes or progress_reporter.mode == 'json'
+                          else 'none'),
+        'progress_interval': progress_reporter.interval,
+        'max_connections_per_host': host_limiter.limit,
+        'circuit_breaker': circuit_breaker.config,
+        # プロセスプールではプロセスごとに1件ずつ実行するため、帯域の上限をプロセス数で分ける
+        'scheduler': ({**download_scheduler.config, 'max_downloads': 1,
+                       'rate_limit': download_scheduler.rate_limit and download_scheduler.rate_limit // workers}
+                      if use_processes else download_scheduler.config),
+    }
+
+
+def _batch_job(url, job_opts):
+    """
+    バッチの1件を処理する（ワーカー内で実行）
+
+    失敗しても例外は投げず、結果のdictにエラーを記録して返す
+    """
+    started = time.monotonic()
+    result = {'url': url, 'ok': False, 'bytes': 0, 'postprocess': {}, 'cache': None,
+              'first_byte': None, 'skipped': False, 'store': None, 'retries': 0, 'backoff': 0.0,
+              'disk_written': 0, 'disk_peak': 0, 'archive_id': None, 'error': None}
+    try:
+        ydl = _get_worker_ydl(job_opts)
+        # フォーマット指定が無い場合のみ mp4 への後処理を行う
+        target_ext = None if job_opts['format_code'] else TARGET_EXT
+        pipeline = run_pipeline(ydl, url, job_opts['output_dir'], verbose=False, target_ext=target_ext,
+                                options=job_opts['options'])
+        result.update(ok=True, bytes=pipeline['bytes'], postprocess=pipeline['postprocess'],
+                      cache=pipeline['cache'], first_byte=pipeline['first_byte'],
+                      skipped=pipeline['skipped'], store=pipeline['store'], retries=pipeline['retries'],
+                      backoff=pipeline['backoff'], disk_written=pipeline['disk_written'],
+                      disk_peak=pipeline['disk_peak'], title=pipeline['info'].get('title'))
+        # 抽出した動画のアーカイブのID（共有のキューで、同じ動画の完了を1回だけ記録するために使う）
+        info = pipeline['info']
+        if info.get('extractor_key') and info.get('id'):
+            result['archive_id'] = yt_dlp.utils.make_archive_id(info['extractor_key'], info['id'])
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        # ワーカープロセスは終了時に atexit が呼ばれないため、ジョブごとに書き込む
+        if job_opts['use_processes'] and job_journal is not None:
+            job_journal.flush()
+        # ワーカープロセスのメトリクスはメインプロセスに返して集計する
+        if job_opts['use_processes']:
+            result['metrics'] = metrics.collect(reset=True)
+    result['elapsed'] = time.monotonic() - started
+    return result
+
+
+def run_batch(urls, output_dir="downloads", format_code=None, workers=4, use_processes=False,
+              options=None):
+    """
+    複数のURLをワーカープールでダウンロードする
+
+    1件が失敗しても残りのURLの処理は続行し、最後に集計を表示する
+
+    Args:
+        urls: ダウンロードするURLのリスト
+        output_dir: ダウンロード先ディレクトリ
+        format_code: 特定のフォーマットID（Noneなら自動選択）
+        workers: 同時に処理するワーカー数
+        use_processes: Trueならスレッドではなくプロセスプールを使う
+        options: ダウンロードの設定（DEFAULT_DOWNLOAD_OPTIONS を参照）
+
+    Returns:
+        集計結果のdict
+    """
+    Path(output_dir).mkdir(exist_ok=True)
+    job_opts = batch_job_opts(output_dir, format_code, workers, use_processes, options)
+
+    if use_processes:
+        from concurrent.futures import ProcessPoolExecutor
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    # スレッドの場合、後処理の順番待ちのスレッドがいてもダウンロードの枠が埋まるよう、後処理の分も増やす
+    pool_size = workers if use_processes else workers + download_scheduler.max_postprocess
+    print(f"\n📥 バッチダウンロード開始: {len(urls)}件 "
+          f"（{'プロセス' if use_processes else 'スレッド'} x {workers}）")
+    print(f"📁 保存先: {output_dir}/")
+    print("-" * 50)
+
+    # fork したワーカーに書き込み前の記録が複製されないよう、先に書き込んでおく
+    if job_journal is not None:
+        job_journal.flush()
+
+    started = time.monotonic()
+    results = []
+    try:
+        with executor_cls(max_workers=pool_size) as executor:
+            futures = [executor.submit(_batch_job, url, job_opts) for url in urls]
+            metrics.set_gauge('ytdl_queue_pending', lambda: sum(1 for f in futures if not (f.running() or f.done())))
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                # ワーカープロセスで集計したメトリクスを足し込む
+                if 'metrics' in result:
+                    metrics.merge(result.pop('metrics'))
+                results.append(result)
+                if result['skipped']:
+                    progress_reporter.log(
+                        f"⏭️ [{done}/{len(urls)}] {result.get('title') or result['url']}（完了済み）")
+                elif result['ok']:
+                    size_mb = result['bytes'] / 1024 / 1024
+                    progress_reporter.log(
+                        f"✓ [{done}/{len(urls)}] {result.get('title') or result['url']} ({size_mb:.1f}MB)")
+                else:
+                    progress_reporter.log(f"❌ [{done}/{len(urls)}] {result['url']}: {result['error']}")
+    finally:
+        metrics.set_gauge('ytdl_queue_pending', 0)
+        # スレッドプールで作成した YoutubeDL を閉じる
+        with _worker_ydls_lock:
+            while _worker_ydls:
+                _worker_ydls.pop().close()
+
+    elapsed = time.monotonic() - started
+    succeeded = [r for r in results if r['ok']]
+    failed = [r for r in results if not r['ok']]
+    total_bytes = sum(r['bytes'] for r in succeeded)
+    postprocess = Counter()
+    for r in succeeded:
+        postprocess.update(r['postprocess'])
+    first_bytes = [r['first_byte'] for r in succeeded if r['first_byte'] is not None]
+    summary = {
+        'total': len(urls),
+        'succeeded': len(succeeded),
+        'failed': len(failed),
+        'skipped': sum(1 for r in results if r['skipped']),
+        'total_bytes': total_bytes,
+        'elapsed': elapsed,
+        'urls_per_minute': len(results) / elapsed * 60 if elapsed > 0 else 0,
+        'bytes_per_second': total_bytes / elapsed if elapsed > 0 else 0,
+        'postprocess': dict(postprocess),
+        'avg_first_byte': sum(first_bytes) / len(first_bytes) if first_bytes else None,
+        'cache_hits': sum(1 for r in results if r.get('cache') == 'hit'),
+        'cache_misses': sum(1 for r in results if r.get('cache') == 'miss'),
+        'store_hits': sum(1 for r in results if r.get('store') == 'hit'),
+        'retries': sum(r['retries'] for r in results),
+        'backoff': sum(r['backoff'] for r in results),
+        'disk_written': sum(r['disk_written'] for r in results),
+        'disk_peak': max((r['disk_peak'] for r in results), default=0),
+        'scheduler': {} if use_processes else dict(download_scheduler.stats),
+        'failures': [{'url': r['url'], 'error': r['error']} for r in failed],
+    }
+    print_batch_summary(summary)
+    return summary
+
+
+def print_batch_summary(summary):
+    """バッチの集計結果を表示"""
+    print("-" * 50)
+    print("📊 バッチ集計")
+    print(f"  成功: {summary['succeeded']}/{summary['total']}件")
+    print(f"  失敗: {summary['failed']}件")
+    if summary['skipped']:
+        print(f"  スキップ（前回の実行で完了済み）: {summary['skipped']}件")
+    print(f"  合計サイズ: {summary['total_bytes'] / 1024 / 1024:.1f}MB")
+    print(f"  所要時間: {summary['elapsed']:.1f}秒")
+    print(f"  スループット: {summary['urls_per_minute']:.1f}件/分, "
+          f"{summary['bytes_per_second'] / 1024 / 1024:.2f} MB/s")
+    if summary['avg_first_byte'] is not None:
+        print(f"  最初のバイトまで（平均）: {summary['avg_first_byte']:.2f}秒")
+    for name, seconds in summary['postprocess'].items():
+        print(f"  後処理 {name}: {seconds:.1f}秒")
+    scheduler_stats = summary['scheduler']
+    if scheduler_stats.get('throttled'):
+        print(f"  帯域制限による待ち時間: {scheduler_stats['throttled']:.1f}秒")
+    if scheduler_stats.get('disk_waits'):
+        print(f"  空き容量待ち: {scheduler_stats['disk_waits']}回")
+    if scheduler_stats.get('postprocess_wait'):
+        print(f"  後処理（順番待ちを含む）: {scheduler_stats['postprocess_wait']:.1f}秒")
+    if summary['cache_hits'] or summary['cache_misses']:
+        print(f"  メタデータキャッシュ: ヒット {summary['cache_hits']}件 / ミス {summary['cache_misses']}件")
+    if summary['store_hits']:
+        print(f"  ストアからリンク（ダウンロードなし）: {summary['store_hits']}件")
+    if summary['retries']:
+        print(f"  リトライ: {summary['retries']}回（待ち時間 {summary['backoff']:.1f}秒）")
+    if summary['disk_written']:
+        print(f"  ディスクへの書き込み: {summary['disk_written'] / 1024 / 1024:.1f}MB"
+              f"（1件あたりの使用量のピーク 最大 {summary['disk_peak'] / 1024 / 1024:.1f}MB）")
+    for failure in summary['failures']:
+        print(f"  ❌ {failure['url']}: {failure['error']}")
+
+
+def build_export_opts(options=None):
+    """
+    動画情報のエクスポート用のyt-dlpオプションを作成する
+
+    メディアは扱わないため、形式の取得に必要な処理（EJSソルバー、プレーヤーのJS、マニフェスト）は使わない
+    """
+    options = {**DEFAULT_DOWNLOAD_OPTIONS, **(options or {})}
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'skip_download': True,
+        'ignore_no_formats_error': True,
+        'extractor_args': EXPORT_EXTRACTOR_ARGS,
+        'nocheckcertificate': True,
+        'geo_bypass': True,
+        'retries': YTDL_RETRIES,
+    }
+    if options['extractors']:
+        ydl_opts['allowed_extractors'] = options['extractors']
+    return ydl_opts
+
+
+def _get_export_ydl(ydl_opts):
+    """このワーカー用の、エクスポートの YoutubeDL を取得する（無ければ作成）"""
+    ydl = getattr(_worker_state, 'export_ydl', None)
+    if ydl is None:
+        ydl = _worker_state.export_ydl = create_ydl(ydl_opts)
+        with _worker_ydls_lock:
+            _worker_ydls.append(ydl)
+    return ydl
+
+
+def _export_value(value, kind):
+    """値をエクスポートの列の型（EXPORT_COLUMNS）にする（変換できなければNone）"""
+    if value is None:
+        return None
+    try:
+        if kind == 'int64':
+            return int(value)
+        if kind == 'double':
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if isinstance(value, str) else str(value)
+
+
+def export_row(info, columns, playlist=None):
+    """
+    info dict（または平坦なエントリ）から、columns の列のエクスポートの行を作る
+
+    playlist_id はエントリを取り出したプレイリストのもの。チャンネルの動画一覧のエントリは
+    投稿者の列を含まないことが多いため、チャンネルのものを使う
+    """
+    channel = playlist if playlist and playlist.get('channel_id') == playlist.get('id') else {}
+    row = {}
+    for name in columns:
+        value = info.get(name)
+        if value is None and name == 'playlist_id' and playlist:
+            value = playlist.get('id')
+        elif value is None and name in ('uploader', 'channel', 'channel_id'):
+            value = channel.get(name)
+        elif name == 'webpage_url' and value:
+            # プレイリストの抽出器がエントリのURLに付けた情報は除く
+            value = yt_dlp.utils.unsmuggle_url(value)[0]
+        row[name] = _export_value(value, EXPORT_COLUMNS[name])
+    return row
+
+
+def flat_entry_info(entry):
+    """
+    プレイリストの平坦なエントリ（_type が url のもの）を、動画を抽出せずに書き出せるなら、そのinfo dictを返す
+
+    抽出器が動画だけを返すもの（チャンネルのタブや入れ子のプレイリストではないもの）に限る
+    """
+    ie_key = entry.get('ie_key')
+    if not ie_key or yt_dlp.extractor.get_info_extractor(ie_key)._RETURN_TYPE != 'video':
+        return None
+    return {**entry, 'webpage_url': entry.get('webpage_url') or entry['url'],
+            'extractor_key': entry.get('extractor_key') or ie_key}
+
+
+def iter_playlist_entries(playlist):
+    """プレイリストのエントリを、取得したページを保持せずに順に返す"""
+    entries = playlist.get('entries') or []
+    if isinstance(entries, yt_dlp.utils.PagedList):
+        # getslice はリストにまとめてしまうため、ページを順に取得するジェネレータを使う
+        entries = entries._getslice(0, None)
+    for entry in entries:
+        if entry:
+            yield entry, playlist
+
+
+def _export_job(url, playlist, ydl_opts, columns):
+    """
+    エクスポートの1件（URL）を抽出する（ワーカー内で実行）
+
+    形式の選択（process_ie_result）は行わない。メタデータキャッシュにあればそれを使う。
+    失敗しても例外は投げず、error の列に記録した行を返す
+
+    Returns:
+        ('row', 行) または ('playlist', エントリを展開していないプレイリストのinfo dict)
+    """
+    try:
+        info = metadata_cache.get(metadata_cache_key(url)) if metadata_cache is not None else None
+        if info is None:
+            ydl = _get_export_ydl(ydl_opts)
+            extractor_calls[url] += 1
+            info = ydl.extract_info(url, download=False, process=False)
+            while info.get('_type') in ('url', 'url_transparent'):
+                info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+    except Exception as e:
+        metrics.inc('ytdl_extractor_failures_total', exception=exception_class(e))
+        row = export_row({'webpage_url': url}, columns, playlist)
+        row['error'] = f"{url}: {type(e).__name__}: {e}"
+        return 'row', row
+    if info.get('_type') in PLAYLIST_TYPES:
+        return 'playlist', info
+    return 'row', export_row(info, columns, playlist)
+
+
+class ExportWriter:
+    """
+    エクスポートの行を、届いた順にファイルに書き込む（全件をメモリに保持しない）
+
+    - ndjson: 1行に1件のJSON
+    - parquet / arrow: 列の型を EXPORT_COLUMNS で固定したスキーマで、EXPORT_BATCH_ROWS 件ごとに書き込む
+      （pyarrow が必要）
+    """
+
+    def __init__(self, path, columns, fmt='ndjson'):
+        self.path = path
+        self.columns = columns
+        self.format = fmt
+        self.rows = 0
+        self._batch = []
+        if fmt == 'ndjson':
+            self._file = open(path, 'w', encoding='utf-8')
+            return
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError(f"{fmt} で書き出すには pyarrow が必要です（pip install pyarrow）")
+        types = {'string': pyarrow.string(), 'int64': pyarrow.int64(), 'double': pyarrow.float64()}
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([(name, types[EXPORT_COLUMNS[name]]) for name in columns])
+        if fmt == 'parquet':
+            self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        else:
+            self._writer = pyarrow.ipc.new_file(path, self._schema)
+
+    def write(self, row):
+        """1行を書き込む"""
+        self.rows += 1
+        if self.format == 'ndjson':
+            self._file.write(json.dumps(row, ensure_ascii=False) + '\n')
+            return
+        self._batch.append(row)
+        if len(self._batch) >= EXPORT_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            self._writer.write_batch(self._pyarrow.RecordBatch.from_pylist(self._batch, schema=self._schema))
+            self._batch = []
+
+    def close(self):
+        """残りの行を書き込んで閉じる"""
+        if self.format == 'ndjson':
+            self._file.close()
+            return
+        self._flush()
+        self._writer.close()
+
+
+def export_metadata(urls, path, columns=EXPORT_DEFAULT_COLUMNS, fmt='ndjson', workers=4, options=None):
+    """
+    動画・プレイリスト・チャンネルのURLから、メディアをダウンロードせずに動画情報を1動画1行で書き出す
+
+    抽出は workers 並列で、形式の選択や署名の解決は行わない（build_export_opts を参照）。
+    プレイリストはエントリを順に取り出しながら処理し、書き出す列が平坦なエントリから取れるもの
+    （EXPORT_FLAT_COLUMNS）だけなら、エントリの動画ごとの抽出もしない。
+    抽出中のURLは workers の2倍まで、行は抽出が終わった順に書き出すため、
+    メモリ使用量はURLやエントリの数にほぼ依存しない
+
+    Args:
+        urls: 動画・プレイリスト・チャンネルのURLのリスト
+        path: 書き出すファイル
+        columns: 書き出す列（EXPORT_COLUMNS を参照。error の列は常に最後に付ける）
+        fmt: ファイルの形式（EXPORT_FORMATS を参照）
+        workers: 同時に抽出する数
+        options: ダウンロードの設定（DEFAULT_DOWNLOAD_OPTIONS を参照。extractors のみ使う）
+
+    Returns:
+        集計結果のdict
+    """
+    columns = [name for name in columns if name != 'error'] + ['error']
+    flat = set(columns) - {'error'} <= set(EXPORT_FLAT_COLUMNS)
+    ydl_opts = build_export_opts(options)
+    writer = ExportWriter(path, columns, fmt)
+    stats = Counter()
+    print(f"\n📤 動画情報のエクスポート開始: {len(urls)}件（スレッド x {workers}）")
+    print(f"📄 出力: {path}（{fmt}、列: {', '.join(columns)}）")
+    if flat:
+        print("⚡ 平坦な列のみのため、プレイリストのエントリは動画ごとに抽出しません")
+    print("-" * 50)
+
+    def write(row, source):
+        writer.write(row)
+        if row['error']:
+            source = 'failed'
+            progress_reporter.log(f"❌ {row['error']}")
+        stats[source] += 1
+        metrics.inc('ytdl_export_rows_total', source=source)
+        if writer.rows % EXPORT_PROGRESS_ROWS == 0:
+            progress_reporter.log(f"📝 {writer.rows}件を書き出しました")
+
+    # 処理するもの（入力のURLと、展開中のプレイリストのエントリ）のイテレータのスタック
+    # 最後に見つかったプレイリストから順に取り出すので、同時に展開するプレイリストは入れ子の深さ分だけ
+    sources = [iter([(url, None) for url in urls])]
+
+    def next_url():
+        """次に抽出するURLを返す（抽出せずに書き出せるエントリはここで書き出す）"""
+        while sources:
+            try:
+                item = next(sources[-1], None)
+            except Exception as e:
+                # プレイリストの続きを取得できなかった場合は、そのプレイリストだけを打ち切る
+                sources.pop()
+                write({**dict.fromkeys(columns), 'error': f"{type(e).__name__}: {e}"}, 'failed')
+                continue
+            if item is None:
+                sources.pop()
+                continue
+            entry, playlist = item
+            if isinstance(entry, str):
+                return entry, playlist
+            if entry.get('_type') in PLAYLIST_TYPES:
+                stats['playlists'] += 1
+                sources.append(iter_playlist_entries(entry))
+            elif entry.get('_type') in ('url', 'url_transparent'):
+                info = flat_entry_info(entry) if flat else None
+                if info is None:
+                    return entry['url'], playlist
+                write(export_row(info, columns, playlist), 'flat')
+            else:
+                # プレイリストの抽出で動画情報まで得られたエントリ
+                write(export_row(entry, columns, playlist), 'extracted')
+        return None
+
+    started = time.monotonic()
+    pending = set()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='export') as executor:
+            while True:
+                while len(pending) < workers * 2:
+                    task = next_url()
+                    if task is None:
+                        break
+                    pending.add(executor.submit(_export_job, *task, ydl_opts, columns))
+                if not pending:
+                    break
+                done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, value = future.result()
+                    if kind == 'playlist':
+                        stats['playlists'] += 1
+                        sources.append(iter_playlist_entries(value))
+                    else:
+                        write(value, 'extracted')
+    finally:
+        writer.close()
+        with _worker_ydls_lock:
+            while _worker_ydls:
+                _worker_ydls.pop().close()
+
+    elapsed = time.monotonic() - started
+    summary = {
+        'rows': writer.rows,
+        'flat': stats['flat'],
+        'extracted': stats['extracted'],
+        'failed': stats['failed'],
+        'playlists': stats['playlists'],
+        'elapsed': elapsed,
+        'rows_per_minute': writer.rows / elapsed * 60 if elapsed > 0 else 0,
+    }
+    print("-" * 50)
+    print("📊 エクスポート集計")
+    print(f"  書き出した行: {summary['rows']}件（抽出なし {summary['flat']}件 / 抽出 {summary['extracted']}件 / "
+          f"失敗 {summary['failed']}件）")
+    if summary['playlists']:
+        print(f"  展開したプレイリスト: {summary['playlists']}件")
+    print(f"  所要時間: {elapsed:.1f}秒（{summary['rows_per_minute']:.1f}件/分）")
+    return summary
+
+
+class JobQueue:
+    """
+    デーモンモードのジョブのキュー
+
+    起動時にワーカースレッドごとに YoutubeDL を作成しておき（import・抽出器の登録・JSランタイムの検出は済ませておく）、
+    投入されたジョブはすぐに空いているワーカーが抽出から始める。
+    YoutubeDL は 保存先・フォーマット指定・設定 ごとにワーカー内で使い回す。
+    ジョブの状態はメモリ上に保持し、終了済みのものは DAEMON_JOB_HISTORY 件まで残す。
+    """
+
+    def __init__(self, output_dir="downloads", format_code=None, workers=4, options=None):
+        self.output_dir = output_dir
+        self.format_code = format_code
+        self.options = {**DEFAULT_DOWNLOAD_OPTIONS, **(options or {})}
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._ydls = []
+        self._ready = threading.Barrier(workers + 1)
+        self._threads = [threading.Thread(target=self._worker, name=f'daemon-{i}', daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+        self._ready.wait()
+
+    def _ydl(self, output_dir, format_code, options):
+        """このワーカーの YoutubeDL を取得する（無ければ作成し、古いものから閉じる）"""
+        ydls = self._local.__dict__.setdefault('ydls', {})
+        key = json.dumps([output_dir, format_code, options], sort_keys=True, default=str)
+        ydl = ydls.pop(key, None)
+        if ydl is None:
+            ydl_opts = build_download_opts(output_dir, format_code, options)
+            ydl_opts.update({'quiet': True, 'no_warnings': True})
+            ydl = create_ydl(ydl_opts)
+            with self._lock:
+                self._ydls.append(ydl)
+            if len(ydls) >= DAEMON_WARM_INSTANCES:
+                oldest = ydls.pop(next(iter(ydls)))
+                with self._lock:
+                    self._ydls.remove(oldest)
+                oldest.close()
+        # 最近使ったものを末尾に置く
+        ydls[key] = ydl
+        return ydl
+
+    def submit(self, request):
+        """
+        ジョブを投入する
+
+        Args:
+            request: {'url': URL, 'format': フォーマット, 'output_dir': 保存先,
+                      'subtitle_langs': [言語, ...], 'profile': プロファイル}（url 以外は省略可）
+                     output_dir はデーモンの保存先からの相対パスで、その外は指定できない
+
+        Returns:
+            ジョブの状態のdict
+
+        Raises:
+            ValueError: 指定が不正な場合
+        """
+        if not isinstance(request, dict):
+            raise ValueError("ジョブはJSONのオブジェクトで指定してください")
+        url = request.get('url')
+        if not isinstance(url, str) or not url.strip():
+            raise ValueError("url を指定してください")
+        langs = request.get('subtitle_langs', self.options['subtitle_langs'])
+        if isinstance(langs, str):
+            langs = [lang for lang in langs.split(',') if lang]
+        if not isinstance(langs, list) or not all(isinstance(lang, str) for lang in langs):
+            raise ValueError("subtitle_langs は言語のリストで指定してください")
+        for key in ('format', 'output_dir', 'profile'):
+            if request.get(key) is not None and not isinstance(request[key], str):
+                raise ValueError(f"{key} は文字列で指定してください")
+        profile = request.get('profile') or self.options['profile']
+        if profile not in PROFILES:
+            raise ValueError(f"不明なプロファイル: {profile}（{', '.join(PROFILES)}）")
+        output_dir = self.output_dir
+        if request.get('output_dir'):
+            base = Path(self.output_dir).resolve()
+            output_dir = (base / request['output_dir']).resolve()
+            if not output_dir.is_relative_to(base):
+                raise ValueError(f"output_dir はデーモンの保存先（{self.output_dir}）の中を指定してください")
+            output_dir = str(output_dir)
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'url': url.strip(),
+            'format': request.get('format') or self.format_code,
+            'output_dir': output_dir,
+            'subtitle_langs': langs,
+            'profile': profile,
+            'status': 'queued',
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'title': None,
+            'bytes': 0,
+            'files': [],
+            'first_byte': None,
+            'skipped': False,
+            'retries': 0,
+            'backoff': 0.0,
+            'disk_written': 0,
+            'disk_peak': 0,
+            'error': None,
+        }
+        with self._lock:
+            self.jobs[job['id']] = job
+            self._forget_finished()
+            snapshot = dict(job)
+        self._queue.put(job)
+        return snapshot
+
+    def _forget_finished(self):
+        """終了済みのジョブを古いものから消して DAEMON_JOB_HISTORY 件にする（_lock を取得して呼ぶ）"""
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - DAEMON_JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        """ジョブの状態（無ければNone）"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        """全ジョブの状態（投入順）"""
+        with self._lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    @property
+    def pending(self):
+        """開始を待っているジョブの数"""
+        return self._queue.qsize()
+
+    def _update(self, job, **values):
+        with self._lock:
+            job.update(values)
+
+    def _worker(self):
+        """ジョブを1件ずつ取り出して実行する"""
+        # 最初のジョブで YoutubeDL の作成を待たないよう、デフォルトの設定で作っておく
+        try:
+            self._ydl(self.output_dir, self.format_code, self.options)
+        except Exception as e:
+            progress_reporter.log(f"⚠️ YoutubeDL を準備できません（ジョブの実行時に再作成します）: {e}")
+        self._ready.wait()
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            self._update(job, status='running', started=time.time())
+            progress_reporter.log(f"📥 [{job['id'][:8]}] 開始: {job['url']}")
+            try:
+                Path(job['output_dir']).mkdir(parents=True, exist_ok=True)
+                options = {**self.options, 'subtitle_langs': job['subtitle_langs'], 'profile': job['profile']}
+                ydl = self._ydl(job['output_dir'], job['format'], options)
+                # フォーマット指定が無い場合のみ mp4 への後処理を行う
+                target_ext = None if job['format'] else TARGET_EXT
+                pipeline = run_pipeline(ydl, job['url'], job['output_dir'], verbose=False,
+                                        target_ext=target_ext, options=options)
+            except Exception as e:
+                self._update(job, status='failed', finished=time.time(), error=f"{type(e).__name__}: {e}")
+                progress_reporter.log(f"❌ [{job['id'][:8]}] {job['url']}: {job['error']}")
+                continue
+            self._update(
+                job, status='done', finished=time.time(), title=pipeline['info'].get('title'),
+                bytes=pipeline['bytes'], first_byte=pipeline['first_byte'], skipped=pipeline['skipped'],
+                files=pipeline['files'], retries=pipeline['retries'], backoff=pipeline['backoff'],
+                disk_written=pipeline['disk_written'], disk_peak=pipeline['disk_peak'])
+            progress_reporter.log(
+                f"✓ [{job['id'][:8]}] {job['title'] or job['url']} ({job['bytes'] / 1024 / 1024:.1f}MB)")
+
+    def shutdown(self):
+        """実行中のジョブが終わるのを待ってワーカーを止め、YoutubeDL を閉じる（未開始のジョブは破棄する）"""
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            while self._ydls:
+                self._ydls.pop().close()
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unixソケットで待ち受けるHTTPサーバー"""
+    daemon_threads = True
+
+
+def is_local_host(value):
+    """Host / Origin ヘッダーの値がこのマシン（DAEMON_LOCAL_HOSTS）を指しているか"""
+    if '://' not in value:
+        value = '//' + value
+    try:
+        return urllib.parse.urlsplit(value).hostname in DAEMON_LOCAL_HOSTS
+    except ValueError:
+        return False
+
+
+def write_daemon_token(path=None):
+    """新しいトークンを作成し、本人だけが読めるファイル（0600）に書き込んで返す"""
+    path = Path(path or CACHE_DIR / DAEMON_TOKEN_FILE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    token = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        # 既にあったファイルは作成時のモードが使われないため、改めて設定する
+        os.fchmod(f.fileno(), 0o600)
+        f.write(token + '\n')
+    return token
+
+
+def make_daemon_handler(job_queue, token=None):
+    """
+    デーモンモードのAPIのハンドラー
+
+    POST /jobs        ジョブを投入（202 とジョブの状態を返す）
+    GET  /jobs        全ジョブの状態
+    GET  /jobs/<id>   ジョブの状態
+    GET  /metrics     メトリクス（Prometheusのテキスト形式）
+
+    Host / Origin がこのマシン以外のリクエストは 403 で拒否する。
+    token を指定した場合、/jobs へのリクエストには `Authorization: Bearer <token>` が必要（無ければ 401）。
+    POST /jobs の本体は Content-Type: application/json に限る（ブラウザのフォームや text/plain の投入を防ぐ）
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def _authorized(self, path):
+            """リクエストを受け付けるか確認し、拒否する場合はエラーを返してFalse"""
+            origin = self.headers.get('Origin')
+            if not is_local_host(self.headers.get('Host') or '') or (origin is not None and not is_local_host(origin)):
+                self._json(403, {'error': 'このマシン以外からのリクエストは受け付けません'})
+                return False
+            if token is not None and (path == '/jobs' or path.startswith('/jobs/')):
+                auth = self.headers.get('Authorization') or ''
+                if not hmac.compare_digest(auth.encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+                    self._json(401, {'error': 'トークンが正しくありません'})
+                    return False
+            return True
+
+        def do_GET(self):
+            path = self.path.split('?')[0].rstrip('/')
+            if not self._authorized(path):
+                return
+            if path == '/jobs':
+                self._json(200, {'jobs': job_queue.list()})
+            elif path.startswith('/jobs/'):
+                job = job_queue.get(path[len('/jobs/'):])
+                if job is None:
+                    self._json(404, {'error': 'ジョブが見つかりません'})
+                else:
+                    self._json(200, job)
+            elif path == '/metrics':
+                self._send(200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode('utf-8'))
+            else:
+                self._json(404, {'error': 'Not Found'})
+
+        def do_POST(self):
+            path = self.path.split('?')[0].rstrip('/')
+            if not self._authorized(path):
+                return
+            if path != '/jobs':
+                self._json(404, {'error': 'Not Found'})
+                return
+            content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+            if content_type != 'application/json':
+                self._json(415, {'error': 'Content-Type: application/json で送信してください'})
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                job = job_queue.submit(json.loads(body or b'{}'))
+            except ValueError as e:
+                self._json(400, {'error': str(e)})
+                return
+            self._json(202, job)
+
+        def _json(self, status, data):
+            self._send(status, 'application/json; charset=utf-8',
+                       json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+        def _send(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def run_daemon(output_dir="downloads", format_code=None, workers=4, options=None, port=DAEMON_PORT,
+               socket_path=None):
+    """
+    デーモンモード: ジョブを受け付けるAPIを起動し、Ctrl+C まで動き続ける
+
+    Args:
+        output_dir: ジョブで保存先を省略した場合の保存先
+        format_code: ジョブでフォーマットを省略した場合のフォーマット
+        workers: 同時に処理するジョブの数
+        options: ダウンロードの設定（DEFAULT_DOWNLOAD_OPTIONS を参照）
+        port: APIのポート（127.0.0.1 で待ち受ける）
+        socket_path: 指定した場合はポートではなくこのUnixソケットで待ち受ける
+
+    ポートで待ち受ける場合は、ジョブのAPIに必要なトークンを CACHE_DIR の DAEMON_TOKEN_FILE に書き込む。
+    Unixソケットは本人だけが接続できる（0600）ため、トークンは使わない
+    """
+    Path(output_dir).mkdir(exist_ok=True)
+    started = time.monotonic()
+    # 後処理の順番待ちのスレッドがいてもダウンロードの枠が埋まるよう、後処理の分も増やす（バッチと同じ）
+    job_queue = JobQueue(output_dir, format_code, workers + download_scheduler.max_postprocess, options)
+    metrics.set_gauge('ytdl_queue_pending', lambda: job_queue.pending)
+
+    token_path = CACHE_DIR / DAEMON_TOKEN_FILE
+    if socket_path:
+        handler = make_daemon_handler(job_queue)
+        # 前回の実行で残ったソケットファイルは消してから待ち受ける
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        # bind で作られた時点から本人だけが接続できるよう、umask で 0600 にする
+        umask = os.umask(0o177)
+        try:
+            server = UnixHTTPServer(socket_path, handler)
+        finally:
+            os.umask(umask)
+        address = f"unix:{socket_path}"
+    else:
+        from http.server import ThreadingHTTPServer
+        handler = make_daemon_handler(job_queue, write_daemon_token(token_path))
+        server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        server.daemon_threads = True
+        address = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"\n🛰️ デーモンモード: {address}（ワーカー x {workers}、起動 {time.monotonic() - started:.2f}秒）")
+    print(f"📁 保存先: {output_dir}/")
+    if socket_path:
+        print(f"💡 ジョブの投入: curl --unix-socket {socket_path} http://localhost/jobs "
+              f"-H 'Content-Type: application/json' -d '{{\"url\": \"URL\"}}'")
+    else:
+        print(f"🔑 トークン: {token_path}")
+        print(f"💡 ジョブの投入: curl {address}/jobs -H \"Authorization: Bearer $(cat {token_path})\" "
+              f"-H 'Content-Type: application/json' -d '{{\"url\": \"URL\"}}'")
+    print("-" * 50)
+
+    def stop(signum, frame):
+        # serve_forever を実行しているスレッドからは shutdown できないため、別のスレッドで止める
+        threading.Thread(target=server.shutdown).start()
+
+    # SIGTERM（systemd などからの停止）でも Ctrl+C と同じように止める
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("\n⚠️ 停止します（実行中のジョブが終わるのを待っています）")
+        server.server_close()
+        if socket_path:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+        job_queue.shutdown()
+        metrics.set_gauge('ytdl_queue_pending', 0)
+
+
+class SharedJobQueue:
     """
-    字幕をダウンロードする（失敗しても続行）
+    複数のマシンのワーカーで共有するジョブのキュー（SQLite）
+
+    - 共有のファイルシステム（NFSなど）に置いたSQLiteファイルを、各マシンのワーカーが直接開く。
+      WALは同じマシンのプロセス間でしか使えないため、ロールバックジャーナルとファイルのロックを使う
+    - ワーカーはジョブを借りて（lease）実行する。借りたジョブは期限（available）まで他のワーカーから見えなくなり、
+      実行中は renew で期限を延ばす。ワーカーが止まって延長されなくなったジョブは、期限が切れると別のワーカーが借りる
+    - 完了は動画（アーカイブのID: 抽出器 + 動画ID）ごとに1回だけ記録する。
+      URLから動画IDが分かるジョブは、完了済みの動画や別のワーカーが実行中の動画なら借りないため、同じ動画を2台でダウンロードしない
+    - 失敗したジョブは QUEUE_RETRY_DELAY 秒（回数に比例）後にやり直し、max_attempts 回で failed にする
+    - リースの期限はマシンの時計で判定するため、各マシンの時計は合わせておく（NTPなど）
     """
-    video_id = info.get('id')
-    title = info.get('title', 'Unknown')
-    base_filename = f"{title}_{video_id}"
 
-    subtitle_opts = {
-        'writesubtitles': True,
-        'writeautomaticsub': True,
-        'subtitleslangs': ['ja', 'en'],
-        'outtmpl': f'{output_dir}/{base_filename}.%(ext)s',
-        'quiet': True,
-        'no_warnings': True,
-        'skip_download': True,  # 動画はダウンロードしない
-        'nocheckcertificate': True,
-        'geo_bypass': True,
+    def __init__(self, path, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY,
+                    url TEXT NOT NULL UNIQUE,
+                    video_id TEXT,
+                    state TEXT NOT NULL,
+                    available REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    token TEXT,
+                    enqueued REAL NOT NULL,
+                    finished REAL,
+                    result TEXT,
+                    error TEXT
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, available)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_video ON jobs (video_id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS videos (
+                    video_id TEXT PRIMARY KEY,
+                    job_id INTEGER NOT NULL,
+                    owner TEXT NOT NULL,
+                    completed REAL NOT NULL
+                ) WITHOUT ROWID""")
+
+    @property
+    def config(self):
+        """別のプロセスで同じキューを開くための設定"""
+        return {'path': str(self.path), 'lease_seconds': self.lease_seconds, 'max_attempts': self.max_attempts}
+
+    def _connect(self):
+        """
+        スレッド/プロセスごとの接続を返す
+
+        トランザクションは各メソッドで BEGIN IMMEDIATE から始める（読んでから更新するまでに他のワーカーが割り込まない）
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, urls):
+        """URLのジョブを追加し、追加した件数を返す（既にあるURLは追加しない）"""
+        now = time.time()
+        rows = [(url, archive_id_for_url(url), now, now) for url in urls]
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs (url, video_id, state, available, enqueued) VALUES (?, ?, 'queued', ?, ?)",
+                rows)
+            return conn.total_changes - before
+
+    def lease(self, owner):
+        """
+        実行できるジョブを1件借りる（無ければNone）
+
+        待っているジョブと、リースの期限が切れたジョブから、古いものを選ぶ。
+        動画が完了済みのジョブは実行せずに完了（duplicate）にし、
+        実行回数が max_attempts に達したジョブ（期限切れを繰り返したもの）は failed にする
+
+        Returns:
+            {'id', 'url', 'video_id', 'attempts', 'token'}
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            while True:
+                now = time.time()
+                row = conn.execute("""
+                    SELECT id, url, video_id, attempts FROM jobs
+                    WHERE state IN ('queued', 'leased') AND available <= ?
+                      AND (video_id IS NULL OR NOT EXISTS (
+                          SELECT 1 FROM jobs AS other
+                          WHERE other.video_id = jobs.video_id AND other.id != jobs.id
+                            AND other.state = 'leased' AND other.available > ?))
+                    ORDER BY available, id LIMIT 1""", (now, now)).fetchone()
+                if row is None:
+                    return None
+                job_id, url, video_id, attempts = row
+                if video_id is not None and conn.execute(
+                        "SELECT 1 FROM videos WHERE video_id = ?", (video_id,)).fetchone():
+                    conn.execute(
+                        "UPDATE jobs SET state = 'done', finished = ?, result = ?, owner = NULL, token = NULL "
+                        "WHERE id = ?", (now, json.dumps({'duplicate': True}), job_id))
+                    continue
+                if attempts >= self.max_attempts:
+                    conn.execute(
+                        "UPDATE jobs SET state = 'failed', finished = ?, owner = NULL, token = NULL, "
+                        "error = COALESCE(error, ?) WHERE id = ?",
+                        (now, "リースの期限切れが続いたため中止しました", job_id))
+                    continue
+                token = uuid.uuid4().hex
+                conn.execute(
+                    "UPDATE jobs SET state = 'leased', available = ?, attempts = attempts + 1, owner = ?, token = ? "
+                    "WHERE id = ?", (now + self.lease_seconds, owner, token, job_id))
+                return {'id': job_id, 'url': url, 'video_id': video_id, 'attempts': attempts + 1, 'token': token}
+
+    def renew(self, job):
+        """
+        リースの期限を延ばす
+
+        期限が切れたリースは、別のワーカーが同じ動画のジョブを借りているかもしれないため延ばさない
+
+        Returns:
+            延ばせたか（期限が切れた・別のワーカーに移った場合は False）
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(
+                "UPDATE jobs SET available = ? WHERE id = ? AND token = ? AND state = 'leased' AND available > ?",
+                (now + self.lease_seconds, job['id'], job['token'], now))
+            return cursor.rowcount == 1
+
+    def claim(self, job, video_id):
+        """
+        抽出して分かった動画のアーカイブのIDをジョブに記録し、その動画をダウンロードしてよいか確かめる
+
+        追加したときにURLから動画IDが分からなかったジョブは lease で重複を除けないため、ダウンロードの前に呼ぶ
+
+        Returns:
+            'ok'（ダウンロードする）、'duplicate'（別のジョブで完了済み。このジョブは完了にした）、
+            'busy'（別のワーカーが実行中。このジョブは待ちに戻した）、
+            または 'lost'（リースが別のワーカーに移っていた）
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(
+                "UPDATE jobs SET video_id = ? WHERE id = ? AND token = ? AND state = 'leased' AND available > ?",
+                (video_id, job['id'], job['token'], now))
+            if cursor.rowcount != 1:
+                return 'lost'
+            if conn.execute("SELECT 1 FROM videos WHERE video_id = ?", (video_id,)).fetchone():
+                conn.execute(
+                    "UPDATE jobs SET state = 'done', finished = ?, result = ?, owner = NULL, token = NULL "
+                    "WHERE id = ?", (now, json.dumps({'duplicate': True}), job['id']))
+                return 'duplicate'
+            if conn.execute(
+                    "SELECT 1 FROM jobs WHERE video_id = ? AND id != ? AND state = 'leased' AND available > ?",
+                    (video_id, job['id'], now)).fetchone():
+                # 実行中のジョブが完了すれば、次に借りたときに lease が完了済み（duplicate）にする。
+                # この回は実行回数に数えない
+                conn.execute(
+                    "UPDATE jobs SET state = 'queued', available = ?, attempts = attempts - 1, owner = NULL, "
+                    "token = NULL WHERE id = ?", (now + QUEUE_POLL_INTERVAL, job['id']))
+                return 'busy'
+        job['video_id'] = video_id
+        return 'ok'
+
+    def complete(self, job, video_id=None, result=None):
+        """
+        ジョブを完了にする
+
+        Args:
+            video_id: 抽出した動画のアーカイブのID（Noneならジョブを追加したときにURLから求めたもの）
+            result: 記録する結果（JSONにできるdict）
+
+        Returns:
+            'done'（この動画の完了を初めて記録した）、'duplicate'（別のジョブで完了済み）、
+            または 'lost'（リースが別のワーカーに移っていたため記録しなかった）
+        """
+        video_id = video_id or job['video_id']
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # 先に videos の記録を確かめておき、ジョブを更新できなかった（リースを失った）場合は何も記録しない
+            first = video_id is None or conn.execute(
+                "SELECT 1 FROM videos WHERE video_id = ?", (video_id,)).fetchone() is None
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'done', finished = ?, result = ?, error = NULL, token = NULL, "
+                "video_id = COALESCE(video_id, ?) WHERE id = ? AND token = ?",
+                (now, json.dumps({**(result or {}), 'duplicate': not first}, ensure_ascii=False), video_id,
+                 job['id'], job['token']))
+            if cursor.rowcount != 1:
+                return 'lost'
+            if first and video_id is not None:
+                conn.execute(
+                    "INSERT INTO videos (video_id, job_id, owner, completed) "
+                    "SELECT ?, id, COALESCE(owner, ''), ? FROM jobs WHERE id = ?", (video_id, now, job['id']))
+        return 'done' if first else 'duplicate'
+
+    def fail(self, job, error):
+        """
+        ジョブの失敗を記録し、やり直すなら待っているジョブに戻す
+
+        Returns:
+            'retry'（やり直す）、'failed'（max_attempts 回に達した）、
+            または 'lost'（リースが別のワーカーに移っていたため記録しなかった）
+        """
+        now = time.time()
+        state = 'queued' if job['attempts'] < self.max_attempts else 'failed'
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(
+                "UPDATE jobs SET state = ?, available = ?, finished = ?, error = ?, owner = NULL, token = NULL "
+                "WHERE id = ? AND token = ?",
+                (state, now + QUEUE_RETRY_DELAY * job['attempts'], now if state == 'failed' else None, error,
+                 job['id'], job['token']))
+            if cursor.rowcount != 1:
+                return 'lost'
+        return 'retry' if state == 'queued' else 'failed'
+
+    def counts(self):
+        """状態ごとのジョブの数（leased のうち期限が切れたものは expired としても数える）"""
+        conn = self._connect()
+        counts = dict.fromkeys(('queued', 'leased', 'done', 'failed'), 0)
+        counts.update(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        counts['expired'] = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'leased' AND available <= ?", (time.time(),)).fetchone()[0]
+        return counts
+
+    def failures(self, limit=10):
+        """失敗したジョブ（新しい順）"""
+        rows = self._connect().execute(
+            "SELECT url, error FROM jobs WHERE state = 'failed' ORDER BY finished DESC LIMIT ?", (limit,))
+        return [{'url': url, 'error': error} for url, error in rows]
+
+
+def configure_queue(path, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+    """共有のジョブのキューを開く"""
+    global shared_queue
+    shared_queue = SharedJobQueue(path, lease_seconds, max_attempts)
+    return shared_queue
 
-        # YouTubeの署名/nチャレンジを解くためのEJSスクリプトを取得
-        'remote_components': ['ejs:github'],
-    }
 
+def queue_urls(urls, options=None, ydl=None):
+    """
+    キューに追加するURLを返す（ジェネレータ）
+
+    各マシンのワーカーが動画ごとにジョブを分け合えるよう、プレイリスト・チャンネルは動画ごとのURLに展開する。
+    展開はエクスポートと同じく平坦に行い、動画ごとの抽出はしない
+    """
+    options = {**DEFAULT_DOWNLOAD_OPTIONS, **(options or {})}
+    own_ydl = ydl is None
     try:
-        print("📝 字幕ダウンロード中...")
-        with yt_dlp.YoutubeDL(subtitle_opts) as ydl:
-            ydl.download([url])
-        print("✓ 字幕ダウンロード完了")
-    except Exception as e:
-        print(f"⚠️ 字幕ダウンロード失敗（ダウンロードは続行）: {e}")
+        for url in urls:
+            ie_key, _ = url_video_id(url, options['extractors'])
+            if ie_key and yt_dlp.extractor.get_info_extractor(ie_key)._RETURN_TYPE == 'video':
+                yield url
+                continue
+            if ydl is None:
+                ydl = create_ydl(build_export_opts(options))
+            try:
+                info = ydl.extract_info(url, download=False, process=False)
+                while info.get('_type') in ('url', 'url_transparent'):
+                    info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+            except yt_dlp.utils.DownloadError:
+                # 展開できないURLもそのまま追加し、ワーカーでのエラーとして記録する
+                yield url
+                continue
+            if info.get('_type') not in PLAYLIST_TYPES:
+                yield url
+                continue
+            sources = [iter_playlist_entries(info)]
+            while sources:
+                item = next(sources[-1], None)
+                if item is None:
+                    sources.pop()
+                    continue
+                entry, _ = item
+                if entry.get('_type') in PLAYLIST_TYPES:
+                    sources.append(iter_playlist_entries(entry))
+                elif entry.get('_type') not in ('url', 'url_transparent'):
+                    yield entry.get('webpage_url') or url
+                elif entry.get('ie_key') and not flat_entry_info(entry):
+                    # チャンネルのタブなど、入れ子のプレイリスト
+                    yield from queue_urls([entry['url']], options, ydl)
+                else:
+                    yield yt_dlp.utils.unsmuggle_url(entry['url'])[0]
+    finally:
+        if own_ydl and ydl is not None:
+            ydl.close()
 
 
-def download_video(url, output_dir="downloads"):
+def run_worker(queue, output_dir="downloads", format_code=None, workers=4, options=None, exit_when_empty=False):
     """
-    YouTube動画をダウンロードする
+    ワーカーモード: 共有のキューからジョブを借りてダウンロードし続ける
+
+    同じキューを開いた複数のマシンで実行すると、ジョブを分け合ってダウンロードする。
+    各ジョブはバッチモードと同じ _batch_job で実行し、実行中のリースは別のスレッドが延長する。
+    リースを延長できなかった（別のワーカーに移った）ジョブは、ダウンロードを止める（cancel_hook）。
+    URLから動画IDが分からなかったジョブは、抽出した後ダウンロードの前に SharedJobQueue.claim で重複を確かめる。
+    Ctrl+C / SIGTERM では新しいジョブを借りるのをやめ、実行中のジョブが終わるのを待って止まる
 
     Args:
-        url: YouTube動画のURL
+        queue: 共有のキュー（SharedJobQueue）
         output_dir: ダウンロード先ディレクトリ
+        format_code: 特定のフォーマットID（Noneなら自動選択）
+        workers: 同時に処理するジョブの数
+        options: ダウンロードの設定（DEFAULT_DOWNLOAD_OPTIONS を参照）
+        exit_when_empty: 待っているジョブも実行中のジョブも無くなったら終了する
+
+    Returns:
+        集計結果のdict
     """
-    # ダウンロード先ディレクトリを作成
     Path(output_dir).mkdir(exist_ok=True)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    job_opts = batch_job_opts(output_dir, format_code, workers, options=options)
+    stop = threading.Event()
+    active = {}
+    active_lock = threading.Lock()
+    stats = Counter()
 
-    # yt-dlpの設定オプション
-    ydl_opts = {
-        # 出力ファイル名のテンプレート
-        'outtmpl': f'{output_dir}/%(title)s_%(id)s.%(ext)s',
-
-        # フォーマット選択（より柔軟な設定）
-        # 動画+音声の組み合わせを優先し、フォールバックを追加
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/bestvideo+bestaudio/best',
+    print(f"\n🛰️ ワーカーモード: {queue.path}（{owner}、ワーカー x {workers}）")
+    print(f"📁 保存先: {output_dir}/")
+    print("-" * 50)
 
-        # 字幕は別途ダウンロードするため、ここでは無効
-        'writesubtitles': False,
-        'writeautomaticsub': False,
+    def renew_leases():
+        # 実行中のジョブのリースをまとめて延長する
+        while not stop.wait(QUEUE_RENEW_INTERVAL):
+            with active_lock:
+                jobs = list(active.values())
+            for job in jobs:
+                try:
+                    renewed = queue.renew(job)
+                except sqlite3.Error as e:
+                    progress_reporter.log(f"⚠️ リースを延長できません（次の間隔でやり直します）: {e}")
+                    continue
+                if not renewed:
+                    # 別のワーカーが同じ動画をダウンロードしないよう、このワーカーでのダウンロードを止める
+                    job['cancel'].set()
+                    metrics.inc('ytdl_queue_lease_lost_total')
+                    progress_reporter.log(f"⚠️ [{job['id']}] リースが別のワーカーに移ったため中止します: {job['url']}")
 
-        # サムネイルを埋め込む
-        'writethumbnail': True,
-        'embedthumbnail': True,
+    def record(func, job, *args):
+        # 結果をキューに記録する（記録できなければ 'lost'。リースの期限切れで別のワーカーがやり直す）
+        for attempt in range(1, QUEUE_RECORD_RETRIES + 1):
+            try:
+                return func(job, *args)
+            except sqlite3.Error as e:
+                progress_reporter.log(f"⚠️ [{job['id']}] 結果をキューに記録できません"
+                                      f"（{attempt}/{QUEUE_RECORD_RETRIES}、{QUEUE_POLL_INTERVAL:.0f}秒後にやり直します）: {e}")
+                # 停止の要求があっても結果は記録したいため、stop ではなく sleep で待つ
+                time.sleep(QUEUE_POLL_INTERVAL)
+        return 'lost'
 
-        # メタデータを保持
-        'keepvideo': True,
-        'addmetadata': True,
+    def claim_video(job, info):
+        # 追加したときに動画IDが分からなかったジョブだけ、抽出した動画で重複を確かめる
+        if job['video_id'] is not None or not (info.get('extractor_key') and info.get('id')):
+            return True
+        video_id = yt_dlp.utils.make_archive_id(info['extractor_key'], info['id'])
+        if download_archive is not None and video_id in download_archive:
+            job['claimed'] = record(queue.complete, job, video_id, {'skipped': True, 'owner': owner})
+        else:
+            job['claimed'] = record(queue.claim, job, video_id)
+        return job['claimed'] == 'ok'
 
-        # プログレスフック
-        'progress_hooks': [progress_hook],
+    def work():
+        while not stop.is_set():
+            try:
+                job = queue.lease(owner)
+                if job is None:
+                    counts = queue.counts()
+                    if exit_when_empty and not counts['queued'] and not counts['leased']:
+                        break
+                    stop.wait(QUEUE_POLL_INTERVAL)
+                    continue
+            except sqlite3.Error as e:
+                progress_reporter.log(f"⚠️ キューを読めません（{QUEUE_POLL_INTERVAL:.0f}秒後にやり直します）: {e}")
+                stop.wait(QUEUE_POLL_INTERVAL)
+                continue
 
-        # エラー時も続行
-        'ignoreerrors': False,
+            progress_reporter.log(f"📥 [{job['id']}] 開始（{job['attempts']}回目）: {job['url']}")
+            job['cancel'] = threading.Event()
+            job['claimed'] = None
+            with active_lock:
+                active[job['id']] = job
+            # 結果を記録するまではリースを延長し続ける
+            _job_state.cancel = job['cancel']
+            _job_state.claim_video = functools.partial(claim_video, job)
+            try:
+                result = _batch_job(job['url'], job_opts)
+                if job['claimed'] not in (None, 'ok'):
+                    # claim_video で完了・待ちに戻した（またはリースを失った）ジョブは記録済み
+                    outcome = job['claimed']
+                elif result['ok']:
+                    summary = {key: result.get(key) for key in ('title', 'bytes', 'skipped', 'elapsed')}
+                    outcome = record(queue.complete, job, result['archive_id'], {**summary, 'owner': owner})
+                else:
+                    outcome = record(queue.fail, job, result['error'])
+            finally:
+                _job_state.cancel = _job_state.claim_video = None
+                with active_lock:
+                    del active[job['id']]
 
-        # プレイリストの場合は全動画をダウンロード
-        'playlistend': None,
+            if outcome == 'busy':
+                progress_reporter.log(f"⏸️ [{job['id']}] 別のワーカーが同じ動画を実行中のため、後で確かめます: {job['url']}")
+            elif outcome == 'lost':
+                progress_reporter.log(f"⚠️ [{job['id']}] リースが別のワーカーに移ったため、結果を記録しませんでした: {job['url']}")
+            elif result['ok'] or outcome == 'duplicate':
+                size_mb = result['bytes'] / 1024 / 1024
+                mark = '✓' if outcome == 'done' else '⏭️ （別のジョブで完了済み）'
+                progress_reporter.log(f"{mark} [{job['id']}] {result.get('title') or job['url']} ({size_mb:.1f}MB)")
+            else:
+                note = '後でやり直します' if outcome == 'retry' else '中止しました'
+                progress_reporter.log(f"❌ [{job['id']}] {job['url']}: {result['error']}（{note}）")
+            stats[outcome] += 1
+            stats['bytes'] += result['bytes']
+            metrics.inc('ytdl_queue_jobs_total', result=outcome)
 
-        # ffmpegのパス（必要に応じて）
-        # 'ffmpeg_location': '/usr/local/bin/ffmpeg',
+    def request_stop(signum, frame):
+        stop.set()
 
-        # ダウンロード後にffmpegで処理
-        'postprocessors': [
-            {
-                'key': 'FFmpegMetadata',
-                'add_metadata': True,
-            },
-            {
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',
-            },
-        ],
+    # SIGTERM（systemd などからの停止）でも Ctrl+C と同じように止める
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, request_stop)
+    started = time.monotonic()
+    renewer = threading.Thread(target=renew_leases, name='lease-renewer', daemon=True)
+    threads = [threading.Thread(target=work, name=f'worker-{i}') for i in range(workers)]
+    renewer.start()
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if any(thread.is_alive() for thread in threads):
+            print("\n⚠️ 停止します（実行中のジョブが終わるのを待っています）")
+        stop.set()
+        for thread in threads:
+            thread.join()
+        with _worker_ydls_lock:
+            while _worker_ydls:
+                _worker_ydls.pop().close()
 
-        # 静かなモード（False:詳細表示, True:最小限の出力）
-        'quiet': False,
-        'no_warnings': False,
+    summary = {
+        'done': stats['done'],
+        'duplicate': stats['duplicate'],
+        'retry': stats['retry'],
+        'failed': stats['failed'],
+        'lost': stats['lost'],
+        'busy': stats['busy'],
+        'total_bytes': stats['bytes'],
+        'elapsed': time.monotonic() - started,
+        'queue': queue.counts(),
+    }
+    print("-" * 50)
+    print("📊 ワーカー集計")
+    print(f"  完了: {summary['done']}件（別のジョブで完了済み {summary['duplicate']}件）")
+    if summary['busy']:
+        print(f"  別のワーカーが実行中のため待ちに戻した: {summary['busy']}件")
+    print(f"  失敗: {summary['failed']}件（キューに戻した {summary['retry']}件）")
+    if summary['lost']:
+        print(f"  記録できなかった: {summary['lost']}件（リースが別のワーカーに移った）")
+    print(f"  合計サイズ: {summary['total_bytes'] / 1024 / 1024:.1f}MB")
+    print(f"  所要時間: {summary['elapsed']:.1f}秒")
+    print_queue_counts(summary['queue'])
+    return summary
 
-        # その他のオプション
-        'nocheckcertificate': True,
-        'geo_bypass': True,
 
-        # YouTubeの署名/nチャレンジを解くためのEJSスクリプトを取得
-        # （これが無いと一部フォーマットのURLが無効になり HTTP 403 で停止する）
-        'remote_components': ['ejs:github'],
+def print_queue_counts(counts):
+    """共有のキューのジョブの数を表示"""
+    print(f"  キュー: 待ち {counts['queued']}件 / 実行中 {counts['leased']}件"
+          f"（期限切れ {counts['expired']}件） / 完了 {counts['done']}件 / 失敗 {counts['failed']}件")
 
-        # 通信エラー/403対策のリトライ
-        'retries': 10,
-        'fragment_retries': 10,
-        'file_access_retries': 5,
 
-        # ブラウザのCookieを使用（必要に応じて）
-        # 'cookiesfrombrowser': 'chrome',
-    }
+def print_cache_stats():
+    """メタデータキャッシュのヒット/ミス数を表示"""
+    if metadata_cache is None:
+        return
+    stats = metadata_cache.stats
+    print(f"💾 メタデータキャッシュ: ヒット {stats['hits']}件 / ミス {stats['misses']}件"
+          f"（期限切れ {stats['expired']}件, 削除 {stats['evictions']}件）")
 
-    try:
-        print(f"\n📥 ダウンロード開始: {url}")
-        print(f"📁 保存先: {output_dir}/")
-        print("-" * 50)
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # 動画情報を取得
-            info = ydl.extract_info(url, download=False)
+def print_archive_stats():
+    """アーカイブでスキップした件数と、新たに記録した件数を表示"""
+    if download_archive is None:
+        return
+    stats = download_archive.stats
+    print(f"🗃️ アーカイブ: 記録済み {stats['hits']}件 / 新規記録 {stats['added']}件")
 
-            # 動画情報を表示
-            if 'entries' in info:
-                # プレイリストの場合
-                print(f"📋 プレイリスト: {info.get('title', 'Unknown')}")
-                print(f"📊 動画数: {len(info['entries'])}本")
-            else:
-                # 単一動画の場合
-                print(f"📹 タイトル: {info.get('title', 'Unknown')}")
-                print(f"👤 チャンネル: {info.get('uploader', 'Unknown')}")
-                print(f"⏱️ 長さ: {format_duration(info.get('duration', 0))}")
-                print(f"👁️ 再生回数: {info.get('view_count', 'Unknown'):,}")
 
-            print("-" * 50)
+def print_store_stats():
+    """ストアからリンクした件数と、新たに追加した件数を表示"""
+    if content_store is None:
+        return
+    stats = content_store.stats
+    print(f"🔗 ストア: ヒット {stats['hits']}件 / 追加 {stats['added']}件"
+          f"（同じ内容のファイルをまとめた数 {stats['deduplicated']}件, 削除 {stats['evictions']}件）")
 
-            # ダウンロード実行
-            ydl.download([url])
 
-        # 字幕をダウンロード（失敗しても続行）
-        download_subtitles(url, output_dir, info)
+def print_usage():
+    """使用方法を表示"""
+    print(f"使用方法: {sys.argv[0]} <YouTube URL> [出力ディレクトリ]")
+    print(f"例: {sys.argv[0]} \"https://www.youtube.com/watch?v=xxxxx\"")
+    print(f"例: {sys.argv[0]} \"https://www.youtube.com/watch?v=xxxxx\" my_videos")
+    print(f"例: {sys.argv[0]} --batch urls.txt my_videos")
+    print(f"例: {sys.argv[0]} --daemon my_videos")
+    print(f"例: {sys.argv[0]} --queue /mnt/shared/queue.db --worker my_videos")
+    print(f"\n📋 オプション:")
+    print(f"  -h, --help            この使用方法を表示")
+    print(f"  --list-formats <URL>   利用可能なフォーマット一覧を表示")
+    print(f"  --format FORMAT       特定のフォーマットを指定（例: --format 22）")
+    print(f"  --format-policy POLICY")
+    print(f"                        フォーマットの選び方（--list-formats の並び順にも使う）")
+    for name, (description, _) in FORMAT_POLICIES.items():
+        print(f"                          {name}: {description}")
+    print(f"  --profile NAME        保存するもの（デフォルト: video）")
+    for name, description in PROFILES.items():
+        print(f"                          {name}: {description}")
+    print(f"  --batch FILE          FILEのURLをまとめてダウンロード（'-' で標準入力）")
+    print(f"  --workers N           バッチの同時実行数（デフォルト: 4）")
+    print(f"  --processes           バッチをスレッドではなくプロセスで並列化")
+    print(f"  --daemon              ジョブを受け付けるAPIを起動して動き続ける（デーモンモード）")
+    print(f"  --daemon-port PORT    デーモンモードのAPIのポート（デフォルト: {DAEMON_PORT}）")
+    print(f"  --daemon-socket PATH  デーモンモードのAPIをポートではなくUnixソケットで待ち受ける")
+    print(f"  --sub-langs LANGS     取得する字幕の言語（カンマ区切り、デフォルト: {','.join(SUBTITLE_LANGS)}）")
+    print(f"  --keep-intermediates  マージ前の動画/音声ファイルを残す")
+    print(f"  --concurrent-fragments N")
+    print(f"                        DASH/HLSのフラグメントを同時にN個ダウンロード（デフォルト: 1）")
+    print(f"  --parallel-streams    動画と音声のストリームを同時にダウンロード")
+    print(f"  --streaming-merge     動画と音声を中間ファイルに書かずにffmpegに渡してマージ（できない場合はファイルを経由）")
+    print(f"  --no-thumbnail        サムネイルを取得・埋め込みしない")
+    print(f"  --export FILE         メディアをダウンロードせずに、動画情報をFILEに1動画1行で書き出す")
+    print(f"                        （URL、または --batch のURL。プレイリスト・チャンネルは各動画を書き出す）")
+    print(f"  --export-format FMT   書き出す形式（{' / '.join(EXPORT_FORMATS)}、デフォルト: FILEの拡張子から。parquet / arrow は pyarrow が必要）")
+    print(f"  --export-fields LIST  書き出す列（カンマ区切り、'all' で全て。デフォルト: {','.join(EXPORT_DEFAULT_COLUMNS)}）")
+    print(f"  --queue PATH          複数のマシンで共有するキュー（SQLite）。URL / --batch はキューに追加して終了")
+    print(f"  --worker              --queue のジョブを借りてダウンロードし続ける（ワーカーモード）")
+    print(f"  --queue-status        --queue のジョブの数と失敗したジョブを表示")
+    print(f"  --lease-seconds N     ワーカーが止まったとみなしてジョブを別のワーカーに渡すまでの秒数"
+          f"（デフォルト: {QUEUE_LEASE_SECONDS}）")
+    print(f"  --exit-when-empty     キューのジョブが無くなったらワーカーを終了する")
+    print(f"  --no-lazy-playlists   プレイリストの全エントリを解決してからダウンロードを始める")
+    print(f"  --max-downloads N     同時にダウンロードする数（デフォルト: --workers と同じ）")
+    print(f"  --max-postprocess N   同時に実行する後処理（ffmpeg）の数（デフォルト: {MAX_POSTPROCESS}）")
+    print(f"  --limit-rate RATE     全ダウンロード合計の帯域の上限（例: 5M, 500K バイト/秒）")
+    print(f"  --max-connections-per-host N")
+    print(f"                        1ホストあたりの同時接続数の上限（デフォルト: {MAX_CONNECTIONS_PER_HOST}）")
+    print(f"  --retries N           429・5xx・通信エラーでダウンロードをやり直す回数（デフォルト: {RETRY_ATTEMPTS}）")
+    print(f"  --circuit-breaker N   同じホストへのダウンロードがN回続けて失敗したら一時的に止める"
+          f"（デフォルト: {CIRCUIT_FAILURE_THRESHOLD}）")
+    print(f"  --progress MODE       進行状況の表示（auto/bar/plain/json/none、デフォルト: auto）")
+    print(f"  --progress-interval SECONDS")
+    print(f"                        進行状況を表示する最小間隔")
+    print(f"  --no-cache            メタデータキャッシュを使わない")
+    print(f"  --archive FILE        ダウンロード済みの動画をFILE（SQLite）に記録し、記録済みの動画は抽出せずに飛ばす")
+    print(f"  --import-archive TXT  yt-dlpのテキスト形式のアーカイブを --archive のFILEに取り込む")
+    print(f"  --store DIR           ダウンロードしたファイルをDIRに保存し、同じ動画・フォーマットはリンクで済ませる")
+    print(f"  --store-max-size SIZE ストアの合計サイズの上限（例: 50G、デフォルト: {STORE_MAX_BYTES // 1024 ** 3}G）")
+    print(f"  --store-gc            ストアを整理して上限のサイズ以下にする（--store と一緒に指定）")
+    print(f"  --no-journal          ジャーナルを使わない（前回の実行の続きから再開せず、最初から実行）")
+    print(f"  --trace FILE          URLごとの段階別の所要時間をFILEに追記（JSON Lines）")
+    print(f"  --trace-chrome FILE   --trace の記録をChromeのトレース形式でもFILEに書き出す")
+    print(f"  --metrics-port PORT   http://127.0.0.1:PORT/metrics でメトリクス（Prometheus形式）を公開")
+    print(f"  --offline-components  EJSソルバーをキャッシュ済みのものだけで解く（GitHubから取得しない）")
+    print(f"  --component-check-interval SECONDS")
+    print(f"                        EJSソルバーの更新確認の間隔（デフォルト: {COMPONENT_CHECK_INTERVAL}秒）")
+    print(f"  --seed-components     EJSソルバーを取得してキャッシュに保存")
+    print(f"  --cache-ttl SECONDS   メタデータキャッシュの有効期間（デフォルト: {METADATA_CACHE_TTL}秒）")
+    print(f"  --cache-size MB       メタデータキャッシュの最大サイズ（デフォルト: {METADATA_CACHE_MAX_BYTES // 1024 // 1024}MB）")
 
-        print("\n✅ ダウンロード完了！")
 
-    except yt_dlp.utils.DownloadError as e:
-        print(f"\n❌ ダウンロードエラー: {e}")
-        sys.exit(1)
-    except KeyboardInterrupt:
-        print("\n⚠️ ダウンロードが中断されました")
-        sys.exit(1)
-    except Exception as e:
-        print(f"\n❌ エラーが発生しました: {e}")
-        sys.exit(1)
+def parse_bytes(text):
+    """'5M' や '500K' のようなサイズ（1K = 1024）をバイト数にする（不正ならNone）"""
+    match = re.fullmatch(r'(\d+(?:\.\d*)?)([kmgtpezy]?)', text.strip(), re.IGNORECASE)
+    if not match:
+        return None
+    exponent = 'kmgtpezy'.find(match.group(2).lower()) + 1 if match.group(2) else 0
+    return round(float(match.group(1)) * 1024 ** exponent)
 
 
-def progress_hook(d):
+def parse_args(argv):
     """
-    ダウンロード進行状況を表示するフック関数
+    コマンドライン引数を解析する
+
+    Args:
+        argv: スクリプト名を除いた引数のリスト
+
+    Returns:
+        オプションのdict
     """
-    if d['status'] == 'downloading':
-        # ダウンロード中の進行状況を表示
-        total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-        downloaded = d.get('downloaded_bytes', 0)
-        
-        if total > 0:
-            percentage = (downloaded / total) * 100
-            speed = d.get('speed', 0)
-            eta = d.get('eta', 0)
-            
-            # 速度をMB/s単位で表示
-            speed_mb = speed / 1024 / 1024 if speed else 0
-            
-            # プログレスバーを作成
-            bar_length = 30
-            filled_length = int(bar_length * downloaded // total)
-            bar = '█' * filled_length + '░' * (bar_length - filled_length)
-            
-            # 進行状況を表示
-            print(f"\r⏬ [{bar}] {percentage:.1f}% | {speed_mb:.2f} MB/s | ETA: {format_time(eta)}", end='', flush=True)
-    
-    elif d['status'] == 'finished':
-        # ダウンロード完了
-        filename = d.get('filename', 'unknown')
-        print(f"\n✓ ダウンロード完了: {os.path.basename(filename)}")
+    args = {
+        'help': False,
+        'url': None,
+        'output_dir': "downloads",
+        'format_code': None,
+        'list_formats': False,
+        'batch_file': None,
+        'workers': 4,
+        'use_processes': False,
+        'daemon': False,
+        'daemon_port': DAEMON_PORT,
+        'daemon_socket': None,
+        'subtitle_langs': SUBTITLE_LANGS,
+        'profile': 'video',
+        'keep_intermediates': False,
+        'concurrent_fragments': 1,
+        'parallel_streams': False,
+        'streaming_merge': False,
+        'thumbnail': True,
+        'export_file': None,
+        'export_format': None,
+        'export_columns': EXPORT_DEFAULT_COLUMNS,
+        'queue_file': None,
+        'worker': False,
+        'queue_status': False,
+        'lease_seconds': QUEUE_LEASE_SECONDS,
+        'exit_when_empty': False,
+        'lazy_playlists': True,
+        'format_policy': None,
+        'max_connections_per_host': MAX_CONNECTIONS_PER_HOST,
+        'retries': RETRY_ATTEMPTS,
+        'circuit_threshold': CIRCUIT_FAILURE_THRESHOLD,
+        'max_downloads': None,
+        'max_postprocess': MAX_POSTPROCESS,
+        'rate_limit': None,
+        'progress_mode': 'auto',
+        'progress_interval': None,
+        'use_cache': True,
+        'use_journal': True,
+        'archive_file': None,
+        'import_archive': None,
+        'store_dir': None,
+        'store_max_bytes': STORE_MAX_BYTES,
+        'store_gc': False,
+        'trace_file': None,
+        'trace_chrome': None,
+        'metrics_port': None,
+        'cache_ttl': METADATA_CACHE_TTL,
+        'cache_max_bytes': METADATA_CACHE_MAX_BYTES,
+        'offline_components': False,
+        'component_check_interval': COMPONENT_CHECK_INTERVAL,
+        'seed_components': False,
+    }
 
+    positional = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
 
-def format_duration(seconds):
-    """秒数を時:分:秒形式に変換"""
-    if not seconds:
-        return "Unknown"
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    secs = seconds % 60
-    
-    if hours > 0:
-        return f"{hours:02d}:{minutes:02d}:{secs:02d}"
-    else:
-        return f"{minutes:02d}:{secs:02d}"
+        if arg in ("-h", "--help"):
+            args['help'] = True
+            i += 1
+        elif arg == "--format" and i + 1 < len(argv):
+            args['format_code'] = argv[i + 1]
+            i += 2
+        elif arg == "--format-policy" and i + 1 < len(argv):
+            parse_format_policy(argv[i + 1])
+            args['format_policy'] = argv[i + 1]
+            i += 2
+        elif arg == "--list-formats":
+            args['list_formats'] = True
+            i += 1
+        elif arg == "--profile" and i + 1 < len(argv):
+            if argv[i + 1] not in PROFILES:
+                raise ValueError(f"不明なプロファイル: {argv[i + 1]}（{', '.join(PROFILES)}）")
+            args['profile'] = argv[i + 1]
+            i += 2
+        elif arg == "--batch" and i + 1 < len(argv):
+            args['batch_file'] = argv[i + 1]
+            i += 2
+        elif arg == "--workers" and i + 1 < len(argv):
+            args['workers'] = max(1, int(argv[i + 1]))
+            i += 2
+        elif arg == "--processes":
+            args['use_processes'] = True
+            i += 1
+        elif arg == "--daemon":
+            args['daemon'] = True
+            i += 1
+        elif arg == "--daemon-port" and i + 1 < len(argv):
+            args['daemon_port'] = int(argv[i + 1])
+            i += 2
+        elif arg == "--daemon-socket" and i + 1 < len(argv):
+            args['daemon_socket'] = argv[i + 1]
+            i += 2
+        elif arg == "--sub-langs" and i + 1 < len(argv):
+            args['subtitle_langs'] = [lang for lang in argv[i + 1].split(',') if lang]
+            i += 2
+        elif arg == "--keep-intermediates":
+            args['keep_intermediates'] = True
+            i += 1
+        elif arg == "--concurrent-fragments" and i + 1 < len(argv):
+            args['concurrent_fragments'] = max(1, int(argv[i + 1]))
+            i += 2
+        elif arg == "--parallel-streams":
+            args['parallel_streams'] = True
+            i += 1
+        elif arg == "--streaming-merge":
+            args['streaming_merge'] = True
+            i += 1
+        elif arg == "--no-thumbnail":
+            args['thumbnail'] = False
+            i += 1
+        elif arg == "--export" and i + 1 < len(argv):
+            args['export_file'] = argv[i + 1]
+            i += 2
+        elif arg == "--export-format" and i + 1 < len(argv):
+            if argv[i + 1] not in EXPORT_FORMATS:
+                raise ValueError(f"エクスポートの形式は {' / '.join(EXPORT_FORMATS)} のいずれかです: {argv[i + 1]}")
+            args['export_format'] = argv[i + 1]
+            i += 2
+        elif arg == "--export-fields" and i + 1 < len(argv):
+            if argv[i + 1] == 'all':
+                args['export_columns'] = tuple(EXPORT_COLUMNS)
+            else:
+                args['export_columns'] = tuple(name for name in argv[i + 1].split(',') if name)
+                unknown = [name for name in args['export_columns'] if name not in EXPORT_COLUMNS]
+                if unknown:
+                    raise ValueError(f"不明な列です: {', '.join(unknown)}（{', '.join(EXPORT_COLUMNS)}）")
+            i += 2
+        elif arg == "--queue" and i + 1 < len(argv):
+            args['queue_file'] = argv[i + 1]
+            i += 2
+        elif arg == "--worker":
+            args['worker'] = True
+            i += 1
+        elif arg == "--queue-status":
+            args['queue_status'] = True
+            i += 1
+        elif arg == "--lease-seconds" and i + 1 < len(argv):
+            args['lease_seconds'] = max(QUEUE_RENEW_INTERVAL * 2, int(argv[i + 1]))
+            i += 2
+        elif arg == "--exit-when-empty":
+            args['exit_when_empty'] = True
+            i += 1
+        elif arg == "--no-lazy-playlists":
+            args['lazy_playlists'] = False
+            i += 1
+        elif arg == "--max-downloads" and i + 1 < len(argv):
+            args['max_downloads'] = max(1, int(argv[i + 1]))
+            i += 2
+        elif arg == "--max-postprocess" and i + 1 < len(argv):
+            args['max_postprocess'] = max(1, int(argv[i + 1]))
+            i += 2
+        elif arg == "--limit-rate" and i + 1 < len(argv):
+            args['rate_limit'] = parse_bytes(argv[i + 1])
+            if not args['rate_limit']:
+                raise ValueError(f"帯域の指定が不正です: {argv[i + 1]}")
+            i += 2
+        elif arg == "--max-connections-per-host" and i + 1 < len(argv):
+            args['max_connections_per_host'] = max(1, int(argv[i + 1]))
+            i += 2
+        elif arg == "--retries" and i + 1 < len(argv):
+            args['retries'] = max(0, int(argv[i + 1]))
+            i += 2
+        elif arg == "--circuit-breaker" and i + 1 < len(argv):
+            args['circuit_threshold'] = max(1, int(argv[i + 1]))
+            i += 2
+        elif arg == "--progress" and i + 1 < len(argv):
+            args['progress_mode'] = argv[i + 1]
+            i += 2
+        elif arg == "--progress-interval" and i + 1 < len(argv):
+            args['progress_interval'] = float(argv[i + 1])
+            i += 2
+        elif arg == "--no-cache":
+            args['use_cache'] = False
+            i += 1
+        elif arg == "--archive" and i + 1 < len(argv):
+            args['archive_file'] = argv[i + 1]
+            i += 2
+        elif arg == "--import-archive" and i + 1 < len(argv):
+            args['import_archive'] = argv[i + 1]
+            i += 2
+        elif arg == "--store" and i + 1 < len(argv):
+            args['store_dir'] = argv[i + 1]
+            i += 2
+        elif arg == "--store-max-size" and i + 1 < len(argv):
+            args['store_max_bytes'] = parse_bytes(argv[i + 1])
+            if args['store_max_bytes'] is None:
+                raise ValueError(f"サイズの指定が不正です: {argv[i + 1]}")
+            i += 2
+        elif arg == "--store-gc":
+            args['store_gc'] = True
+            i += 1
+        elif arg == "--no-journal":
+            args['use_journal'] = False
+            i += 1
+        elif arg == "--trace" and i + 1 < len(argv):
+            args['trace_file'] = argv[i + 1]
+            i += 2
+        elif arg == "--trace-chrome" and i + 1 < len(argv):
+            args['trace_chrome'] = argv[i + 1]
+            i += 2
+        elif arg == "--metrics-port" and i + 1 < len(argv):
+            args['metrics_port'] = int(argv[i + 1])
+            i += 2
+        elif arg == "--cache-ttl" and i + 1 < len(argv):
+            args['cache_ttl'] = int(argv[i + 1])
+            i += 2
+        elif arg == "--cache-size" and i + 1 < len(argv):
+            args['cache_max_bytes'] = int(argv[i + 1]) * 1024 * 1024
+            i += 2
+        elif arg == "--offline-components":
+            args['offline_components'] = True
+            i += 1
+        elif arg == "--component-check-interval" and i + 1 < len(argv):
+            args['component_check_interval'] = int(argv[i + 1])
+            i += 2
+        elif arg == "--seed-components":
+            args['seed_components'] = True
+            i += 1
+        elif arg == "-" or not arg.startswith("--"):
+            positional.append(arg)
+            i += 1
+        else:
+            print(f"⚠️ 不明なオプション: {arg}")
+            i += 1
 
+    # バッチモード・デーモンモード・ワーカーモードでは位置引数は出力ディレクトリのみ
+    if args['batch_file'] is None and not args['daemon'] and not args['worker'] and positional:
+        args['url'] = positional.pop(0)
+    if positional:
+        # オプションでない場合は出力ディレクトリとして扱う
+        args['output_dir'] = positional[-1]
 
-def format_time(seconds):
-    """秒数を読みやすい形式に変換"""
-    if not seconds:
-        return "Unknown"
-    if seconds < 60:
-        return f"{seconds}秒"
-    elif seconds < 3600:
-        return f"{seconds // 60}分{seconds % 60}秒"
-    else:
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        return f"{hours}時間{minutes}分"
+    return args
 
 
 def main():
@@ -226,70 +5391,268 @@ def main():
     # コマンドライン引数をチェック
     if len(sys.argv) < 2:
         print("❌ エラー: URLを指定してください")
-        print(f"使用方法: {sys.argv[0]} <YouTube URL> [出力ディレクトリ]")
-        print(f"例: {sys.argv[0]} \"https://www.youtube.com/watch?v=xxxxx\"")
-        print(f"例: {sys.argv[0]} \"https://www.youtube.com/watch?v=xxxxx\" my_videos")
-        print(f"\n📋 オプション:")
-        print(f"  --list-formats <URL>   利用可能なフォーマット一覧を表示")
-        print(f"  --format FORMAT       特定のフォーマットを指定（例: --format 22）")
+        print_usage()
         sys.exit(1)
-    
-    # 最初の引数をチェック
-    first_arg = sys.argv[1]
-    
-    # --list-formatsが最初の引数の場合
-    if first_arg == "--list-formats":
-        if len(sys.argv) < 3:
+
+    try:
+        args = parse_args(sys.argv[1:])
+    except ValueError as e:
+        print(f"❌ エラー: 引数が不正です: {e}")
+        print_usage()
+        sys.exit(1)
+
+    if args['help']:
+        print_usage()
+        sys.exit(0)
+
+    # URLが無い場合は、キャッシュなどを準備する前に終了する
+    if not args['url'] and not (args['seed_components'] or args['import_archive'] or args['store_gc']
+                                or args['queue_status']):
+        if args['list_formats']:
             print("❌ エラー: --list-formats の後にURLを指定してください")
             print(f"例: {sys.argv[0]} --list-formats \"https://www.youtube.com/watch?v=xxxxx\"")
             sys.exit(1)
-        url = sys.argv[2]
-        list_formats(url)
+        if args['batch_file'] is None and not args['daemon'] and not args['worker']:
+            print("❌ エラー: URLを指定してください")
+            print_usage()
+            sys.exit(1)
+
+    # 進行状況の表示
+    try:
+        configure_progress(args['progress_mode'], args['progress_interval'])
+    except ValueError as e:
+        print(f"❌ エラー: {e}")
+        print_usage()
+        sys.exit(1)
+
+    # EJSソルバーの取得設定
+    component_settings['offline'] = args['offline_components']
+    component_settings['check_interval'] = args['component_check_interval']
+
+    # --seed-components の場合
+    if args['seed_components']:
+        try:
+            version = seed_components()
+        except Exception as e:
+            print(f"❌ エラー: EJSソルバーを取得できません: {e}")
+            sys.exit(1)
+        print(f"✓ EJSソルバー v{version} を保存しました: {COMPONENT_CACHE_DIR}/")
         sys.exit(0)
-    
-    # 通常のURL処理
-    url = first_arg
-    output_dir = "downloads"
-    format_code = None
-    
-    # 残りのオプション引数の処理
-    i = 2
-    while i < len(sys.argv):
-        arg = sys.argv[i]
-        
-        if arg == "--format" and i + 1 < len(sys.argv):
-            format_code = sys.argv[i + 1]
-            i += 2
-        elif arg == "--list-formats":
-            # URLの後に--list-formatsが来た場合
-            list_formats(url)
-            sys.exit(0)
-        elif not arg.startswith("--"):
-            # オプションでない場合は出力ディレクトリとして扱う
-            output_dir = arg
-            i += 1
-        else:
-            print(f"⚠️ 不明なオプション: {arg}")
-            i += 1
-    
+
+    # メタデータキャッシュ（使えなくてもダウンロードは続行）
+    if args['use_cache']:
+        try:
+            configure_metadata_cache(ttl=args['cache_ttl'], max_bytes=args['cache_max_bytes'])
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️ メタデータキャッシュを使用できません（キャッシュなしで続行）: {e}")
+
+    # ダウンロード済みの動画のアーカイブ
+    if args['archive_file']:
+        try:
+            configure_archive(args['archive_file'])
+        except (OSError, sqlite3.Error) as e:
+            print(f"❌ エラー: アーカイブを開けません: {e}")
+            sys.exit(1)
+
+    # --import-archive の場合
+    if args['import_archive']:
+        if download_archive is None:
+            print("❌ エラー: --import-archive には --archive で取り込み先を指定してください")
+            sys.exit(1)
+        try:
+            added = download_archive.import_file(args['import_archive'])
+        except (OSError, sqlite3.Error) as e:
+            print(f"❌ エラー: アーカイブを取り込めません: {e}")
+            sys.exit(1)
+        print(f"✓ {added}件をアーカイブに取り込みました（合計 {len(download_archive)}件）: {download_archive.path}")
+        sys.exit(0)
+
+    # ダウンロードしたメディアのストア
+    if args['store_dir']:
+        try:
+            configure_store(args['store_dir'], args['store_max_bytes'])
+        except (OSError, sqlite3.Error) as e:
+            print(f"❌ エラー: ストアを開けません: {e}")
+            sys.exit(1)
+
+    # --store-gc の場合
+    if args['store_gc']:
+        if content_store is None:
+            print("❌ エラー: --store-gc には --store で整理するストアを指定してください")
+            sys.exit(1)
+        try:
+            stats = content_store.gc()
+        except (OSError, sqlite3.Error) as e:
+            print(f"❌ エラー: ストアを整理できません: {e}")
+            sys.exit(1)
+        print(f"✓ ストアを整理しました: {stats['removed']}件を削除（{stats['freed'] / 1024 / 1024:.1f}MB 解放）、"
+              f"残り {stats['objects']}件 / {stats['bytes'] / 1024 / 1024:.1f}MB: {content_store.path}")
+        sys.exit(0)
+
+    # 複数のマシンで共有するジョブのキュー
+    if (args['worker'] or args['queue_status']) and not args['queue_file']:
+        print("❌ エラー: --worker / --queue-status には --queue でキューを指定してください")
+        sys.exit(1)
+    if args['queue_file']:
+        try:
+            configure_queue(args['queue_file'], lease_seconds=args['lease_seconds'])
+        except (OSError, sqlite3.Error) as e:
+            print(f"❌ エラー: キューを開けません: {e}")
+            sys.exit(1)
+
+    # --queue-status の場合
+    if args['queue_status']:
+        counts = shared_queue.counts()
+        print(f"🛰️ キュー: {shared_queue.path}")
+        print_queue_counts(counts)
+        for failure in shared_queue.failures():
+            print(f"  ❌ {failure['url']}: {failure['error']}")
+        sys.exit(0)
+
+    # --list-formats の場合
+    if args['list_formats']:
+        list_formats(args['url'], args['format_policy'])
+        print_cache_stats()
+        sys.exit(0)
+
+    url = args['url']
+    output_dir = args['output_dir']
+    format_code = args['format_code']
+    options = {key: args[key] for key in DEFAULT_DOWNLOAD_OPTIONS if key in args}
+    # YouTubeのURLだけなら、YouTubeの抽出器だけを登録する
+    options['extractors'] = extractors_for_urls([url] if url else [])
+    configure_host_limiter(args['max_connections_per_host'])
+    configure_circuit_breaker(args['circuit_threshold'])
+    configure_scheduler(max_downloads=args['max_downloads'] or args['workers'],
+                        max_postprocess=args['max_postprocess'], rate_limit=args['rate_limit'])
+
+    # ジャーナル（使えなくてもダウンロードは続行）
+    if args['use_journal']:
+        try:
+            configure_journal()
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️ ジャーナルを使用できません（中断後の再開なしで続行）: {e}")
+
+    # 段階ごとの所要時間の記録
+    if args['trace_chrome'] and not args['trace_file']:
+        print("❌ エラー: --trace-chrome には --trace で記録先を指定してください")
+        sys.exit(1)
+    if args['trace_file']:
+        try:
+            configure_trace(args['trace_file'], args['trace_chrome'])
+        except OSError as e:
+            print(f"❌ エラー: 記録先を開けません: {e}")
+            sys.exit(1)
+
+    # メトリクスの公開
+    if args['metrics_port'] is not None:
+        try:
+            configure_metrics(args['metrics_port'])
+        except OSError as e:
+            print(f"❌ エラー: メトリクスのポートを開けません: {e}")
+            sys.exit(1)
+        print(f"📈 メトリクス: http://127.0.0.1:{args['metrics_port']}/metrics")
+
     # ヘッダー表示
     print("\n" + "=" * 50)
     print("🎥 YouTube Video Downloader v3.0")
     print("=" * 50)
     print(f"📅 実行時刻: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    
+
+    # 動画情報のエクスポート（メディアはダウンロードしない）
+    if args['export_file']:
+        try:
+            urls = read_batch_urls(args['batch_file']) if args['batch_file'] is not None else [url]
+        except OSError as e:
+            print(f"❌ エラー: バッチファイルを読み込めません: {e}")
+            sys.exit(1)
+        options['extractors'] = extractors_for_urls(urls)
+        path = args['export_file']
+        fmt = args['export_format'] or {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}.get(
+            Path(path).suffix.lower(), 'ndjson')
+        try:
+            summary = export_metadata(urls, path, args['export_columns'], fmt,
+                                      workers=args['workers'], options=options)
+        except (OSError, ValueError) as e:
+            print(f"❌ エラー: エクスポートできません: {e}")
+            sys.exit(1)
+        print(f"\n📄 動画情報を '{path}' に書き出しました")
+        print("=" * 50 + "\n")
+        sys.exit(1 if summary['failed'] else 0)
+
+    # キューへの追加（ダウンロードはワーカーが行う）
+    if args['queue_file'] and not args['worker']:
+        try:
+            urls = read_batch_urls(args['batch_file']) if args['batch_file'] is not None else [url]
+        except OSError as e:
+            print(f"❌ エラー: バッチファイルを読み込めません: {e}")
+            sys.exit(1)
+        options['extractors'] = extractors_for_urls(urls)
+        print(f"\n🛰️ キューに追加中: {shared_queue.path}")
+        try:
+            added = shared_queue.enqueue(queue_urls(urls, options))
+        except sqlite3.Error as e:
+            print(f"❌ エラー: キューに追加できません: {e}")
+            sys.exit(1)
+        print(f"✓ {added}件をキューに追加しました")
+        print_queue_counts(shared_queue.counts())
+        print("=" * 50 + "\n")
+        sys.exit(0)
+
+    # ワーカーモード
+    if args['worker']:
+        summary = run_worker(shared_queue, output_dir, format_code, workers=args['workers'], options=options,
+                             exit_when_empty=args['exit_when_empty'])
+        print(f"\n📂 ファイルは '{output_dir}/' フォルダに保存されました")
+        print("=" * 50 + "\n")
+        sys.exit(1 if summary['failed'] else 0)
+
+    # デーモンモード
+    if args['daemon']:
+        try:
+            run_daemon(output_dir, format_code, workers=args['workers'], options=options,
+                       port=args['daemon_port'], socket_path=args['daemon_socket'])
+        except OSError as e:
+            print(f"❌ エラー: APIを起動できません: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    # バッチモード
+    if args['batch_file'] is not None:
+        try:
+            urls = read_batch_urls(args['batch_file'])
+        except OSError as e:
+            print(f"❌ エラー: バッチファイルを読み込めません: {e}")
+            sys.exit(1)
+        options['extractors'] = extractors_for_urls(urls)
+        summary = run_batch(urls, output_dir, format_code,
+                            workers=args['workers'], use_processes=args['use_processes'],
+                            options=options)
+        print(f"\n📂 ファイルは '{output_dir}/' フォルダに保存されました")
+        print("=" * 50 + "\n")
+        sys.exit(1 if summary['failed'] else 0)
+
     # フォーマット指定がある場合は渡す
     if format_code:
-        download_video_with_format(url, output_dir, format_code)
+        download_video_with_format(url, output_dir, format_code, options)
     else:
-        download_video(url, output_dir)
-    
+        download_video(url, output_dir, options)
+
+    print_cache_stats()
+    print_archive_stats()
+    print_store_stats()
     print(f"\n📂 ファイルは '{output_dir}/' フォルダに保存されました")
     print("=" * 50 + "\n")
 
 
-def list_formats(url):
-    """利用可能なフォーマット一覧を表示"""
+def list_formats(url, policy=None):
+    """
+    利用可能なフォーマット一覧を、ポリシーで良い順に表示
+
+    Args:
+        url: 動画のURL
+        policy: フォーマット選択のポリシー（Noneなら DEFAULT_FORMAT_POLICY）
+    """
     print("\n📋 利用可能なフォーマット一覧を取得中...")
 
     # より詳細なオプションでフォーマット情報を取得
@@ -300,13 +5663,15 @@ def list_formats(url):
         'geo_bypass': True,
         'extract_flat': False,  # 完全な情報を取得
 
-        # YouTubeの署名/nチャレンジを解くためのEJSスクリプトを取得
-        'remote_components': ['ejs:github'],
+        # YouTubeの署名/nチャレンジを解くためのEJSスクリプト（キャッシュを共有）
+        **component_opts(),
     }
+    if extractors_for_urls([url]):
+        ydl_opts['allowed_extractors'] = YOUTUBE_EXTRACTORS
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        with create_ydl(ydl_opts) as ydl:
+            info = extract_info(ydl, url)
 
             print(f"\n📹 タイトル: {info.get('title', 'Unknown')}")
             print("-" * 60)
@@ -319,76 +5684,50 @@ def list_formats(url):
                 print("   しばらく時間をおいて再度お試しください")
                 return
 
-            # フォーマットをカテゴリ別に整理
-            video_formats = []
-            audio_formats = []
-
-            for f in formats:
-                format_id = f.get('format_id', 'N/A')
-                ext = f.get('ext', 'N/A')
-                resolution = f.get('resolution', 'N/A')
-                fps = f.get('fps', 'N/A')
-                vcodec = f.get('vcodec', 'N/A')
-                acodec = f.get('acodec', 'N/A')
-                filesize = f.get('filesize', 0)
-                url_available = f.get('url', None) is not None
-
-                # ファイルサイズをMBで表示
-                size_mb = filesize / 1024 / 1024 if filesize else 0
-                size_str = f"{size_mb:.1f}MB" if size_mb > 0 else "N/A"
-
-                # URLが利用可能かチェック
-                status = "✓" if url_available else "✗"
-
-                if vcodec != 'none':
-                    video_formats.append({
-                        'id': format_id,
-                        'ext': ext,
-                        'resolution': resolution,
-                        'fps': fps,
-                        'size': size_str,
-                        'vcodec': vcodec,
-                        'acodec': acodec,
-                        'available': url_available,
-                        'status': status,
-                    })
-                elif acodec != 'none':
-                    audio_formats.append({
-                        'id': format_id,
-                        'ext': ext,
-                        'acodec': acodec,
-                        'size': size_str,
-                        'available': url_available,
-                        'status': status,
-                    })
+            # フォーマットを表にして、ポリシーで順位付けする
+            rows = format_table(formats, info.get('duration'))
+            video_formats = rank_formats(rows, policy, 'video')
+            audio_formats = rank_formats(rows, policy, 'audio')
+
+            def size_str(row):
+                if not row.size:
+                    return "N/A"
+                # 推定値には ~ を付ける
+                return f"{'' if row.size_exact else '~'}{row.size / 1024 / 1024:.1f}MB"
 
             # 動画フォーマットを表示
             if video_formats:
                 print("\n🎥 動画フォーマット:")
                 print(f"{'ID':<6} {'解像度':<10} {'FPS':<5} {'形式':<5} {'サイズ':<10} {'ステータス':<8} {'コーデック'}")
                 print("-" * 70)
-                for f in sorted(video_formats, key=lambda x: (x['available'], x['resolution']), reverse=True):
-                    print(f"{f['id']:<6} {f['resolution']:<10} {f['fps']:<5} {f['ext']:<5} {f['size']:<10} {f['status']:<8} {f['vcodec']}")
+                for row in video_formats:
+                    f = formats[row.index]
+                    resolution = f"{row.width}x{row.height}" if row.height else f.get('resolution') or 'N/A'
+                    print(f"{row.format_id:<6} {resolution:<10} {row.fps or 'N/A':<5} {row.ext:<5} "
+                          f"{size_str(row):<10} {'✓' if row.available else '✗':<8} {f.get('vcodec', 'N/A')}")
 
             # 音声フォーマットを表示
             if audio_formats:
                 print("\n🎵 音声フォーマット:")
                 print(f"{'ID':<6} {'形式':<5} {'サイズ':<10} {'ステータス':<8} {'コーデック'}")
                 print("-" * 50)
-                for f in audio_formats:
-                    print(f"{f['id']:<6} {f['ext']:<5} {f['size']:<10} {f['status']:<8} {f['acodec']}")
+                for row in audio_formats:
+                    print(f"{row.format_id:<6} {row.ext:<5} {size_str(row):<10} "
+                          f"{'✓' if row.available else '✗':<8} {formats[row.index].get('acodec', 'N/A')}")
 
             # 利用可能なフォーマットがあるかチェック
-            available_video = [f for f in video_formats if f['available']]
-            available_audio = [f for f in audio_formats if f['available']]
+            available_video = [row for row in video_formats if row.available]
+            available_audio = [row for row in audio_formats if row.available]
 
             if available_video or available_audio:
                 print("\n💡 ヒント: 特定のフォーマットをダウンロードするには:")
                 print(f"   uv run youtube_dl_v3.py \"{url}\" --format <ID>")
                 print(f"   例: uv run youtube_dl_v3.py \"{url}\" --format 22")
                 if available_video:
-                    best_video = max(available_video, key=lambda x: x['resolution'])
-                    print(f"   おすすめ: --format {best_video['id']} (最高品質の動画)")
+                    # 一覧はポリシーの順に並んでいるので、先頭がおすすめ
+                    name, _ = parse_format_policy(policy)
+                    print(f"   おすすめ: --format {available_video[0].format_id} "
+                          f"({FORMAT_POLICIES[name][0]}、--format-policy {policy or DEFAULT_FORMAT_POLICY})")
             else:
                 print("\n⚠️ 利用可能なフォーマットがありません")
                 print("💡 ヒント: YouTubeの仕様変更により、一時的に利用できない可能性があります")
@@ -407,34 +5746,11 @@ def list_formats(url):
         print("   詳細: https://github.com/yt-dlp/yt-dlp/issues")
 
 
-def download_video_with_format(url, output_dir, format_code):
+def download_video_with_format(url, output_dir, format_code, options=None):
     """指定されたフォーマットで動画をダウンロード"""
     Path(output_dir).mkdir(exist_ok=True)
 
-    ydl_opts = {
-        'outtmpl': f'{output_dir}/%(title)s_%(id)s.%(ext)s',
-        'format': f'{format_code}+bestaudio/best',  # 指定されたフォーマットに音声を追加
-        'writesubtitles': False,  # 字幕は別途ダウンロード
-        'writeautomaticsub': False,
-        'writethumbnail': True,
-        'embedthumbnail': True,
-        'keepvideo': True,
-        'addmetadata': True,
-        'progress_hooks': [progress_hook],
-        'ignoreerrors': False,
-        'quiet': False,
-        'no_warnings': False,
-        'nocheckcertificate': True,
-        'geo_bypass': True,
-
-        # YouTubeの署名/nチャレンジを解くためのEJSスクリプトを取得
-        'remote_components': ['ejs:github'],
-
-        # 通信エラー/403対策のリトライ
-        'retries': 10,
-        'fragment_retries': 10,
-        'file_access_retries': 5,
-    }
+    ydl_opts = build_download_opts(output_dir, format_code, options)
 
     try:
         print(f"\n📥 ダウンロード開始: {url}")
@@ -442,22 +5758,9 @@ def download_video_with_format(url, output_dir, format_code):
         print(f"🎯 指定フォーマット: {format_code}")
         print("-" * 50)
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # 動画情報を取得
-            info = ydl.extract_info(url, download=False)
-
-            # 動画情報を表示
-            print(f"📹 タイトル: {info.get('title', 'Unknown')}")
-            print(f"👤 チャンネル: {info.get('uploader', 'Unknown')}")
-            print(f"⏱️ 長さ: {format_duration(info.get('duration', 0))}")
-            print(f"👁️ 再生回数: {info.get('view_count', 'Unknown'):,}")
-            print("-" * 50)
-
-            # ダウンロード実行
-            ydl.download([url])
-
-        # 字幕をダウンロード（失敗しても続行）
-        download_subtitles(url, output_dir, info)
+        with create_ydl(ydl_opts) as ydl:
+            # 指定フォーマットのコンテナはそのまま保持する
+            run_pipeline(ydl, url, output_dir, target_ext=None, options=options)
 
         print("\n✅ ダウンロード完了！")
 